@@ -0,0 +1,304 @@
+import logging
+import threading
+import time
+from collections import deque, Counter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from urllib.parse import urlsplit
+from sqlalchemy import select, insert, delete
+from sqlstuff import engine, ClickEvent, ClickRollup
+from config import ANALYTICS_BUFFER_SIZE, ANALYTICS_FLUSH_INTERVAL, ANALYTICS_BATCH_SIZE, ANALYTICS_TOMBSTONE_TTL
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ("minute", "hour", "day")
+BUCKET_STEP = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+# Период по умолчанию для /links/{short_code}/stats/timeseries
+DEFAULT_SPAN = {
+    "minute": timedelta(hours=1),
+    "hour": timedelta(days=2),
+    "day": timedelta(days=30),
+}
+
+# Порядок важен: в User-Agent Edge и Opera есть "Chrome/", а в Chrome — "Safari/"
+UA_FAMILIES = (
+    ("bot", "Bot"),
+    ("spider", "Bot"),
+    ("crawl", "Bot"),
+    ("edg/", "Edge"),
+    ("opr/", "Opera"),
+    ("firefox/", "Firefox"),
+    ("chrome/", "Chrome"),
+    ("safari/", "Safari"),
+    ("curl/", "curl"),
+)
+
+
+@lru_cache(maxsize=4096)
+def ua_family(user_agent: str | None) -> str | None:
+    """Грубое семейство браузера по User-Agent. Одинаковые строки повторяются, поэтому кэшируем."""
+    if not user_agent:
+        return None
+    lowered = user_agent.lower()
+    for marker, family in UA_FAMILIES:
+        if marker in lowered:
+            return family
+    return "Other"
+
+
+def referrer_host(referrer: str | None) -> str | None:
+    if not referrer:
+        return None
+    try:
+        return urlsplit(referrer).hostname
+    except ValueError:
+        return None
+
+
+def country_from_ip(ip: str | None) -> str | None:
+    """Заглушка: пока не подключена база GeoIP, страна неизвестна."""
+    return None
+
+
+def to_naive_utc(when: datetime) -> datetime:
+    """В БД время хранится в UTC без часового пояса."""
+    if when.tzinfo is not None:
+        return when.astimezone(timezone.utc).replace(tzinfo=None)
+    return when
+
+
+def bucket_start(when: datetime, granularity: str) -> datetime:
+    if granularity == "minute":
+        return when.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def rollup_upsert(dialect_name: str):
+    """INSERT ... ON CONFLICT DO UPDATE, прибавляющий клики к существующему интервалу."""
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    table = ClickRollup.__table__
+    stmt = dialect_insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.short_code, table.c.granularity, table.c.bucket_start],
+        set_={"clicks": table.c.clicks + stmt.excluded.clicks},
+    )
+
+
+def timeseries_query(short_code: str, granularity: str, start: datetime, end: datetime):
+    """Интервалы из click_rollups; читается только диапазон первичного ключа, без сырых событий."""
+    return (
+        select(ClickRollup.bucket_start, ClickRollup.clicks)
+        .where(
+            ClickRollup.short_code == short_code,
+            ClickRollup.granularity == granularity,
+            ClickRollup.bucket_start >= start,
+            ClickRollup.bucket_start <= end,
+        )
+        .order_by(ClickRollup.bucket_start)
+    )
+
+
+def analytics_delete_statements(short_codes) -> list:
+    """DELETE сырых событий и агрегатов удаляемых ссылок — выполняются в транзакции удаления ссылки."""
+    short_codes = list(short_codes)
+    return [
+        delete(ClickEvent.__table__).where(ClickEvent.short_code.in_(short_codes)),
+        delete(ClickRollup.__table__).where(ClickRollup.short_code.in_(short_codes)),
+    ]
+
+
+def fill_buckets(rows, granularity: str, start: datetime, end: datetime) -> list[tuple[datetime, int]]:
+    """Дополняет разреженные интервалы нулями, от bucket_start(start) до end включительно."""
+    clicks = {row.bucket_start: row.clicks for row in rows}
+    step = BUCKET_STEP[granularity]
+    points = []
+    current = bucket_start(start, granularity)
+    while current <= end:
+        points.append((current, clicks.get(current, 0)))
+        current += step
+    return points
+
+
+class ClickEventPipeline:
+    """
+    События кликов для аналитики. Редирект только кладёт сырое событие в кольцевой
+    буфер; разбор заголовков, запись в click_events и обновление агрегатов
+    click_rollups выполняет фоновый поток пачками. Коды удалённых ссылок tombstone_ttl
+    секунд помнятся как «надгробия»: клики редиректов, начавшихся до удаления, не пишутся.
+    """
+
+    def __init__(self, bind, capacity: int, flush_interval: float, batch_size: int, tombstone_ttl: float = 300.0):
+        self.bind = bind
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.tombstone_ttl = tombstone_ttl
+        self._tombstones = {}  # short_code -> до какого момента (monotonic) отбрасывать клики
+        self._tombstone_lock = threading.Lock()
+        # deque с maxlen — кольцевой буфер: append атомарен и при переполнении вытесняет старые события
+        self._buffer = deque(maxlen=capacity)
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._upsert = rollup_upsert(bind.dialect.name)
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.discarded = 0
+        self.errors = 0
+
+    def record(self, short_code: str, referrer: str | None, user_agent: str | None,
+               ip: str | None, when: datetime | None = None):
+        """Добавляет событие в буфер. Не обращается к БД."""
+        if self._tombstones and self._is_deleted(short_code):
+            self.discarded += 1
+            return
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append((short_code, when or datetime.utcnow(), referrer, user_agent, ip))
+        self.recorded += 1
+        self.ensure_started()
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def discard(self, short_codes):
+        """
+        Ставит надгробия удаляемым ссылкам и убирает из буфера их ещё не записанные события.
+        Вызывается до удаления строк: записанное раньше удалится вместе со ссылкой, а более
+        поздние клики отбросят record() и flush().
+        """
+        short_codes = set(short_codes)
+        now = time.monotonic()
+        with self._tombstone_lock:
+            self._tombstones = {code: until for code, until in self._tombstones.items() if until > now}
+            self._tombstones.update(dict.fromkeys(short_codes, now + self.tombstone_ttl))
+        with self._flush_lock:
+            kept = []
+            # Новые события дописываются справа; проходим только те, что были в буфере
+            for _ in range(len(self._buffer)):
+                try:
+                    event = self._buffer.popleft()
+                except IndexError:
+                    break
+                if event[0] not in short_codes:
+                    kept.append(event)
+            self._buffer.extendleft(reversed(kept))
+
+    def revive(self, short_codes):
+        """Снимает надгробия: код снова занят новой ссылкой, её клики нужно записывать."""
+        with self._tombstone_lock:
+            for code in short_codes:
+                self._tombstones.pop(code, None)
+
+    def _is_deleted(self, short_code: str) -> bool:
+        until = self._tombstones.get(short_code)
+        return until is not None and until > time.monotonic()
+
+    def _deleted_among(self, short_codes) -> list[str]:
+        if not self._tombstones:
+            return []
+        return [code for code in short_codes if self._is_deleted(code)]
+
+    def flush(self) -> int:
+        """Записывает в БД одну пачку событий. Возвращает, сколько событий взято из буфера."""
+        with self._flush_lock:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._buffer.popleft())
+            except IndexError:
+                pass
+            if not batch:
+                return 0
+            taken = len(batch)
+            # Клики удалённых ссылок, попавшие в буфер уже после discard() (record проверил
+            # надгробие до того, как оно появилось)
+            deleted = set(self._deleted_among({event[0] for event in batch}))
+            if deleted:
+                batch = [event for event in batch if event[0] not in deleted]
+                self.discarded += taken - len(batch)
+                if not batch:
+                    return taken
+            events = []
+            rollups = Counter()
+            for short_code, when, referrer, user_agent, ip in batch:
+                events.append({
+                    "short_code": short_code,
+                    "occurred_at": when,
+                    "referrer": referrer_host(referrer),
+                    "ua_family": ua_family(user_agent),
+                    "country": country_from_ip(ip),
+                })
+                for granularity in GRANULARITIES:
+                    rollups[(short_code, granularity, bucket_start(when, granularity))] += 1
+            try:
+                with self.bind.begin() as conn:
+                    conn.execute(insert(ClickEvent.__table__), events)
+                    conn.execute(self._upsert, [
+                        {"short_code": code, "granularity": granularity, "bucket_start": start, "clicks": clicks}
+                        for (code, granularity, start), clicks in rollups.items()
+                    ])
+            except Exception:
+                # Возвращаем события в начало буфера; если он успел заполниться, теряются самые новые
+                self._buffer.extendleft(reversed(batch))
+                self.errors += 1
+                raise
+            self.written += len(batch)
+            return taken
+
+    def flush_all(self) -> int:
+        total = 0
+        while True:
+            written = self.flush()
+            total += written
+            if written < self.batch_size:
+                return total
+
+    def stats(self) -> dict:
+        return {
+            "recorded": self.recorded,
+            "written": self.written,
+            "pending": self.pending(),
+            "dropped": self.dropped,
+            "discarded": self.discarded,
+            "errors": self.errors,
+        }
+
+    def ensure_started(self):
+        if self._thread is not None or self._stop.is_set():
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="click-events", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновый поток и записывает остаток событий."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush_all()
+        self._stop.clear()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush_all()
+            except Exception:
+                logger.exception("Не удалось записать события кликов")
+
+
+click_events = ClickEventPipeline(
+    engine, ANALYTICS_BUFFER_SIZE, ANALYTICS_FLUSH_INTERVAL, ANALYTICS_BATCH_SIZE, ANALYTICS_TOMBSTONE_TTL
+)
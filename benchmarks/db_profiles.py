@@ -0,0 +1,122 @@
+"""
+Сравнение профилей движка SQLite (DB_PROFILE) на запросах редиректа и создания ссылок.
+
+Читатели выполняют запрос редиректа (original_url, expires_at по short_code),
+писатели — вставку ссылки с commit, как POST /links/shorten. Обе группы работают
+одновременно, поэтому видно, как писатели блокируют читателей.
+
+    python -m benchmarks.db_profiles --links 20000 --seconds 5 --readers 4 --writers 2
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def run_profile(profile: str, workdir: str, links: int, seconds: float, readers: int, writers: int) -> dict:
+    from sqlalchemy import select, insert
+    from sqlstuff import Base, Link, create_app_engine
+
+    engine = create_app_engine(f"sqlite:///{workdir}/bench_{profile}.sqlite", profile)
+    Base.metadata.create_all(bind=engine)
+    table = Link.__table__
+    codes = [f"b{i:07d}" for i in range(links)]
+    with engine.begin() as conn:
+        for start in range(0, links, 5000):
+            conn.execute(insert(table), [
+                {"short_code": code, "original_url": f"https://example.com/{code}", "clicks": 0}
+                for code in codes[start:start + 5000]
+            ])
+
+    deadline = time.perf_counter() + seconds
+    redirect_latencies, create_latencies = [], []
+    errors = []
+    counter = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    def reader():
+        local = []
+        with engine.connect() as conn:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    conn.execute(
+                        select(table.c.original_url, table.c.expires_at)
+                        .where(table.c.short_code == random.choice(codes))
+                    ).first()
+                    conn.rollback()
+                except Exception as e:
+                    errors.append(type(e).__name__)
+                    continue
+                local.append(time.perf_counter() - started)
+        with lock:
+            redirect_latencies.extend(local)
+
+    def writer():
+        local = []
+        while time.perf_counter() < deadline:
+            code = f"w{profile[0]}{next(counter):08d}"
+            started = time.perf_counter()
+            try:
+                with engine.begin() as conn:
+                    conn.execute(insert(table).values(short_code=code, original_url="https://example.com/new", clicks=0))
+            except Exception as e:
+                errors.append(type(e).__name__)
+                continue
+            local.append(time.perf_counter() - started)
+        with lock:
+            create_latencies.extend(local)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    return {
+        "profile": profile,
+        "redirect_rps": round(len(redirect_latencies) / seconds, 1),
+        "redirect_p50_ms": round(percentile(redirect_latencies, 0.50) * 1000, 3),
+        "redirect_p99_ms": round(percentile(redirect_latencies, 0.99) * 1000, 3),
+        "create_rps": round(len(create_latencies) / seconds, 1),
+        "create_p50_ms": round(percentile(create_latencies, 0.50) * 1000, 3),
+        "create_p99_ms": round(percentile(create_latencies, 0.99) * 1000, 3),
+        "create_mean_ms": round(statistics.fmean(create_latencies) * 1000, 3) if create_latencies else 0.0,
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", default="default,production")
+    parser.add_argument("--links", type=int, default=20000)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # sqlstuff при импорте открывает ./links_db.sqlite — уводим его во временный каталог
+        os.chdir(workdir)
+        results = [
+            run_profile(profile, workdir, args.links, args.seconds, args.readers, args.writers)
+            for profile in args.profiles.split(",")
+        ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
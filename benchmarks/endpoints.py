@@ -0,0 +1,300 @@
+"""
+Нагрузочный бенчмарк эндпоинтов: редирект, создание ссылки, статистика и личный кабинет.
+
+Заполняет временную БД N ссылками и по очереди гоняет каждый сценарий с заданной
+конкурентностью против приложения в этом же процессе (asgi — без сети, клиент и
+сервер делят event loop) и/или настоящего сервера uvicorn. Результат — JSON
+с p50/p95/p99 и req/s. С --baseline результат сравнивается с прошлым прогоном,
+и при заметном ухудшении программа завершается с кодом 1.
+
+    python -m benchmarks.endpoints --links 100000 --concurrency 32 --seconds 10 --output bench.json
+    python -m benchmarks.endpoints --targets asgi,uvicorn --workers 4 --baseline bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.db_profiles import percentile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_USER = "bench"
+SEED_CHUNK = 50_000
+
+
+def seed_database(links: int, user_links: int):
+    """Заполняет БД ссылками с кодами id_to_code(1..links); первые user_links принадлежат BENCH_USER."""
+    from datetime import datetime, timedelta
+    from sqlalchemy import insert
+    from sqlstuff import engine, Link, User, CodeSequence
+    from handlers.auth import get_password_hash
+    from uuid_stuff import id_to_code
+
+    with engine.begin() as conn:
+        user_id = conn.execute(
+            insert(User.__table__).values(username=BENCH_USER, hashed_password=get_password_hash(BENCH_USER))
+        ).inserted_primary_key[0]
+        started = datetime.utcnow() - timedelta(seconds=links)
+        for start in range(1, links + 1, SEED_CHUNK):
+            conn.execute(insert(Link.__table__), [
+                {
+                    "short_code": id_to_code(number),
+                    "original_url": f"https://example.com/{number}",
+                    "created_at": started + timedelta(seconds=number),
+                    "clicks": 0,
+                    "user_id": user_id if number <= user_links else None,
+                }
+                for number in range(start, min(start + SEED_CHUNK, links + 1))
+            ])
+        # Новые ссылки получают коды после засеянных, иначе каждое создание упрётся в коллизию
+        conn.execute(insert(CodeSequence.__table__).values(name="links", next_value=links + 1))
+
+
+def random_code(rnd: random.Random, links: int) -> str:
+    from uuid_stuff import id_to_code
+    return id_to_code(rnd.randint(1, links))
+
+
+async def redirect_request(client, rnd, links):
+    return await client.get(f"/links/{random_code(rnd, links)}")
+
+async def create_request(client, rnd, links):
+    return await client.post("/links/shorten", json={"original_url": f"https://example.com/new/{rnd.random()}"})
+
+async def stats_request(client, rnd, links):
+    return await client.get(f"/links/{random_code(rnd, links)}/stats")
+
+async def dashboard_request(client, rnd, links):
+    return await client.get("/dashboard")
+
+
+SCENARIOS = {
+    "redirect": redirect_request,
+    "create": create_request,
+    "stats": stats_request,
+    "dashboard": dashboard_request,
+}
+
+
+async def run_scenario(client, name: str, links: int, concurrency: int, seconds: float, warmup: float, seed: int) -> dict:
+    request = SCENARIOS[name]
+    latencies = []
+    errors = 0
+
+    async def worker(index: int, deadline: float, record: bool):
+        nonlocal errors
+        # У каждого воркера свой генератор: одинаковый seed даёт одинаковую последовательность ключей
+        rnd = random.Random(f"{seed}:{name}:{index}:{record}")
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = await request(client, rnd, links)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            if not record:
+                continue
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    if warmup > 0:
+        deadline = time.perf_counter() + warmup
+        await asyncio.gather(*(worker(i, deadline, False) for i in range(concurrency)))
+    started = time.perf_counter()
+    deadline = started + seconds
+    await asyncio.gather(*(worker(i, deadline, True) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+        "max_ms": round(max(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+
+async def run_scenarios(client, args) -> list[dict]:
+    results = []
+    for name in args.scenarios.split(","):
+        results.append(await run_scenario(client, name, args.links, args.concurrency, args.seconds, args.warmup, args.seed))
+    return results
+
+
+async def bench_asgi(args) -> list[dict]:
+    import httpx
+    from main import app
+
+    # ASGITransport не запускает lifespan сам: без него не будет фоновой записи кликов
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies={"token": BENCH_USER}) as client:
+            return await run_scenarios(client, args)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(client, process, timeout: float = 30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"uvicorn завершился с кодом {process.returncode}")
+        try:
+            await client.get("/login_page")
+            return
+        except Exception:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("uvicorn не запустился вовремя")
+
+
+async def bench_uvicorn(args) -> list[dict]:
+    import httpx
+
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--app-dir", REPO_ROOT, "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(args.workers), "--log-level", "warning", "--no-access-log",
+        ],
+        env=os.environ.copy(),
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", cookies={"token": BENCH_USER}, limits=limits, timeout=30.0
+        ) as client:
+            await wait_for_server(client, process)
+            return await run_scenarios(client, args)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+TARGETS = {
+    "asgi": bench_asgi,
+    "uvicorn": bench_uvicorn,
+}
+
+# Метрики, где рост — это ухудшение, и где ухудшение — падение
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms")
+HIGHER_IS_BETTER = ("rps",)
+
+
+def compare(results: list[dict], baseline: dict, threshold: float) -> list[dict]:
+    """Сравнивает с прошлым прогоном. Регрессия — p95/p99 или req/s хуже больше чем на threshold."""
+    previous = {(r["target"], r["scenario"]): r for r in baseline.get("results", [])}
+    comparison = []
+    for result in results:
+        old = previous.get((result["target"], result["scenario"]))
+        if old is None:
+            continue
+        changes = {}
+        regressions = []
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if not old.get(metric):
+                continue
+            change = result[metric] / old[metric] - 1
+            changes[metric] = round(change, 3)
+            worse = change > threshold if metric in LOWER_IS_BETTER else change < -threshold
+            if worse and metric != "p50_ms":
+                regressions.append(metric)
+        comparison.append({
+            "target": result["target"],
+            "scenario": result["scenario"],
+            "changes": changes,
+            "regressions": regressions,
+        })
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--links", type=int, default=10_000, help="Сколько ссылок засеять (1k–10M)")
+    parser.add_argument("--user-links", type=int, default=1000, help="Сколько из них принадлежат пользователю для /dashboard")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--targets", default="asgi", help="asgi, uvicorn или оба через запятую")
+    parser.add_argument("--workers", type=int, default=1, help="Число воркеров uvicorn")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5.0, help="Длительность замера каждого сценария")
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Сохранить результат в файл (пригодится как --baseline)")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Допустимое ухудшение, доля")
+    args = parser.parse_args()
+    # Пути относительно текущего каталога: ниже мы перейдём во временный
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Настройки БД читаются при импорте приложения, поэтому задаём их до импорта
+        os.chdir(workdir)
+        os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/bench.sqlite"
+        os.environ.pop("DATABASE_REPLICA_URL", None)
+        # Вся нагрузка идёт с одного адреса: лимиты частоты запросов превратили бы её в 429
+        os.environ["RATE_LIMIT_ENABLED"] = "0"
+        sys.path.insert(0, REPO_ROOT)
+        seed_started = time.perf_counter()
+        seed_database(args.links, min(args.user_links, args.links))
+        seed_seconds = time.perf_counter() - seed_started
+
+        results = []
+        for target in args.targets.split(","):
+            for result in asyncio.run(TARGETS[target](args)):
+                results.append({"target": target, **result})
+
+    report = {
+        "meta": {
+            "links": args.links,
+            "user_links": args.user_links,
+            "concurrency": args.concurrency,
+            "seconds": args.seconds,
+            "workers": args.workers,
+            "seed": args.seed,
+            "seed_seconds": round(seed_seconds, 1),
+            "db_mode": os.getenv("DB_MODE", "sync"),
+            "db_profile": os.getenv("DB_PROFILE", "default"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    exit_code = 0
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if {k: v for k, v in baseline.get("meta", {}).items() if k != "seed_seconds"} != \
+                {k: v for k, v in report["meta"].items() if k != "seed_seconds"}:
+            print("Внимание: параметры прогона отличаются от baseline, сравнение может быть некорректным", file=sys.stderr)
+        report["comparison"] = compare(results, baseline, args.threshold)
+        if any(item["regressions"] for item in report["comparison"]):
+            exit_code = 1
+
+    print(json.dumps(report, indent=2))
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Фильтр Блума по всем short_code.
+
+Если фильтр говорит «кода нет», его точно нет: редирект и статистика отвечают 404,
+а проверка alias при массовом создании — «свободен», без запроса к БД. «Код, может
+быть, есть» (ложноположительно с вероятностью error_rate) — обычный путь через БД.
+
+Фильтр строится в фоне при старте потоковым чтением таблицы links; пока он не
+готов, все коды считаются возможными. Ссылка, созданная в этом воркере, добавляется
+в фильтр сразу после commit. О кодах других воркеров фильтр узнаёт по инвалидации
+общего кэша (CACHE_BACKEND=redis), поэтому без него фильтр по умолчанию выключен.
+Сообщение об инвалидации может потеряться, а фильтр Блума не должен отвечать «нет»
+для существующего кода, поэтому он перестраивается из БД каждые
+BLOOM_FILTER_REBUILD_INTERVAL секунд — это ограничивает время, на которое потерянный
+код может получить ложный 404. Удалять из фильтра Блума нельзя, поэтому удалённые
+коды остаются ложноположительными до перестройки. Когда доля ложноположительных
+ответов вырастает вдвое против заданной, фильтр перестраивается раньше срока.
+Перестройка идёт в фоне, старый фильтр тем временем продолжает отвечать.
+"""
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+from sqlalchemy import select, func
+from cache import cache_tier
+from sqlstuff import engine, Link
+from config import (
+    BLOOM_FILTER_ENABLED, BLOOM_FILTER_ERROR_RATE, BLOOM_FILTER_MIN_CAPACITY,
+    BLOOM_FILTER_HEADROOM, BLOOM_FILTER_BUILD_BATCH, BLOOM_FILTER_REBUILD_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+LINK_CACHE_PREFIX = "link_redirect_"
+# Дайджест blake2b — до 64 байт, то есть до восьми 64-битных хэшей
+MAX_DIGEST_HASHES = 8
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Оптимальные размер и число хэшей для capacity элементов
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._unpack = struct.Struct(f"<{min(self.hashes, MAX_DIGEST_HASHES)}Q").unpack
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+        self.bits_set = 0
+        self.items_added = 0
+
+    def _positions(self, item: str) -> list[int]:
+        size = self.size
+        data = item.encode("utf-8")
+        if self.hashes <= MAX_DIGEST_HASHES:
+            # Каждой хэш-функции — свои 8 байт одного дайджеста blake2b
+            digest = hashlib.blake2b(data, digest_size=8 * self.hashes).digest()
+            return [value % size for value in self._unpack(digest)]
+        # Очень малая доля ошибок: не хватает дайджеста, используем двойное хэширование
+        first, second = struct.unpack("<QQ", hashlib.blake2b(data, digest_size=16).digest())
+        second |= 1
+        return [(first + i * second) % size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        self.update((item,))
+
+    def update(self, items):
+        # Запись под блокировкой: гонка на одном байте потеряла бы бит, а это ложное «нет»
+        bits = self._bits
+        with self._lock:
+            added = 0
+            for item in items:
+                for position in self._positions(item):
+                    index, mask = position >> 3, 1 << (position & 7)
+                    if not bits[index] & mask:
+                        bits[index] |= mask
+                        added += 1
+                self.items_added += 1
+            self.bits_set += added
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def false_positive_rate(self) -> float:
+        """Текущая вероятность ложноположительного ответа по доле установленных битов."""
+        return (self.bits_set / self.size) ** self.hashes
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self._bits)
+
+
+class ShortCodeFilter:
+    def __init__(self, bind, error_rate: float, min_capacity: int, headroom: float, batch_size: int,
+                 rebuild_interval: float):
+        self.bind = bind
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.headroom = headroom
+        self.batch_size = batch_size
+        self.rebuild_interval = rebuild_interval
+        self._filter = None  # None — ещё не построен, все коды возможны
+        self._building = None  # строящийся фильтр: новые коды пишутся и в него
+        self._lock = threading.Lock()
+        self._thread = None
+        self._rebuild = threading.Event()
+        self._stop = threading.Event()
+        self._listening = False
+        self.builds = 0
+        self.last_build_seconds = 0.0
+        self.last_build_rows = 0
+        self.definite_misses = 0
+        self.errors = 0
+
+    @property
+    def ready(self) -> bool:
+        return self._filter is not None
+
+    def might_contain(self, short_code: str) -> bool:
+        current = self._filter
+        if current is None or short_code in current:
+            return True
+        self.definite_misses += 1
+        return False
+
+    def add(self, short_code: str):
+        self.update((short_code,))
+
+    def update(self, short_codes):
+        """Добавляет новые коды в текущий и в строящийся фильтр."""
+        short_codes = list(short_codes)
+        # Оба фильтра читаются вместе: иначе код мог бы не попасть в только что построенный
+        with self._lock:
+            current, building = self._filter, self._building
+        if building is not None:
+            building.update(short_codes)
+        if current is not None:
+            current.update(short_codes)
+            if current.false_positive_rate() > 2 * self.error_rate:
+                self.ensure_started()
+
+    def _on_invalidate(self, key: str):
+        if key.startswith(LINK_CACHE_PREFIX):
+            self.add(key[len(LINK_CACHE_PREFIX):])
+
+    def build(self) -> BloomFilter:
+        """Строит фильтр заново потоковым чтением links и подменяет им текущий."""
+        started = time.perf_counter()
+        table = Link.__table__
+        with self.bind.connect() as conn:
+            total = conn.execute(select(func.count()).select_from(table)).scalar_one()
+        new_filter = BloomFilter(max(self.min_capacity, math.ceil(total * self.headroom)), self.error_rate)
+        with self._lock:
+            self._building = new_filter
+        try:
+            rows = 0
+            with self.bind.connect() as conn:
+                result = conn.execution_options(yield_per=self.batch_size).execute(select(table.c.short_code))
+                for codes in result.scalars().partitions():
+                    new_filter.update(codes)
+                    rows += len(codes)
+            with self._lock:
+                self._filter = new_filter
+        finally:
+            with self._lock:
+                self._building = None
+        self.builds += 1
+        self.last_build_rows = rows
+        self.last_build_seconds = time.perf_counter() - started
+        return new_filter
+
+    def ensure_started(self):
+        """
+        Подписывается на новые коды и запускает фоновое построение. Если поток уже
+        работает, просит перестроить фильтр, не дожидаясь срока.
+        """
+        if not BLOOM_FILTER_ENABLED:
+            return
+        with self._lock:
+            if not self._listening:
+                cache_tier.add_invalidation_listener(self._on_invalidate)
+                self._listening = True
+            if self._thread is not None and self._thread.is_alive():
+                self._rebuild.set()
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="short-code-bloom", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._rebuild.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._rebuild.clear()
+            try:
+                self.build()
+            except Exception:
+                self.errors += 1
+                logger.exception("Не удалось построить фильтр коротких кодов")
+            # Перестройка по расписанию возвращает в фильтр коды, о которых воркер не узнал
+            self._rebuild.wait(self.rebuild_interval if self.rebuild_interval > 0 else None)
+
+    def reset(self):
+        """Выключает фильтр: пока он не построен снова, все коды считаются возможными."""
+        self.stop()
+        with self._lock:
+            self._filter = None
+
+    def stats(self) -> dict:
+        current = self._filter
+        return {
+            "ready": current is not None,
+            "building": self._building is not None,
+            "capacity": current.capacity if current else 0,
+            "items_added": current.items_added if current else 0,
+            "hashes": current.hashes if current else 0,
+            "memory_bytes": current.memory_bytes if current else 0,
+            "target_error_rate": self.error_rate,
+            "estimated_error_rate": current.false_positive_rate() if current else None,
+            "definite_misses": self.definite_misses,
+            "builds": self.builds,
+            "last_build_rows": self.last_build_rows,
+            "last_build_seconds": round(self.last_build_seconds, 3),
+            "errors": self.errors,
+        }
+
+
+short_code_filter = ShortCodeFilter(
+    engine, BLOOM_FILTER_ERROR_RATE, BLOOM_FILTER_MIN_CAPACITY, BLOOM_FILTER_HEADROOM, BLOOM_FILTER_BUILD_BATCH,
+    BLOOM_FILTER_REBUILD_INTERVAL,
+)
@@ -1,26 +1,597 @@
+import asyncio
+import logging
+import pickle
+import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_SWEEP_INTERVAL,
+    CACHE_BACKEND, REDIS_URL, CACHE_L1_TTL, CACHE_INVALIDATION_CHANNEL, REPLICA_MAX_LAG_SECONDS,
+    CACHE_L2_THREADS, CACHE_L2_FAILURE_THRESHOLD, CACHE_L2_COOLDOWN,
+)
 
-# Простой in-memory кэш на базе словаря
-cache_store = {}
+logger = logging.getLogger(__name__)
+
+
+def estimate_size(key: str, value) -> int:
+    """Приблизительный размер записи в байтах."""
+    try:
+        value_size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        value_size = sys.getsizeof(value)
+    return sys.getsizeof(key) + value_size
+
+
+class LRUCache:
+    """In-memory кэш с TTL, ограничением по числу записей и объёму и вытеснением LRU."""
+
+    def __init__(self, max_entries: int, max_bytes: int, sweep_interval: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._data = OrderedDict()  # key -> (value, expire_at, size)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._sweeper = None
+        self._stop_sweeper = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def set(self, key: str, value, ttl: int):
+        size = estimate_size(key, value)
+        expire_at = time.time() + ttl
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if size > self.max_bytes:
+                # Запись больше всего бюджета: не храним её и не вытесняем остальные
+                return
+            self._data[key] = (value, expire_at, size)
+            self._bytes += size
+            self._evict()
+        self.ensure_sweeper()
+
+    def set_if_absent(self, key: str, value, ttl: float) -> bool:
+        """
+        Кладёт запись, только если ключа ещё нет. Проверка и запись — под одной блокировкой:
+        свежая запись, положенная запросом параллельно, не перезаписывается старой.
+        """
+        size = estimate_size(key, value)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._data:
+                return False
+            self._data[key] = (value, time.time() + ttl, size)
+            self._bytes += size
+            self._evict()
+        self.ensure_sweeper()
+        return True
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expire_at, size = entry
+            if time.time() >= expire_at:
+                # Если срок хранения истёк — удаляем запись
+                del self._data[key]
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def delete(self, key: str):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def hottest(self, limit: int, keep=None) -> list[tuple]:
+        """
+        До limit непросроченных записей (key, value, expire_at), от самых свежих
+        по использованию. keep(key, value) отбирает, какие записи брать.
+        """
+        now = time.time()
+        entries = []
+        with self._lock:
+            for key in reversed(self._data):
+                value, expire_at, _ = self._data[key]
+                if expire_at > now and (keep is None or keep(key, value)):
+                    entries.append((key, value, expire_at))
+                    if len(entries) >= limit:
+                        break
+        return entries
+
+    def restore(self, entries) -> int:
+        """
+        Загружает записи из hottest(), сохраняя их срок годности. Идут от холодных
+        к горячим, чтобы порядок LRU остался прежним; уже имеющиеся ключи не трогаются.
+        """
+        now = time.time()
+        restored = 0
+        for key, value, expire_at in reversed(entries):
+            if expire_at > now and self.set_if_absent(key, value, expire_at - now):
+                restored += 1
+        return restored
+
+    def sweep(self, batch_size: int = 1000) -> int:
+        """Удаляет просроченные записи порциями, не держа блокировку надолго."""
+        with self._lock:
+            keys = list(self._data.keys())
+        removed = 0
+        for start in range(0, len(keys), batch_size):
+            now = time.time()
+            with self._lock:
+                for key in keys[start:start + batch_size]:
+                    entry = self._data.get(key)
+                    if entry is not None and now >= entry[1]:
+                        del self._data[key]
+                        self._bytes -= entry[2]
+                        self.expirations += 1
+                        removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def ensure_sweeper(self):
+        if self._sweeper is not None or self.sweep_interval <= 0:
+            return
+        with self._lock:
+            if self._sweeper is None:
+                self._stop_sweeper.clear()
+                self._sweeper = threading.Thread(target=self._run_sweeper, name="cache-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop_sweeper.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _evict(self):
+        # Вызывается под блокировкой: вытесняем самые давно использованные записи
+        while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, _, size) = self._data.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def _run_sweeper(self):
+        while not self._stop_sweeper.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Ошибка при очистке кэша")
+
+
+class InMemorySharedBackend:
+    """
+    Общее хранилище с рассылкой сообщений, как у Redis, но внутри одного процесса.
+    Позволяет в тестах моделировать несколько воркеров без сервера Redis.
+    """
+
+    def __init__(self):
+        self._data = {}  # key -> (payload, expire_at)
+        self._subscribers = []  # (channel, callback)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if time.time() >= entry[1]:
+                del self._data[key]
+                return None
+            return entry[0]
+
+    def set(self, key: str, payload: bytes, ttl: int):
+        with self._lock:
+            self._data[key] = (payload, time.time() + ttl)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def publish(self, channel: str, message: str):
+        with self._lock:
+            callbacks = [callback for name, callback in self._subscribers if name == channel]
+        for callback in callbacks:
+            callback(message)
+
+    def invalidate(self, channel: str, keys: list[str]):
+        """Удаляет ключи и рассылает каждый из них в channel."""
+        for key in keys:
+            self.delete(key)
+        for key in keys:
+            self.publish(channel, key)
+
+    def subscribe(self, channel: str, callback):
+        with self._lock:
+            self._subscribers.append((channel, callback))
+
+    def close(self):
+        with self._lock:
+            self._subscribers.clear()
+
+
+class RedisSharedBackend:
+    """Общий кэш в Redis; инвалидации рассылаются через PUBLISH/SUBSCRIBE."""
+
+    PIPELINE_CHUNK = 1000
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("Для CACHE_BACKEND=redis нужен пакет redis (pip install redis)") from e
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._pubsub_thread = None
+
+    def get(self, key: str):
+        return self._client.get(key)
+
+    def set(self, key: str, payload: bytes, ttl: int):
+        self._client.set(key, payload, ex=max(1, int(ttl)))
+
+    def delete(self, key: str):
+        self._client.delete(key)
+
+    def publish(self, channel: str, message: str):
+        self._client.publish(channel, message)
+
+    def invalidate(self, channel: str, keys: list[str]):
+        # DEL и PUBLISH порциями в одном конвейере: одна сетевая задержка на порцию, а не на ключ
+        for start in range(0, len(keys), self.PIPELINE_CHUNK):
+            chunk = keys[start:start + self.PIPELINE_CHUNK]
+            pipe = self._client.pipeline(transaction=False)
+            pipe.delete(*chunk)
+            for key in chunk:
+                pipe.publish(channel, key)
+            pipe.execute()
+
+    def subscribe(self, channel: str, callback):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: lambda message: callback(message["data"].decode())})
+        # get_message ждёт сообщение не дольше sleep_time и возвращается сразу, как только оно пришло
+        self._pubsub_thread = pubsub.run_in_thread(sleep_time=0.5, daemon=True)
+
+    def close(self):
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+            self._pubsub_thread = None
+        self._client.close()
+
+
+class CircuitBreaker:
+    """
+    После threshold ошибок подряд cooldown секунд не пускает запросы к L2. По истечении
+    паузы пропускает пробный запрос: если и он упал, пауза начинается снова.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._tripped = False
+        self._lock = threading.Lock()
+        self.trips = 0
+
+    @property
+    def open(self) -> bool:
+        return time.monotonic() < self._open_until
+
+    def allow(self) -> bool:
+        return not self.open
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._tripped = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._tripped or self._failures >= self.threshold:
+                self._open_until = time.monotonic() + self.cooldown
+                self._failures = 0
+                self._tripped = True
+                self.trips += 1
+
+
+class TieredCache:
+    """
+    Двухуровневый кэш: L1 — LRUCache в памяти процесса, L2 — общий для всех воркеров бэкенд.
+    Удаление сбрасывает ключ в L2 и рассылает его остальным воркерам, а они убирают
+    свою копию из L1. Копии в L1 живут не дольше l1_ttl, поэтому даже потерянное
+    сообщение об инвалидации оставляет устаревшее значение ненадолго.
+
+    Сетевые обращения к L2 выполняются в отдельных потоках и не блокируют event loop:
+    запись и удаление уходят в фон сразу, чтение из асинхронного кода — через get_async.
+    Ключ всегда обслуживает один и тот же поток, поэтому операции над ключом
+    выполняются в порядке вызова (удаление не обгонит предшествующую запись).
+    Ошибки L2 не ломают запросы: кэш работает как локальный, а после нескольких
+    ошибок подряд L2 на время отключается (CircuitBreaker).
+    """
+
+    def __init__(self, local: LRUCache, shared=None, l1_ttl: int = 5, channel: str = "cache-invalidate",
+                 threads: int = 4, failure_threshold: int = 5, cooldown: float = 10.0):
+        self.local = local
+        self.shared = shared
+        self.l1_ttl = l1_ttl
+        self.channel = channel
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"cache-l2-{i}")
+            for i in range(max(1, threads))
+        ] if shared is not None else []
+        self._subscribed = False
+        self._lock = threading.Lock()
+        self.shared_hits = 0
+        self.shared_misses = 0
+        self.shared_errors = 0
+        self.shared_skipped = 0
+        self.invalidations_received = 0
+        self._invalidation_listeners = []
+
+    def add_invalidation_listener(self, callback):
+        """callback(key) вызывается при удалении ключа в этом процессе и по сообщению от других воркеров."""
+        self._invalidation_listeners.append(callback)
+
+    def _notify_invalidated(self, key: str):
+        for callback in self._invalidation_listeners:
+            callback(key)
+
+    def _executor(self, key: str) -> ThreadPoolExecutor:
+        return self._executors[hash(key) % len(self._executors)]
+
+    def set(self, key: str, value, ttl: int):
+        if self.shared is None:
+            self.local.set(key, value, ttl)
+            return
+        self.local.set(key, value, min(ttl, self.l1_ttl))
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._executor(key).submit(self._shared_set, key, payload, ttl)
+
+    def get(self, key: str):
+        """Чтение для синхронного кода (фоновые потоки). В обработчиках — get_async."""
+        value = self.local.get(key)
+        if value is not None or self.shared is None:
+            return value
+        return self._executor(key).submit(self._shared_get, key).result()
+
+    async def get_async(self, key: str):
+        value = self.local.get(key)
+        if value is not None or self.shared is None:
+            return value
+        return await asyncio.wrap_future(self._executor(key).submit(self._shared_get, key))
+
+    def delete(self, key: str):
+        self.delete_many((key,))
+
+    def delete_many(self, keys):
+        """Удаляет ключи во всех воркерах; в L2 — одним конвейером на поток."""
+        keys = list(keys)
+        for key in keys:
+            self.local.delete(key)
+            self._notify_invalidated(key)
+        if self.shared is None or not keys:
+            return
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._executor(key), []).append(key)
+        for executor, group in groups.items():
+            executor.submit(self._shared_invalidate, group)
+
+    def flush(self):
+        """Дожидается, пока все отправленные в L2 операции выполнятся."""
+        for future in [executor.submit(lambda: None) for executor in self._executors]:
+            future.result()
+
+    def ensure_subscribed(self):
+        if self._subscribed or self.shared is None:
+            return
+        with self._lock:
+            if self._subscribed:
+                return
+            try:
+                self.shared.subscribe(self.channel, self._on_invalidate)
+            except Exception:
+                self._shared_failed("подписка на инвалидации")
+                return
+            self._subscribed = True
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+        if self.shared is not None:
+            self.shared.close()
+        self._subscribed = False
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats.update({
+            "shared_hits": self.shared_hits,
+            "shared_misses": self.shared_misses,
+            "shared_errors": self.shared_errors,
+            "shared_skipped": self.shared_skipped,
+            "shared_circuit_open": int(self.breaker.open),
+            "shared_circuit_trips": self.breaker.trips,
+            "invalidations_received": self.invalidations_received,
+        })
+        return stats
+
+    # Методы ниже выполняются в потоках L2
+
+    def _shared_available(self) -> bool:
+        if not self.breaker.allow():
+            self.shared_skipped += 1
+            return False
+        self.ensure_subscribed()
+        return True
+
+    def _shared_set(self, key: str, payload: bytes, ttl: int):
+        if not self._shared_available():
+            return
+        try:
+            self.shared.set(key, payload, ttl)
+        except Exception:
+            self._shared_failed("запись в общий кэш")
+            return
+        self.breaker.success()
+
+    def _shared_get(self, key: str):
+        if not self._shared_available():
+            return None
+        try:
+            payload = self.shared.get(key)
+        except Exception:
+            self._shared_failed("чтение из общего кэша")
+            return None
+        self.breaker.success()
+        if payload is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        value = pickle.loads(payload)
+        self.local.set(key, value, self.l1_ttl)
+        return value
+
+    def _shared_invalidate(self, keys: list[str]):
+        # Чтение, поставленное в очередь до удаления, могло вернуть ключ в L1 — убираем ещё раз
+        for key in keys:
+            self.local.delete(key)
+        if not self._shared_available():
+            return
+        try:
+            self.shared.invalidate(self.channel, keys)
+        except Exception:
+            self._shared_failed("инвалидация в общем кэше")
+            return
+        self.breaker.success()
+
+    def _on_invalidate(self, key: str):
+        self.invalidations_received += 1
+        self.local.delete(key)
+        self._notify_invalidated(key)
+
+    def _shared_failed(self, action: str):
+        self.shared_errors += 1
+        self.breaker.failure()
+        logger.warning("Ошибка общего кэша (%s), используется только локальный", action, exc_info=True)
+
+
+class InvalidationLog:
+    """
+    Ключи, сброшенные за последние window секунд (в этом процессе или другими воркерами).
+    Такой ключ заполняется только из основной БД: реплика могла ещё не получить
+    изменение, и её старая версия строки осела бы в кэше на весь TTL.
+    """
+
+    def __init__(self, window: float, max_keys: int):
+        self.window = window
+        self.max_keys = max_keys
+        self._keys = OrderedDict()  # key -> время сброса, от старых к новым
+        self._lock = threading.Lock()
+
+    def note(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            self._keys[key] = now
+            self._keys.move_to_end(key)
+            while self._keys and (
+                len(self._keys) > self.max_keys or now - next(iter(self._keys.values())) >= self.window
+            ):
+                self._keys.popitem(last=False)
+
+    def recent(self, key: str) -> bool:
+        with self._lock:
+            invalidated_at = self._keys.get(key)
+        return invalidated_at is not None and time.monotonic() - invalidated_at < self.window
+
+
+def create_shared_backend(kind: str, url: str):
+    if kind == "local":
+        return None
+    if kind == "redis":
+        return RedisSharedBackend(url)
+    raise ValueError(f"Неизвестный CACHE_BACKEND: {kind!r} (ожидается 'local' или 'redis')")
+
+
+# Общий кэш приложения: L1 в памяти процесса и, если настроен, L2 для всех воркеров
+cache_store = LRUCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_SWEEP_INTERVAL)
+cache_tier = TieredCache(
+    cache_store, create_shared_backend(CACHE_BACKEND, REDIS_URL), CACHE_L1_TTL, CACHE_INVALIDATION_CHANNEL,
+    CACHE_L2_THREADS, CACHE_L2_FAILURE_THRESHOLD, CACHE_L2_COOLDOWN,
+)
+recent_invalidations = InvalidationLog(REPLICA_MAX_LAG_SECONDS, CACHE_MAX_ENTRIES)
+cache_tier.add_invalidation_listener(recent_invalidations.note)
 
 def set_cache(key: str, value, ttl: int):
     """Сохраняет значение в кэше с временем жизни ttl (в секундах)."""
-    expire_at = time.time() + ttl
-    cache_store[key] = (value, expire_at)
+    cache_tier.set(key, value, ttl)
 
 def get_cache(key: str):
-    """Возвращает значение из кэша, если оно не истекло."""
-    entry = cache_store.get(key)
-    if entry:
-        value, expire_at = entry
-        if time.time() < expire_at:
-            return value
-        else:
-            # Если срок хранения истёк — удаляем запись
-            del cache_store[key]
-    return None
+    """Возвращает значение из кэша, если оно не истекло. Из обработчиков — get_cache_async."""
+    return cache_tier.get(key)
+
+async def get_cache_async(key: str):
+    """Как get_cache, но при промахе L1 ждёт общий кэш, не блокируя event loop."""
+    return await cache_tier.get_async(key)
 
 def delete_cache(key: str):
-    """Удаляет значение из кэша по ключу."""
-    if key in cache_store:
-        del cache_store[key]
+    """Удаляет значение из кэша по ключу во всех воркерах."""
+    cache_tier.delete(key)
+
+def delete_cache_many(keys):
+    """Удаляет значения по ключам во всех воркерах; в общем кэше — пакетом."""
+    cache_tier.delete_many(keys)
+
+
+# ================================
+# Ключи ссылок
+# ================================
+
+# Отметка в кэше для несуществующего кода (негативное кэширование)
+LINK_NOT_FOUND = False
+
+def invalidate_link_cache(short_code: str):
+    """Сбрасывает все закэшированные данные по ссылке."""
+    invalidate_links_cache((short_code,))
+
+def invalidate_links_cache(short_codes):
+    """Сбрасывает закэшированные данные по ссылкам; в общем кэше — одним пакетом."""
+    delete_cache_many(
+        key for short_code in short_codes for key in (f"link_stats_{short_code}", f"link_redirect_{short_code}")
+    )
@@ -0,0 +1,115 @@
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import update, bindparam, func
+from sqlstuff import engine, Link
+from config import CLICK_FLUSH_INTERVAL, CLICK_FLUSH_MAX_PENDING
+
+logger = logging.getLogger(__name__)
+
+# Пакетное обновление: clicks увеличивается на накопленное значение
+_flush_stmt = (
+    update(Link.__table__)
+    .where(Link.__table__.c.short_code == bindparam("b_short_code"))
+    .values(
+        clicks=func.coalesce(Link.__table__.c.clicks, 0) + bindparam("b_clicks"),
+        last_accessed_at=bindparam("b_last_accessed_at"),
+    )
+)
+
+
+class ClickAggregator:
+    """Накапливает клики в памяти и периодически сбрасывает их в БД пачкой UPDATE."""
+
+    def __init__(self, bind, flush_interval: float, max_pending: int):
+        self.bind = bind
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}  # short_code -> [clicks, last_accessed_at]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def record(self, short_code: str, when: datetime | None = None):
+        """Учитывает один клик. Не обращается к БД."""
+        when = when or datetime.utcnow()
+        with self._lock:
+            entry = self._pending.get(short_code)
+            if entry is None:
+                self._pending[short_code] = [1, when]
+            else:
+                entry[0] += 1
+                if when > entry[1]:
+                    entry[1] = when
+            overflow = len(self._pending) >= self.max_pending
+        self.ensure_started()
+        if overflow:
+            self._wakeup.set()
+
+    def pending(self, short_code: str) -> tuple[int, datetime | None]:
+        """Возвращает ещё не сброшенные клики и время последнего из них."""
+        with self._lock:
+            entry = self._pending.get(short_code)
+            return (entry[0], entry[1]) if entry else (0, None)
+
+    def discard(self, short_code: str):
+        """Забывает накопленные клики (например, при удалении ссылки)."""
+        with self._lock:
+            self._pending.pop(short_code, None)
+
+    def flush(self) -> int:
+        """Записывает накопленные клики в БД. Возвращает число обновлённых ссылок."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            params = [
+                {"b_short_code": code, "b_clicks": clicks, "b_last_accessed_at": last}
+                for code, (clicks, last) in batch.items()
+            ]
+            try:
+                with self.bind.begin() as conn:
+                    conn.execute(_flush_stmt, params)
+            except Exception:
+                # Возвращаем клики в буфер, чтобы не потерять их до следующей попытки
+                with self._lock:
+                    for code, (clicks, last) in batch.items():
+                        entry = self._pending.setdefault(code, [0, last])
+                        entry[0] += clicks
+                        if last > entry[1]:
+                            entry[1] = last
+                raise
+            return len(params)
+
+    def ensure_started(self):
+        if self._thread is not None or self._stopping:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="click-flusher", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновый поток и сбрасывает остаток кликов."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._stopping = False
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Не удалось сбросить клики в БД")
+
+
+click_aggregator = ClickAggregator(engine, CLICK_FLUSH_INTERVAL, CLICK_FLUSH_MAX_PENDING)
@@ -0,0 +1,162 @@
+"""
+Сжатие ответов (brotli или gzip) по заголовку Accept-Encoding.
+
+Сжимаются текстовые ответы (HTML, JSON) от COMPRESSION_MIN_SIZE байт, а потоковые
+(личный кабинет) — всегда: каждый кусок сжимается и сразу уходит клиенту.
+Brotli используется, если установлен пакет brotli; иначе — только gzip.
+Сильный ETag у сжатого ответа становится слабым: байты уже не те, но
+If-None-Match сравнивается слабо, так что 304 продолжает работать.
+"""
+import zlib
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+
+def parse_accept_encoding(value: str) -> dict:
+    encodings = {}
+    for item in value.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            encodings[name.strip().lower()] = quality
+    return encodings
+
+
+def choose_encoding(accept_encoding: Optional[str], brotli_available: bool = brotli is not None) -> Optional[str]:
+    if not accept_encoding:
+        return None
+    encodings = parse_accept_encoding(accept_encoding)
+    wildcard = encodings.get("*", 0.0)
+    candidates = (("br", "gzip") if brotli_available else ("gzip",))
+    best, best_quality = None, 0.0
+    for name in candidates:
+        quality = encodings.get(name, wildcard)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+class GzipCompressor:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        # Z_SYNC_FLUSH отдаёт всё сжатое до сих пор, не дожидаясь конца потока
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class BrotliCompressor:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        output = self._compressor.process(data)
+        return output + (self._compressor.finish() if final else self._compressor.flush())
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int, gzip_level: int, brotli_quality: int):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def compressor(self, encoding: str):
+        if encoding == "br":
+            return BrotliCompressor(self.brotli_quality)
+        return GzipCompressor(self.gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = None
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = choose_encoding(accept_encoding)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+
+        async def compressing_send(message):
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+            if compressor is None:
+                body = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                if not self.should_compress(start_message, body, more_body):
+                    await send(start_message)
+                    start_message = None
+                    await send(message)
+                    return
+                compressor = self.compressor(encoding)
+                if not more_body:
+                    # Ответ целиком: сжимаем сразу, чтобы указать content-length
+                    compressed = compressor.compress(body, final=True)
+                    await send(self.compressed_start(start_message, encoding, len(compressed)))
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                await send(self.compressed_start(start_message, encoding, None))
+            more_body = message.get("more_body", False)
+            await send({
+                "type": "http.response.body",
+                "body": compressor.compress(message.get("body", b""), final=not more_body),
+                "more_body": more_body,
+            })
+
+        await self.app(scope, receive, compressing_send)
+
+    def should_compress(self, start_message, body: bytes, more_body: bool) -> bool:
+        if start_message["status"] < 200 or start_message["status"] in (204, 304):
+            return False
+        content_type = ""
+        for name, value in start_message.get("headers", []):
+            name = name.lower()
+            if name == b"content-encoding":
+                return False
+            if name == b"content-type":
+                content_type = value.decode("latin-1").lower()
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+        return more_body or len(body) >= self.minimum_size
+
+    def compressed_start(self, start_message, encoding: str, content_length: Optional[int]) -> dict:
+        headers = []
+        vary = None
+        for name, value in start_message.get("headers", []):
+            lower = name.lower()
+            if lower == b"content-length":
+                continue
+            if lower == b"etag" and not value.startswith(b"W/"):
+                value = b"W/" + value
+            if lower == b"vary":
+                vary = value
+                continue
+            headers.append((name, value))
+        headers.append((b"content-encoding", encoding.encode()))
+        headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+        if content_length is not None:
+            headers.append((b"content-length", str(content_length).encode()))
+        return {**start_message, "headers": headers}
@@ -0,0 +1,289 @@
+"""
+Выгрузка таблиц links и click_events для офлайн-аналитики.
+
+Данные читаются порциями по первичному ключу через отдельное соединение только
+для чтения (из реплики, если она настроена), поэтому память не растёт с размером
+таблицы, а выгрузка не держит блокировок, мешающих редиректам и записи кликов.
+
+    python export.py links --output links.csv.gz
+    python export.py links --watermark-column last_accessed_at --state-file export_state.json
+    python export.py click_events --format parquet --output events.parquet
+
+С --state-file выгрузка инкрементальная: берутся строки, у которых отметка
+(created_at, last_accessed_at или occurred_at) новее сохранённой в прошлый раз.
+"""
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from typing import Iterator, NamedTuple, Optional
+from sqlalchemy import create_engine, event, select, Table, Integer, BigInteger, DateTime
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+from analytics import to_naive_utc
+from sqlstuff import Link, ClickEvent
+from config import (
+    DATABASE_URL, DATABASE_REPLICA_URL, SQLITE_BUSY_TIMEOUT_MS,
+    EXPORT_CHUNK_SIZE, EXPORT_WATERMARK_LAG_SECONDS,
+)
+
+
+class ExportDataset(NamedTuple):
+    table: Table
+    key: str
+    # Колонки, по которым возможна инкрементальная выгрузка; первая — по умолчанию
+    watermarks: tuple[str, ...]
+
+
+DATASETS = {
+    "links": ExportDataset(Link.__table__, "short_code", ("created_at", "last_accessed_at")),
+    "click_events": ExportDataset(ClickEvent.__table__, "id", ("occurred_at",)),
+}
+
+
+def snapshot_engine(url: Optional[str] = None):
+    """
+    Движок для выгрузки: без пула и только для чтения. SQLite открывается с
+    PRAGMA query_only, PostgreSQL — в транзакции REPEATABLE READ READ ONLY,
+    так что вся выгрузка видит один снимок данных.
+    """
+    url = make_url(url or DATABASE_REPLICA_URL or DATABASE_URL)
+    if url.get_backend_name() == "sqlite":
+        new_engine = create_engine(url, poolclass=NullPool, connect_args={"check_same_thread": False})
+
+        @event.listens_for(new_engine, "connect")
+        def read_only(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA query_only = ON")
+            cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.close()
+        return new_engine
+    options = {"postgresql_readonly": True} if url.get_backend_name() == "postgresql" else {}
+    return create_engine(url, poolclass=NullPool, isolation_level="REPEATABLE READ", execution_options=options)
+
+
+class ExportBuffer:
+    """Файлоподобный приёмник: копит записанные байты, пока их не заберёт drain()."""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def writable(self) -> bool:
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class CsvGzipWriter:
+    extension = "csv.gz"
+    media_type = "application/gzip"
+
+    def __init__(self, sink, table: Table):
+        self._text = io.TextIOWrapper(gzip.GzipFile(fileobj=sink, mode="wb"), encoding="utf-8", newline="")
+        self._csv = csv.writer(self._text)
+        self._csv.writerow([column.name for column in table.columns])
+
+    @classmethod
+    def ensure_available(cls):
+        pass
+
+    def write_rows(self, rows):
+        self._csv.writerows(rows)
+        self._text.flush()
+
+    def close(self):
+        # Закрывает gzip и дописывает его трейлер; сам sink остаётся открытым
+        self._text.close()
+
+
+class ParquetWriter:
+    """Parquet со сжатием zstd; каждая порция строк — отдельная row group."""
+
+    extension = "parquet"
+    media_type = "application/vnd.apache.parquet"
+
+    def __init__(self, sink, table: Table):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self._schema = pa.schema([(column.name, self._arrow_type(column.type)) for column in table.columns])
+        self._writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), self._schema, compression="zstd")
+
+    @classmethod
+    def ensure_available(cls):
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError as e:
+            raise RuntimeError("Для формата parquet нужен пакет pyarrow (pip install pyarrow)") from e
+
+    def _arrow_type(self, column_type):
+        if isinstance(column_type, (Integer, BigInteger)):
+            return self._pa.int64()
+        if isinstance(column_type, DateTime):
+            return self._pa.timestamp("us")
+        return self._pa.string()
+
+    def write_rows(self, rows):
+        columns = list(zip(*rows))
+        self._writer.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(values, type=field.type) for values, field in zip(columns, self._schema)],
+            schema=self._schema,
+        ))
+
+    def close(self):
+        self._writer.close()
+
+
+FORMATS = {
+    "csv.gz": CsvGzipWriter,
+    "parquet": ParquetWriter,
+}
+
+
+class Export:
+    """
+    Одна выгрузка таблицы. Параметры проверяются сразу (ValueError или RuntimeError),
+    а данные читаются только при обходе chunks().
+    """
+
+    def __init__(self, dataset: str, fmt: str = "csv.gz", since: Optional[datetime] = None,
+                 watermark_column: Optional[str] = None, chunk_size: int = EXPORT_CHUNK_SIZE,
+                 lag_seconds: int = EXPORT_WATERMARK_LAG_SECONDS, bind=None):
+        if dataset not in DATASETS:
+            raise ValueError(f"Неизвестная таблица: {dataset!r}. Доступны: {', '.join(DATASETS)}")
+        if fmt not in FORMATS:
+            raise ValueError(f"Неизвестный формат: {fmt!r}. Доступны: {', '.join(FORMATS)}")
+        self.dataset = DATASETS[dataset]
+        self.name = dataset
+        self.watermark_column = watermark_column or self.dataset.watermarks[0]
+        if self.watermark_column not in self.dataset.watermarks:
+            raise ValueError(
+                f"Для {dataset} отметка может быть только {', '.join(self.dataset.watermarks)}"
+            )
+        self.writer_cls = FORMATS[fmt]
+        self.writer_cls.ensure_available()
+        self.since = to_naive_utc(since) if since else None
+        # Верхняя граница фиксируется заранее и становится отметкой для следующей выгрузки
+        self.until = datetime.utcnow() - timedelta(seconds=lag_seconds)
+        self.chunk_size = chunk_size
+        self.bind = bind
+        self.rows_exported = 0
+
+    @property
+    def filename(self) -> str:
+        return f"{self.name}_{self.until:%Y%m%dT%H%M%S}.{self.writer_cls.extension}"
+
+    @property
+    def media_type(self) -> str:
+        return self.writer_cls.media_type
+
+    def chunk_query(self, after):
+        table = self.dataset.table
+        key = table.c[self.dataset.key]
+        watermark = table.c[self.watermark_column]
+        # Порции идут по первичному ключу: каждый запрос — короткий проход по индексу
+        stmt = select(table).where(watermark <= self.until)
+        if self.since is not None:
+            stmt = stmt.where(watermark > self.since)
+        if after is not None:
+            stmt = stmt.where(key > after)
+        return stmt.order_by(key).limit(self.chunk_size)
+
+    def chunks(self) -> Iterator[bytes]:
+        sink = ExportBuffer()
+        writer = self.writer_cls(sink, self.dataset.table)
+        key_index = list(self.dataset.table.columns.keys()).index(self.dataset.key)
+        bind = self.bind or snapshot_engine()
+        with bind.connect() as conn:
+            after = None
+            while True:
+                rows = conn.execute(self.chunk_query(after)).all()
+                if rows:
+                    writer.write_rows(rows)
+                    self.rows_exported += len(rows)
+                    after = rows[-1][key_index]
+                data = sink.drain()
+                if data:
+                    yield data
+                if len(rows) < self.chunk_size:
+                    break
+        writer.close()
+        yield sink.drain()
+
+    def write_to(self, fileobj) -> int:
+        for data in self.chunks():
+            fileobj.write(data)
+        return self.rows_exported
+
+
+def load_state(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="export.py", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dataset", choices=sorted(DATASETS))
+    parser.add_argument("--format", default="csv.gz", choices=sorted(FORMATS))
+    parser.add_argument("--output", help="Файл для выгрузки (по умолчанию — имя с отметкой времени)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Выгрузить строки с отметкой новее этой (ISO 8601)")
+    parser.add_argument("--watermark-column", help="Колонка-отметка для --since")
+    parser.add_argument("--state-file", help="JSON-файл, где хранится отметка прошлой выгрузки")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv[1:])
+
+    state = load_state(args.state_file) if args.state_file else {}
+    watermark_column = args.watermark_column or DATASETS[args.dataset].watermarks[0]
+    state_key = f"{args.dataset}:{watermark_column}"
+    since = args.since or (datetime.fromisoformat(state[state_key]) if state_key in state else None)
+    try:
+        job = Export(args.dataset, args.format, since, watermark_column, chunk_size=args.chunk_size)
+    except (ValueError, RuntimeError) as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    output = args.output or job.filename
+    with open(output, "wb") as f:
+        rows = job.write_to(f)
+    if args.state_file:
+        state[state_key] = job.until.isoformat()
+        save_state(args.state_file, state)
+    print(f"Выгружено строк: {rows} -> {output} (отметка {job.until.isoformat()})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
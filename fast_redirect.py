@@ -0,0 +1,115 @@
+"""
+Быстрый путь для GET /links/{short_code}.
+
+Редирект — самый частый запрос, и большую часть его времени занимают не БД и не
+кэш, а обвязка: перебор маршрутов, разбор зависимостей FastAPI, объект Request,
+ORM-сессия. Middleware отвечает на такие запросы сам: код берётся из пути,
+ссылка — через тот же resolve_link (кэш, затем Core-запрос без ORM-сессии),
+клик — в те же буферы. Ответы (302, 404, 410, 429) совпадают с ответами обработчика
+redirect_link, а остальные запросы уходят в приложение как обычно.
+"""
+import json
+from datetime import datetime
+from functools import lru_cache
+from urllib.parse import quote
+from fastapi import HTTPException
+from starlette.requests import HTTPConnection
+from analytics import click_events
+from clicks import click_aggregator
+from handlers.links import resolve_link
+from ratelimit import RATE_LIMITS, RATE_LIMITED_DETAIL, retry_after, retry_after_header
+from sqlstuff import CoreReader, read_client_key
+from config import FAST_REDIRECT
+
+PREFIX = "/links/"
+
+
+class RoutePath:
+    """Подставляется в scope["route"], чтобы метрики и профайлер видели шаблон маршрута."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+
+REDIRECT_ROUTE = RoutePath("/links/{short_code}")
+
+
+@lru_cache(maxsize=4096)
+def location_header(url: str) -> bytes:
+    # То же экранирование, что в RedirectResponse
+    return quote(url, safe=":/%#?=@[]!$&'()*+,;").encode("latin-1")
+
+
+def error_body(detail: str) -> bytes:
+    return json.dumps({"detail": detail}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def header(scope, name: bytes):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+class FastRedirectMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def short_code(self, scope):
+        if not FAST_REDIRECT or scope["type"] != "http" or scope["method"] != "GET":
+            return None
+        path = scope["path"]
+        if not path.startswith(PREFIX):
+            return None
+        code = path[len(PREFIX):]
+        if not code or "/" in code:
+            return None
+        return code
+
+    async def __call__(self, scope, receive, send):
+        short_code = self.short_code(scope)
+        if short_code is None:
+            await self.app(scope, receive, send)
+            return
+        scope["route"] = REDIRECT_ROUTE
+        conn = HTTPConnection(scope)
+        if RATE_LIMITS["redirect"] is not None:
+            wait = await retry_after("redirect", conn)
+            if wait > 0:
+                await self.send_error(send, 429, RATE_LIMITED_DETAIL, [(b"retry-after", retry_after_header(wait).encode())])
+                return
+        try:
+            original_url, expires_at = await resolve_link(short_code, CoreReader(client=read_client_key(conn)))
+        except HTTPException as e:
+            await self.send_error(send, e.status_code, e.detail)
+            return
+        if expires_at and datetime.utcnow() > expires_at:
+            await self.send_error(send, 410, "Ссылка уже слишком старая.")
+            return
+        click_aggregator.record(short_code)
+        client = scope.get("client")
+        click_events.record(
+            short_code,
+            header(scope, b"referer"),
+            header(scope, b"user-agent"),
+            client[0] if client else None,
+        )
+        await send({
+            "type": "http.response.start",
+            "status": 302,
+            "headers": [(b"content-length", b"0"), (b"location", location_header(original_url))],
+        })
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send_error(self, send, status_code: int, detail: str, headers: list = ()):
+        body = error_body(detail)
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-length", str(len(body)).encode()),
+                (b"content-type", b"application/json"),
+                *headers,
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,97 @@
+import secrets
+from datetime import datetime
+from fastapi import APIRouter, HTTPException, Depends, Header
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from typing import Optional
+from config import ADMIN_TOKEN
+from reaper import link_reaper
+from cache import cache_tier
+from analytics import click_events
+from bloom import short_code_filter
+from export import Export
+from profiler import request_profiler
+
+router = APIRouter(prefix="/admin")
+
+def is_admin_token(value: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and bool(value) and secrets.compare_digest(value, ADMIN_TOKEN)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Нет доступа")
+
+# ================================
+# Удаление истёкших ссылок
+# ================================
+@router.get("/reaper", dependencies=[Depends(require_admin)])
+def reaper_stats():
+    return link_reaper.stats()
+
+# ================================
+# Кэш
+# ================================
+@router.get("/cache", dependencies=[Depends(require_admin)])
+def cache_stats():
+    return cache_tier.stats()
+
+# ================================
+# События кликов
+# ================================
+@router.get("/analytics", dependencies=[Depends(require_admin)])
+def analytics_stats():
+    return click_events.stats()
+
+# ================================
+# Фильтр Блума по коротким кодам
+# ================================
+@router.get("/bloom", dependencies=[Depends(require_admin)])
+def bloom_stats():
+    return short_code_filter.stats()
+
+@router.post("/bloom/rebuild", status_code=202, dependencies=[Depends(require_admin)])
+def bloom_rebuild():
+    # Перестройка идёт в фоне, пока старый фильтр продолжает отвечать
+    short_code_filter.ensure_started()
+    return short_code_filter.stats()
+
+# ================================
+# Выгрузка данных для аналитики
+# ================================
+@router.get("/export/{dataset}", dependencies=[Depends(require_admin)])
+def export_dataset(
+    dataset: str,
+    format: str = "csv.gz",
+    since: Optional[datetime] = None,
+    watermark_column: Optional[str] = None
+):
+    try:
+        job = Export(dataset, format, since, watermark_column)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    # Отметку для следующей инкрементальной выгрузки клиент берёт из заголовка
+    return StreamingResponse(job.chunks(), media_type=job.media_type, headers={
+        "Content-Disposition": f'attachment; filename="{job.filename}"',
+        "X-Export-Watermark": job.until.isoformat(),
+    })
+
+# ================================
+# Профилирование запросов
+# ================================
+
+# Сводка в формате collapsed stacks: flamegraph.pl или speedscope строят по ней flamegraph
+@router.get("/profile", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+def profile_collapsed(route: Optional[str] = None):
+    return PlainTextResponse(request_profiler.collapsed(route))
+
+@router.get("/profile/requests", dependencies=[Depends(require_admin)])
+def profile_requests():
+    return {"stats": request_profiler.stats(), "requests": request_profiler.recent()}
+
+@router.delete("/profile", dependencies=[Depends(require_admin)])
+def profile_reset():
+    request_profiler.reset()
+    return {"message": "Профили очищены"}
@@ -1,16 +1,21 @@
 from fastapi import APIRouter, HTTPException, Depends, status, Form, Header, Cookie
 from fastapi.responses import HTMLResponse, RedirectResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlstuff import get_db, User
-from pydantic_stuff import UserCreate
+from pydantic_stuff import UserCreate, CurrentUser
 from passlib.context import CryptContext
+from password_pool import password_pool, PasswordPoolBusy
+from ratelimit import rate_limit
+from cache import get_cache_async, set_cache, delete_cache
+from config import BCRYPT_ROUNDS, USER_CACHE_TTL
 
 router = APIRouter()
 
 # Инициализация контекста для хэширования паролей (bcrypt)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
@@ -18,39 +23,61 @@ def get_password_hash(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+# bcrypt нагружает CPU, поэтому из обработчиков он вызывается в отдельном пуле потоков.
+# Если пул перегружен, запрос сразу получает 503 и не мешает остальным.
+async def run_in_password_pool(fn, *args):
+    try:
+        return await password_pool.run(fn, *args)
+    except PasswordPoolBusy:
+        raise HTTPException(
+            status_code=503,
+            detail="Сервис перегружен, попробуйте позже.",
+            headers={"Retry-After": "1"}
+        )
+
+async def hash_password_async(password: str) -> str:
+    return await run_in_password_pool(get_password_hash, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await run_in_password_pool(verify_password, plain_password, hashed_password)
+
+async def find_user(db: AsyncSession, username: str) -> Optional[User]:
+    return await db.scalar(select(User).where(User.username == username))
+
 # ================================
 # Эндпоинты регистрации
 # ================================
 
 # API-эндпоинт для регистрации
-@router.post("/users/register", status_code=status.HTTP_201_CREATED)
-def register_user_api(user: UserCreate, db: Session = Depends(get_db)):
-    existing_user = db.query(User).filter(User.username == user.username).first()
+@router.post("/users/register", status_code=status.HTTP_201_CREATED, dependencies=[Depends(rate_limit("register"))])
+async def register_user_api(user: UserCreate, db: AsyncSession = Depends(get_db)):
+    existing_user = await find_user(db, user.username)
     if existing_user:
         raise HTTPException(status_code=400, detail="Пользователь с таким username уже существует.")
     new_user = User(
         username=user.username,
-        hashed_password=get_password_hash(user.password)
+        hashed_password=await hash_password_async(user.password)
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
+    invalidate_user_cache(new_user.username)
     return {"message": f"Пользователь {new_user.username} зарегистрирован", "username": new_user.username}
 
 # HTML-эндпоинт для регистрации через форму (с подтверждением пароля)
-@router.post("/register")
+@router.post("/register", dependencies=[Depends(rate_limit("register"))])
 async def register_user_form(
     username: str = Form(...),
     password: str = Form(...),
     confirm: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if password != confirm:
         return HTMLResponse(
             content="<h3>Пароли не совпадают.</h3><a href='/register_page'>Назад</a>",
             status_code=400
         )
-    existing_user = db.query(User).filter(User.username == username).first()
+    existing_user = await find_user(db, username)
     if existing_user:
         return HTMLResponse(
             content=f"<h3>Пользователь с username '{username}' уже существует.</h3><a href='/register_page'>Назад</a>",
@@ -58,11 +85,12 @@ async def register_user_form(
         )
     new_user = User(
         username=username,
-        hashed_password=get_password_hash(password)
+        hashed_password=await hash_password_async(password)
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
+    invalidate_user_cache(new_user.username)
     return RedirectResponse(url="/?message=Регистрация прошла успешно", status_code=303)
 
 # ================================
@@ -70,23 +98,23 @@ async def register_user_form(
 # ================================
 
 # API-эндпоинт для логина (OAuth2PasswordRequestForm)
-@router.post("/users/login")
-def login_user_api(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+@router.post("/users/login", dependencies=[Depends(rate_limit("login"))])
+async def login_user_api(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await find_user(db, form_data.username)
+    if not user or not await verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Неверное имя пользователя или пароль")
     # Простейший вариант: токен – это username
     return {"token": user.username}
 
 # HTML-эндпоинт для логина через форму
-@router.post("/login")
+@router.post("/login", dependencies=[Depends(rate_limit("login"))])
 async def login_user_form(
     username: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not verify_password(password, user.hashed_password):
+    user = await find_user(db, username)
+    if not user or not await verify_password_async(password, user.hashed_password):
         return HTMLResponse(
             content="<h3>Неверное имя пользователя или пароль.</h3><a href='/login_page'>Назад</a>",
             status_code=401
@@ -107,30 +135,42 @@ def logout_user():
 # Вспомогательные функции аутентификации
 # ================================
 
-def get_current_user(authorization: Optional[str] = Header(None), token: Optional[str] = Cookie(None), db: Session = Depends(get_db)) -> User:
-    token_value = None
+def extract_token(authorization: Optional[str], token: Optional[str]) -> Optional[str]:
     if authorization:
         if not authorization.startswith("Bearer "):
             raise HTTPException(status_code=401, detail="Неверный формат заголовка авторизации.")
-        token_value = authorization[len("Bearer "):]
-    elif token:
-        token_value = token
+        return authorization[len("Bearer "):]
+    return token or None
+
+async def resolve_token(token_value: str, db: AsyncSession) -> Optional[CurrentUser]:
+    """Находит пользователя по токену, на тёплом кэше — без запроса к БД."""
+    cache_key = f"user_token_{token_value}"
+    cached_user = await get_cache_async(cache_key)
+    if cached_user is not None:
+        return cached_user
+    user = await find_user(db, token_value)
+    if not user:
+        return None
+    # В кэш кладём лёгкую копию, а не ORM-объект, привязанный к сессии
+    current_user = CurrentUser(id=user.id, username=user.username)
+    set_cache(cache_key, current_user, ttl=USER_CACHE_TTL)
+    return current_user
+
+def invalidate_user_cache(token_value: str):
+    """Сбрасывает закэшированного пользователя для токена."""
+    delete_cache(f"user_token_{token_value}")
+
+async def get_current_user(authorization: Optional[str] = Header(None), token: Optional[str] = Cookie(None), db: AsyncSession = Depends(get_db)) -> CurrentUser:
+    token_value = extract_token(authorization, token)
     if not token_value:
         raise HTTPException(status_code=401, detail="Необходима авторизация")
-    user = db.query(User).filter(User.username == token_value).first()
+    user = await resolve_token(token_value, db)
     if not user:
         raise HTTPException(status_code=401, detail="Неверный токен или пользователь не найден.")
     return user
 
-def get_current_user_optional(authorization: Optional[str] = Header(None), token: Optional[str] = Cookie(None), db: Session = Depends(get_db)) -> Optional[User]:
-    token_value = None
-    if authorization:
-        if not authorization.startswith("Bearer "):
-            raise HTTPException(status_code=401, detail="Неверный формат заголовка авторизации.")
-        token_value = authorization[len("Bearer "):]
-    elif token:
-        token_value = token
+async def get_current_user_optional(authorization: Optional[str] = Header(None), token: Optional[str] = Cookie(None), db: AsyncSession = Depends(get_db)) -> Optional[CurrentUser]:
+    token_value = extract_token(authorization, token)
     if token_value:
-        user = db.query(User).filter(User.username == token_value).first()
-        return user
+        return await resolve_token(token_value, db)
     return None
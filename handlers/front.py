@@ -1,16 +1,19 @@
 from fastapi import APIRouter, Request, Depends, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
-from sqlstuff import get_db, Link, User
-from sqlalchemy.orm import Session
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from sqlstuff import get_read_db, Link
+from pydantic_stuff import CurrentUser
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 from handlers.auth import get_current_user_optional
+from pagination import fetch_links_page, render_in_chunks
+from rendering import Template, StaticPage
+from config import LINKS_PAGE_SIZE, RENDER_CHUNK_ROWS, STATIC_PAGE_MAX_AGE
 
 router = APIRouter()
 
-# Функция для формирования базового HTML с Bootstrap
-def base_html(title: str, content: str, current_user: Optional[User] = None) -> str:
-    nav = navbar(current_user)
-    return f"""
+# Макет страницы с Bootstrap и навигация разбираются один раз при импорте
+LAYOUT = Template("""
     <!DOCTYPE html>
     <html lang="ru">
     <head>
@@ -27,12 +30,9 @@ def base_html(title: str, content: str, current_user: Optional[User] = None) ->
         <script src="https://cdn.jsdelivr.net/npm/bootstrap@4.5.2/dist/js/bootstrap.bundle.min.js"></script>
     </body>
     </html>
-    """
+    """)
 
-# Функция формирования навигационного меню
-def navbar(current_user: Optional[User]) -> str:
-    if current_user:
-        return f"""
+USER_NAVBAR = Template("""
         <nav class="navbar navbar-expand-lg navbar-dark bg-dark">
             <a class="navbar-brand" href="/">ShortLink</a>
             <div class="collapse navbar-collapse">
@@ -42,13 +42,13 @@ def navbar(current_user: Optional[User]) -> str:
                     <li class="nav-item"><a class="nav-link" href="/create">Создать ссылку</a></li>
                     <li class="nav-item"><a class="nav-link" href="/stats_page">Статистика</a></li>
                 </ul>
-                <span class="navbar-text mr-3">Привет, {current_user.username}</span>
+                <span class="navbar-text mr-3">Привет, {username}</span>
                 <a class="btn btn-outline-light" href="/logout">Выход</a>
             </div>
         </nav>
-        """
-    else:
-        return """
+        """)
+
+ANONYMOUS_NAVBAR = """
         <nav class="navbar navbar-expand-lg navbar-dark bg-dark">
             <a class="navbar-brand" href="/">ShortLink</a>
             <div class="collapse navbar-collapse">
@@ -61,24 +61,34 @@ def navbar(current_user: Optional[User]) -> str:
         </nav>
         """
 
+# Функция навигационного меню
+def navbar(current_user: Optional[CurrentUser]) -> str:
+    if current_user:
+        return USER_NAVBAR.render(username=current_user.username)
+    return ANONYMOUS_NAVBAR
+
+# Функция для формирования базового HTML с Bootstrap
+def base_html(title: str, content: str, current_user: Optional[CurrentUser] = None) -> str:
+    return LAYOUT.render(title=title, nav=navbar(current_user), content=content)
+
+# Шапка и подвал страницы отдельно: между ними потоком отдаётся содержимое
+def base_html_parts(title: str, current_user: Optional[CurrentUser] = None) -> tuple[str, str]:
+    return LAYOUT.render_parts("content", title=title, nav=navbar(current_user))
+
+def next_page_link(path: str, next_cursor: Optional[str]) -> str:
+    if not next_cursor:
+        return ""
+    return f"<a class='btn btn-outline-primary mb-4' href='{path}?cursor={next_cursor}'>Следующая страница</a>"
+
+# Страницы без данных пользователя браузер может хранить STATIC_PAGE_MAX_AGE секунд
+STATIC_CACHE_CONTROL = f"public, max-age={STATIC_PAGE_MAX_AGE}"
+# Главная для гостя зависит от токена, поэтому только с проверкой через If-None-Match
+ANONYMOUS_CACHE_CONTROL = "no-cache"
+
 # ================================
 # Landing Page (Главная страница)
 # ================================
-@router.get("/", response_class=HTMLResponse)
-async def landing_page(request: Request, db: Session = Depends(get_db), current_user=Depends(get_current_user_optional)):
-    message = request.query_params.get("message", "")
-    msg_html = f"<div class='alert alert-success'>{message}</div>" if message else ""
-    
-    if current_user:
-        links = db.query(Link).filter(Link.user_id == current_user.id).all()
-        links_html = "<h3>Ваши ссылки:</h3><table class='table table-striped'><thead><tr><th>Оригинальный URL</th><th>Короткая ссылка</th><th>Клики</th></tr></thead><tbody>"
-        for l in links:
-            links_html += f"<tr><td>{l.original_url}</td><td><a href='/links/{l.short_code}' target='_blank'>/links/{l.short_code}</a></td><td>{l.clicks}</td></tr>"
-        links_html += "</tbody></table>"
-    else:
-        links_html = "<h2>Добро пожаловать!</h2><p>Пожалуйста, зарегистрируйтесь или войдите, чтобы начать пользоваться сервисом.</p>"
-    
-    create_form = """
+LANDING_CREATE_FORM = """
     <h2>Создать короткую ссылку</h2>
     <form action="/links/shorten/form" method="post">
         <div class="form-group">
@@ -96,15 +106,44 @@ async def landing_page(request: Request, db: Session = Depends(get_db), current_
         <button type="submit" class="btn btn-primary">Создать ссылку</button>
     </form>
     """
-    content = msg_html + create_form + links_html
-    return HTMLResponse(content=base_html("Главная страница", content, current_user))
+
+LANDING_WELCOME = "<h2>Добро пожаловать!</h2><p>Пожалуйста, зарегистрируйтесь или войдите, чтобы начать пользоваться сервисом.</p>"
+
+ANONYMOUS_LANDING = StaticPage(
+    base_html("Главная страница", LANDING_CREATE_FORM + LANDING_WELCOME),
+    ANONYMOUS_CACHE_CONTROL,
+    vary="Authorization, Cookie",
+)
+
+def landing_row(l) -> str:
+    return f"<tr><td>{l.original_url}</td><td><a href='/links/{l.short_code}' target='_blank'>/links/{l.short_code}</a></td><td>{l.clicks}</td></tr>"
+
+@router.get("/", response_class=HTMLResponse)
+async def landing_page(request: Request, db: AsyncSession = Depends(get_read_db), current_user=Depends(get_current_user_optional)):
+    message = request.query_params.get("message", "")
+    msg_html = f"<div class='alert alert-success'>{message}</div>" if message else ""
+
+    if not current_user:
+        if not message:
+            return ANONYMOUS_LANDING.response(request)
+        return HTMLResponse(content=base_html("Главная страница", msg_html + LANDING_CREATE_FORM + LANDING_WELCOME))
+
+    try:
+        links, next_cursor = await fetch_links_page(db, current_user.id, request.query_params.get("cursor"), LINKS_PAGE_SIZE)
+    except ValueError:
+        return HTMLResponse(content=base_html("Ошибка", "<p>Некорректный курсор.</p>", current_user), status_code=400)
+    head, tail = base_html_parts("Главная страница", current_user)
+    def page():
+        yield head + msg_html + LANDING_CREATE_FORM
+        yield "<h3>Ваши ссылки:</h3><table class='table table-striped'><thead><tr><th>Оригинальный URL</th><th>Короткая ссылка</th><th>Клики</th></tr></thead><tbody>"
+        yield from render_in_chunks(links, landing_row, RENDER_CHUNK_ROWS)
+        yield "</tbody></table>" + next_page_link("/", next_cursor) + tail
+    return StreamingResponse(page(), media_type="text/html; charset=utf-8")
 
 # ================================
 # Страница регистрации
 # ================================
-@router.get("/register_page", response_class=HTMLResponse)
-async def register_page(request: Request):
-    content = """
+REGISTER_PAGE = StaticPage(base_html("Регистрация", """
     <h1>Регистрация</h1>
     <form action="/register" method="post">
         <div class="form-group">
@@ -122,15 +161,16 @@ async def register_page(request: Request):
         <button type="submit" class="btn btn-success">Зарегистрироваться</button>
     </form>
     <p>Уже зарегистрированы? <a href="/login_page">Войти</a></p>
-    """
-    return HTMLResponse(content=base_html("Регистрация", content))
+    """), STATIC_CACHE_CONTROL)
+
+@router.get("/register_page", response_class=HTMLResponse)
+async def register_page(request: Request):
+    return REGISTER_PAGE.response(request)
 
 # ================================
 # Страница входа
 # ================================
-@router.get("/login_page", response_class=HTMLResponse)
-async def login_page(request: Request):
-    content = """
+LOGIN_PAGE = StaticPage(base_html("Вход", """
     <h1>Вход</h1>
     <form action="/login" method="post">
         <div class="form-group">
@@ -144,34 +184,16 @@ async def login_page(request: Request):
         <button type="submit" class="btn btn-primary">Войти</button>
     </form>
     <p>Нет аккаунта? <a href="/register_page">Зарегистрироваться</a></p>
-    """
-    return HTMLResponse(content=base_html("Вход", content))
+    """), STATIC_CACHE_CONTROL)
+
+@router.get("/login_page", response_class=HTMLResponse)
+async def login_page(request: Request):
+    return LOGIN_PAGE.response(request)
 
 # ================================
 # Личный кабинет (Dashboard)
 # ================================
-@router.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, db: Session = Depends(get_db), current_user=Depends(get_current_user_optional)):
-    if not current_user:
-        return RedirectResponse(url="/login_page?message=Сначала авторизуйтесь", status_code=303)
-    links = db.query(Link).filter(Link.user_id == current_user.id).all()
-    rows = ""
-    for l in links:
-        rows += f"""
-        <tr>
-            <td>{l.original_url}</td>
-            <td><a href="/links/{l.short_code}" target="_blank">/links/{l.short_code}</a></td>
-            <td>{l.clicks}</td>
-            <td>{l.created_at.strftime("%Y-%m-%d %H:%M:%S")}</td>
-            <td>{l.expires_at.strftime("%Y-%m-%d %H:%M:%S") if l.expires_at else "Нет"}</td>
-            <td>
-                <a class="btn btn-sm btn-warning" href="/edit_link?short_code={l.short_code}">Редактировать</a>
-                <a class="btn btn-sm btn-danger" href="/delete_link?short_code={l.short_code}">Удалить</a>
-                <a class="btn btn-sm btn-info" href="/stats_page?short_code={l.short_code}">Статистика</a>
-            </td>
-        </tr>
-        """
-    content = f"""
+DASHBOARD_TABLE_START = """
     <h1>Личный кабинет</h1>
     <h2>Ваши ссылки</h2>
     <table class="table table-bordered">
@@ -186,20 +208,48 @@ async def dashboard(request: Request, db: Session = Depends(get_db), current_use
             </tr>
         </thead>
         <tbody>
-            {rows}
+"""
+
+DASHBOARD_TABLE_END = """
         </tbody>
     </table>
-    """
-    return HTMLResponse(content=base_html("Личный кабинет", content, current_user))
+"""
+
+def dashboard_row(l) -> str:
+    return f"""
+        <tr>
+            <td>{l.original_url}</td>
+            <td><a href="/links/{l.short_code}" target="_blank">/links/{l.short_code}</a></td>
+            <td>{l.clicks}</td>
+            <td>{l.created_at.strftime("%Y-%m-%d %H:%M:%S")}</td>
+            <td>{l.expires_at.strftime("%Y-%m-%d %H:%M:%S") if l.expires_at else "Нет"}</td>
+            <td>
+                <a class="btn btn-sm btn-warning" href="/edit_link?short_code={l.short_code}">Редактировать</a>
+                <a class="btn btn-sm btn-danger" href="/delete_link?short_code={l.short_code}">Удалить</a>
+                <a class="btn btn-sm btn-info" href="/stats_page?short_code={l.short_code}">Статистика</a>
+            </td>
+        </tr>
+        """
+
+@router.get("/dashboard", response_class=HTMLResponse)
+async def dashboard(request: Request, db: AsyncSession = Depends(get_read_db), current_user=Depends(get_current_user_optional)):
+    if not current_user:
+        return RedirectResponse(url="/login_page?message=Сначала авторизуйтесь", status_code=303)
+    try:
+        links, next_cursor = await fetch_links_page(db, current_user.id, request.query_params.get("cursor"), LINKS_PAGE_SIZE)
+    except ValueError:
+        return HTMLResponse(content=base_html("Ошибка", "<p>Некорректный курсор.</p>", current_user), status_code=400)
+    head, tail = base_html_parts("Личный кабинет", current_user)
+    def page():
+        yield head + DASHBOARD_TABLE_START
+        yield from render_in_chunks(links, dashboard_row, RENDER_CHUNK_ROWS)
+        yield DASHBOARD_TABLE_END + next_page_link("/dashboard", next_cursor) + tail
+    return StreamingResponse(page(), media_type="text/html; charset=utf-8")
 
 # ================================
 # Страница создания ссылки
 # ================================
-@router.get("/create", response_class=HTMLResponse)
-async def create_page(request: Request, current_user=Depends(get_current_user_optional)):
-    if not current_user:
-        return RedirectResponse(url="/login_page?message=Сначала авторизуйтесь", status_code=303)
-    content = """
+CREATE_FORM = """
     <h1>Создать ссылку</h1>
     <form action="/links/shorten/form" method="post">
         <div class="form-group">
@@ -220,19 +270,24 @@ async def create_page(request: Request, current_user=Depends(get_current_user_op
         <button type="submit" class="btn btn-primary">Создать ссылку</button>
     </form>
     """
-    return HTMLResponse(content=base_html("Создать ссылку", content, current_user))
+
+@router.get("/create", response_class=HTMLResponse)
+async def create_page(request: Request, current_user=Depends(get_current_user_optional)):
+    if not current_user:
+        return RedirectResponse(url="/login_page?message=Сначала авторизуйтесь", status_code=303)
+    return HTMLResponse(content=base_html("Создать ссылку", CREATE_FORM, current_user))
 
 # ================================
 # Страница статистики и аналитики
 # ================================
 @router.get("/stats_page", response_class=HTMLResponse)
-async def stats_page(request: Request, db: Session = Depends(get_db), current_user=Depends(get_current_user_optional)):
+async def stats_page(request: Request, db: AsyncSession = Depends(get_read_db), current_user=Depends(get_current_user_optional)):
     if not current_user:
         return RedirectResponse(url="/login_page?message=Сначала авторизуйтесь", status_code=303)
     short_code = request.query_params.get("short_code")
     stats_html = ""
     if short_code:
-        link = db.query(Link).filter(Link.short_code == short_code, Link.user_id == current_user.id).first()
+        link = await db.scalar(select(Link).where(Link.short_code == short_code, Link.user_id == current_user.id))
         if not link:
             stats_html = "<p>Ссылка не найдена или доступ запрещён.</p>"
         else:
@@ -266,13 +321,13 @@ async def stats_page(request: Request, db: Session = Depends(get_db), current_us
 # (Изменён путь – теперь доступна по /edit_link)
 # ================================
 @router.get("/edit_link", response_class=HTMLResponse)
-async def edit_link_page(request: Request, db: Session = Depends(get_db), current_user=Depends(get_current_user_optional)):
+async def edit_link_page(request: Request, db: AsyncSession = Depends(get_read_db), current_user=Depends(get_current_user_optional)):
     if not current_user:
         return RedirectResponse(url="/login_page?message=Сначала авторизуйтесь", status_code=303)
     short_code = request.query_params.get("short_code")
     if not short_code:
         return HTMLResponse(content=base_html("Ошибка", "<p>Нет короткого кода.</p>", current_user))
-    link = db.query(Link).filter(Link.short_code == short_code, Link.user_id == current_user.id).first()
+    link = await db.scalar(select(Link).where(Link.short_code == short_code, Link.user_id == current_user.id))
     if not link:
         return HTMLResponse(content=base_html("Ошибка", "<p>Ссылка не найдена или доступ запрещён.</p>", current_user))
     content = f"""
@@ -293,13 +348,13 @@ async def edit_link_page(request: Request, db: Session = Depends(get_db), curren
 # (Изменён путь – теперь доступна по /delete_link)
 # ================================
 @router.get("/delete_link", response_class=HTMLResponse)
-async def delete_link_page(request: Request, db: Session = Depends(get_db), current_user=Depends(get_current_user_optional)):
+async def delete_link_page(request: Request, db: AsyncSession = Depends(get_read_db), current_user=Depends(get_current_user_optional)):
     if not current_user:
         return RedirectResponse(url="/login_page?message=Сначала авторизуйтесь", status_code=303)
     short_code = request.query_params.get("short_code")
     if not short_code:
         return HTMLResponse(content=base_html("Ошибка", "<p>Нет короткого кода.</p>", current_user))
-    link = db.query(Link).filter(Link.short_code == short_code, Link.user_id == current_user.id).first()
+    link = await db.scalar(select(Link).where(Link.short_code == short_code, Link.user_id == current_user.id))
     if not link:
         return HTMLResponse(content=base_html("Ошибка", "<p>Ссылка не найдена или доступ запрещён.</p>", current_user))
     content = f"""
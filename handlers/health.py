@@ -0,0 +1,21 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from bloom import short_code_filter
+from warmup import cache_warmer
+
+router = APIRouter()
+
+# ================================
+# Готовность воркера принимать трафик
+# ================================
+
+# 503, пока идёт прогрев кэша: балансировщик не отправит трафик на холодный воркер.
+# Фильтр Блума на готовность не влияет: без него коды просто проверяются в БД
+@router.get("/ready", include_in_schema=False)
+def readiness():
+    body = {
+        "ready": cache_warmer.ready,
+        "cache_warmup": cache_warmer.progress(),
+        "bloom_filter_ready": short_code_filter.ready,
+    }
+    return JSONResponse(body, status_code=200 if cache_warmer.ready else 503)
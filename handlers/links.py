@@ -1,61 +1,137 @@
-from fastapi import APIRouter, HTTPException, Depends, status, Form, Header, Cookie
-from fastapi.responses import HTMLResponse, RedirectResponse
-from sqlalchemy.orm import Session
+import json
+from fastapi import APIRouter, HTTPException, Depends, status, Form, Header, Cookie, Request, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
+from pydantic import ValidationError
+from sqlalchemy import select, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
-from typing import Optional
-from sqlstuff import get_db, Link
-from pydantic_stuff import LinkCreate, LinkUpdate, LinkStats
-from uuid_stuff import generate_short_code
+from typing import Optional, Literal
+from sqlstuff import get_db, get_read_db, first_with_fallback, Link
+from pydantic_stuff import LinkCreate, LinkUpdate, LinkStats, LinkListItem, LinkPage, LinkTimeseries, TimeseriesPoint
+from pagination import fetch_links_page
+from ratelimit import rate_limit, enforce_rate_limit
+from bloom import short_code_filter
+from rendering import make_etag, etag_matches, not_modified
+from profiler import run_in_threadpool
+from uuid_stuff import generate_short_code_async, code_generator
 from handlers.auth import get_current_user, get_current_user_optional
-from cache import get_cache, set_cache, delete_cache  # Импорт функций кэша
+from cache import (  # Импорт функций кэша
+    get_cache_async, set_cache, recent_invalidations, invalidate_link_cache, invalidate_links_cache, LINK_NOT_FOUND,
+)
+from clicks import click_aggregator
+from analytics import (
+    click_events, timeseries_query, fill_buckets, bucket_start, to_naive_utc, analytics_delete_statements,
+    BUCKET_STEP, DEFAULT_SPAN,
+)
+from config import (
+    REDIRECT_CACHE_TTL, REDIRECT_NEGATIVE_TTL, BULK_MAX_ITEMS, BULK_CHUNK_SIZE,
+    LINKS_API_DEFAULT_LIMIT, LINKS_API_MAX_LIMIT, ANALYTICS_MAX_POINTS,
+)
 
 router = APIRouter()
 
-def get_link(short_code: str, db: Session) -> Link:
-    link = db.query(Link).filter(Link.short_code == short_code).first()
-    if not link:
+async def get_link(short_code: str, db: AsyncSession, fresh: bool = False) -> Link:
+    """fresh=True читает ссылку из основной БД, даже если db — реплика."""
+    if not short_code_filter.might_contain(short_code):
         raise HTTPException(status_code=404, detail="Ссылка не найдена.")
-    return link
+    row = await first_with_fallback(db, select(Link).where(Link.short_code == short_code), fresh=fresh)
+    if not row:
+        raise HTTPException(status_code=404, detail="Ссылка не найдена.")
+    return row[0]
+
+# ================================
+# Кэш редиректов
+# ================================
+
+async def resolve_link(short_code: str, db: AsyncSession) -> tuple[str, Optional[datetime]]:
+    """Возвращает (original_url, expires_at), по возможности без запроса к БД."""
+    # Заведомо несуществующий код не занимает место в кэше
+    if not short_code_filter.might_contain(short_code):
+        raise HTTPException(status_code=404, detail="Ссылка не найдена.")
+    cache_key = f"link_redirect_{short_code}"
+    cached = await get_cache_async(cache_key)
+    if cached is None:
+        # Недавно изменённую ссылку читаем из основной БД: отстающая реплика
+        # вернула бы прежний original_url, и он остался бы в кэше на весь TTL
+        row = await first_with_fallback(
+            db,
+            select(Link.original_url, Link.expires_at).where(Link.short_code == short_code),
+            fresh=recent_invalidations.recent(cache_key),
+        )
+        if row:
+            cached = (row.original_url, row.expires_at)
+            set_cache(cache_key, cached, ttl=REDIRECT_CACHE_TTL)
+        else:
+            cached = LINK_NOT_FOUND
+            set_cache(cache_key, cached, ttl=REDIRECT_NEGATIVE_TTL)
+    if cached is LINK_NOT_FOUND:
+        raise HTTPException(status_code=404, detail="Ссылка не найдена.")
+    return cached
+
+async def delete_link_analytics(db: AsyncSession, short_codes: list[str]):
+    """Удаляет события и агрегаты кликов ссылок в транзакции db (до её commit)."""
+    # Буфер ждёт идущую запись пачки под блокировкой — не в event loop
+    await run_in_threadpool(click_events.discard, short_codes)
+    for statement in analytics_delete_statements(short_codes):
+        await db.execute(statement)
 
 # ================================
 # Создание ссылки
 # ================================
-@router.post("/links/shorten", status_code=status.HTTP_201_CREATED)
-def create_link_api(
+
+# Сколько раз пробуем вставить сгенерированный код, если он совпал с существующим
+# (возможно только для старых случайных кодов и ручных alias)
+INSERT_LINK_ATTEMPTS = 5
+
+async def insert_link(db: AsyncSession, custom_alias: Optional[str], **fields) -> Optional[str]:
+    """
+    Создаёт ссылку без предварительной проверки кода: занятость определяет
+    первичный ключ. Возвращает short_code или None, если custom_alias занят.
+    """
+    for _ in range(INSERT_LINK_ATTEMPTS):
+        short_code = custom_alias or await generate_short_code_async()
+        db.add(Link(short_code=short_code, **fields))
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            if custom_alias:
+                return None
+            continue
+        # Код попадает в фильтр явно: сброс кэша ниже оповещает только другие воркеры с общим кэшем
+        short_code_filter.add(short_code)
+        # Alias мог принадлежать недавно удалённой ссылке: клики новой записываются
+        click_events.revive((short_code,))
+        invalidate_link_cache(short_code)
+        return short_code
+    raise HTTPException(status_code=500, detail="Не удалось сгенерировать короткий код.")
+
+@router.post("/links/shorten", status_code=status.HTTP_201_CREATED, dependencies=[Depends(rate_limit("create"))])
+async def create_link_api(
     link: LinkCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user_optional)
 ):
-    short_code = link.custom_alias if link.custom_alias else generate_short_code()
-    existing_link = db.query(Link).filter(Link.short_code == short_code).first()
-    if existing_link:
-        raise HTTPException(status_code=400, detail="Код занят.")
-    new_link = Link(
-        short_code=short_code,
+    short_code = await insert_link(
+        db,
+        link.custom_alias,
         original_url=str(link.original_url),  # Приведение к строке
         expires_at=link.expires_at,
         user_id=current_user.id if current_user else None
     )
-    db.add(new_link)
-    db.commit()
-    db.refresh(new_link)
-    return {"short_code": short_code, "original_url": new_link.original_url}
+    if short_code is None:
+        raise HTTPException(status_code=400, detail="Код занят.")
+    return {"short_code": short_code, "original_url": str(link.original_url)}
 
-@router.post("/links/shorten/form")
-def create_link_form(
+@router.post("/links/shorten/form", dependencies=[Depends(rate_limit("create"))])
+async def create_link_form(
     original_url: str = Form(...),
     custom_alias: Optional[str] = Form(None),
     expires_at: Optional[str] = Form(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user_optional)
 ):
-    short_code = custom_alias if custom_alias else generate_short_code()
-    existing_link = db.query(Link).filter(Link.short_code == short_code).first()
-    if existing_link:
-        return HTMLResponse(
-            content=f"<h3>Код {short_code} уже занят.</h3><a href='/create'>Назад</a>",
-            status_code=400
-        )
     expires_dt = None
     if expires_at:
         try:
@@ -65,117 +141,310 @@ def create_link_form(
                 content="<h3>Неверный формат даты.</h3><a href='/create'>Назад</a>",
                 status_code=400
             )
-    new_link = Link(
-        short_code=short_code,
+    short_code = await insert_link(
+        db,
+        custom_alias,
         original_url=original_url,
         expires_at=expires_dt,
         user_id=current_user.id if current_user else None
     )
-    db.add(new_link)
-    db.commit()
-    db.refresh(new_link)
+    if short_code is None:
+        return HTMLResponse(
+            content=f"<h3>Код {custom_alias} уже занят.</h3><a href='/create'>Назад</a>",
+            status_code=400
+        )
     return RedirectResponse(url=f"/?message=Ссылка создана: /links/{short_code}", status_code=303)
 
+# ================================
+# Массовое создание ссылок
+# ================================
+
+async def read_bulk_items(request: Request) -> list:
+    """Читает тело запроса: JSON-массив или NDJSON (по объекту в строке)."""
+    content_type = request.headers.get("content-type", "")
+    items = []
+    if "ndjson" in content_type or "jsonl" in content_type:
+        # NDJSON разбираем построчно по мере чтения потока
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    items.append(line)
+            if len(items) > BULK_MAX_ITEMS:
+                break
+        if buffer.strip():
+            items.append(buffer)
+        parsed = []
+        for line in items:
+            try:
+                parsed.append(json.loads(line))
+            except ValueError:
+                parsed.append(None)
+        items = parsed
+    else:
+        try:
+            items = json.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Некорректный JSON.")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Ожидается JSON-массив ссылок.")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Не больше {BULK_MAX_ITEMS} ссылок за запрос.")
+    return items
+
+async def find_taken_codes(db: AsyncSession, codes: list[str]) -> set[str]:
+    """Одним запросом на порцию находит уже занятые коды."""
+    # Коды, которых заведомо нет, проверять в БД не нужно
+    codes = [code for code in codes if short_code_filter.might_contain(code)]
+    taken = set()
+    for start in range(0, len(codes), BULK_CHUNK_SIZE):
+        chunk = codes[start:start + BULK_CHUNK_SIZE]
+        taken.update((await db.scalars(select(Link.short_code).where(Link.short_code.in_(chunk)))).all())
+    return taken
+
+@router.post("/links/shorten/bulk", dependencies=[Depends(rate_limit("create"))])
+async def create_links_bulk(
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(get_current_user_optional)
+):
+    items = await read_bulk_items(request)
+    await enforce_rate_limit("bulk", request, cost=len(items))
+    results = [None] * len(items)
+    valid = []  # (index, LinkCreate)
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, LinkCreate.model_validate(item)))
+        except ValidationError as e:
+            results[index] = {"index": index, "status": "error", "detail": e.errors(include_url=False, include_context=False)}
+
+    # Проверяем alias: повторы внутри запроса и занятые в БД
+    seen_aliases = set()
+    with_alias, generated = [], []
+    for index, link in valid:
+        if link.custom_alias:
+            if link.custom_alias in seen_aliases:
+                results[index] = {"index": index, "status": "error", "detail": "Alias повторяется в запросе."}
+                continue
+            seen_aliases.add(link.custom_alias)
+            with_alias.append((index, link))
+        else:
+            generated.append((index, link))
+    taken = await find_taken_codes(db, list(seen_aliases))
+    rows = []
+    for index, link in with_alias:
+        if link.custom_alias in taken:
+            results[index] = {"index": index, "status": "error", "detail": "Код занят."}
+        else:
+            rows.append((index, link.custom_alias, link))
+
+    # Сгенерированные коды уникальны между собой; отбрасываем редкие совпадения
+    # со старыми случайными кодами и alias и добираем новые
+    pending = generated
+    while pending:
+        codes = await run_in_threadpool(code_generator.next_codes, len(pending))
+        clash = await find_taken_codes(db, codes) | (seen_aliases & set(codes))
+        retry = []
+        for (index, link), code in zip(pending, codes):
+            if code in clash:
+                retry.append((index, link))
+            else:
+                rows.append((index, code, link))
+        pending = retry
+
+    user_id = current_user.id if current_user else None
+    params = [
+        {
+            "short_code": code,
+            "original_url": str(link.original_url),
+            "expires_at": link.expires_at,
+            "user_id": user_id,
+        }
+        for _, code, link in rows
+    ]
+    try:
+        for start in range(0, len(params), BULK_CHUNK_SIZE):
+            await db.execute(insert(Link.__table__), params[start:start + BULK_CHUNK_SIZE])
+        await db.commit()
+    except IntegrityError:
+        # Кто-то занял alias между проверкой и вставкой: откатываем весь пакет
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Alias был занят во время обработки, повторите запрос.")
+
+    short_code_filter.update(code for _, code, _ in rows)
+    click_events.revive(code for _, code, _ in rows)
+    invalidate_links_cache(code for _, code, _ in rows)
+    for index, code, link in rows:
+        results[index] = {"index": index, "status": "created", "short_code": code, "original_url": str(link.original_url)}
+    return {"created": len(rows), "failed": len(items) - len(rows), "results": results}
+
 # ================================
 # Перенаправление по короткой ссылке
 # ================================
-@router.get("/links/{short_code}")
-def redirect_link(short_code: str, db: Session = Depends(get_db)):
-    link = get_link(short_code, db)
-    if link.expires_at and datetime.utcnow() > link.expires_at:
+@router.get("/links/{short_code}", dependencies=[Depends(rate_limit("redirect"))])
+async def redirect_link(short_code: str, request: Request, db: AsyncSession = Depends(get_read_db)):
+    original_url, expires_at = await resolve_link(short_code, db)
+    if expires_at and datetime.utcnow() > expires_at:
         raise HTTPException(status_code=410, detail="Ссылка уже слишком старая.")
-    link.clicks += 1
-    link.last_accessed_at = datetime.utcnow()
-    db.commit()
-    return RedirectResponse(url=link.original_url, status_code=302)
+    # Клик попадает в буфер и будет записан в БД пачкой, без commit на каждый редирект
+    click_aggregator.record(short_code)
+    click_events.record(
+        short_code,
+        request.headers.get("referer"),
+        request.headers.get("user-agent"),
+        request.client.host if request.client else None,
+    )
+    return RedirectResponse(url=original_url, status_code=302)
+
+# ================================
+# Список ссылок пользователя (keyset-пагинация)
+# ================================
+@router.get("/users/me/links", response_model=LinkPage)
+async def list_my_links(
+    cursor: Optional[str] = None,
+    limit: int = Query(LINKS_API_DEFAULT_LIMIT, ge=1, le=LINKS_API_MAX_LIMIT),
+    db: AsyncSession = Depends(get_read_db),
+    current_user = Depends(get_current_user)
+):
+    try:
+        rows, next_cursor = await fetch_links_page(db, current_user.id, cursor, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный курсор.")
+    items = [LinkListItem(**{**row._mapping, "clicks": row.clicks or 0}) for row in rows]
+    return LinkPage(items=items, next_cursor=next_cursor)
 
 # ================================
 # Получение статистики по ссылке (API) с кэшированием
 # ================================
 @router.get("/links/{short_code}/stats", response_model=LinkStats)
-def get_stats(short_code: str, db: Session = Depends(get_db)):
+async def get_stats(short_code: str, request: Request, db: AsyncSession = Depends(get_read_db)):
+    # В кэше лежит уже сериализованный ответ и его ETag: повторный запрос
+    # (и 304 на If-None-Match) обходится без БД и без сборки LinkStats
     cache_key = f"link_stats_{short_code}"
-    cached_stats = get_cache(cache_key)
-    if cached_stats:
-        return cached_stats
-    link = get_link(short_code, db)
-    stats = LinkStats(
-        original_url=str(link.original_url),
-        created_at=link.created_at,
-        expires_at=link.expires_at,
-        clicks=link.clicks,
-        last_accessed_at=link.last_accessed_at
-    )
-    set_cache(cache_key, stats, ttl=60)
-    return stats
+    cached_stats = await get_cache_async(cache_key)
+    if cached_stats is None:
+        link = await get_link(short_code, db, fresh=recent_invalidations.recent(cache_key))
+        # Учитываем клики, которые ещё не сброшены в БД
+        pending_clicks, pending_last = click_aggregator.pending(short_code)
+        last_accessed_at = link.last_accessed_at
+        if pending_last and (not last_accessed_at or pending_last > last_accessed_at):
+            last_accessed_at = pending_last
+        stats = LinkStats(
+            original_url=str(link.original_url),
+            created_at=link.created_at,
+            expires_at=link.expires_at,
+            clicks=link.clicks + pending_clicks,
+            last_accessed_at=last_accessed_at
+        )
+        body = stats.model_dump_json().encode("utf-8")
+        # ETag меняется вместе с clicks и last_accessed_at (и с самой ссылкой)
+        cached_stats = (make_etag(body), body)
+        set_cache(cache_key, cached_stats, ttl=60)
+    etag, body = cached_stats
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# ================================
+# Клики по минутам, часам или дням
+# ================================
+@router.get("/links/{short_code}/stats/timeseries", response_model=LinkTimeseries)
+async def get_stats_timeseries(
+    short_code: str,
+    granularity: Literal["minute", "hour", "day"] = "hour",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_read_db)
+):
+    await resolve_link(short_code, db)
+    end = to_naive_utc(end) if end else datetime.utcnow()
+    start = to_naive_utc(start) if start else end - DEFAULT_SPAN[granularity]
+    if start > end:
+        raise HTTPException(status_code=400, detail="start должен быть не позже end.")
+    first_bucket = bucket_start(start, granularity)
+    if (end - first_bucket) // BUCKET_STEP[granularity] >= ANALYTICS_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"Слишком большой период: больше {ANALYTICS_MAX_POINTS} точек.")
+    rows = (await db.execute(timeseries_query(short_code, granularity, first_bucket, end))).all()
+    points = [
+        TimeseriesPoint(bucket_start=bucket, clicks=clicks)
+        for bucket, clicks in fill_buckets(rows, granularity, first_bucket, end)
+    ]
+    return LinkTimeseries(short_code=short_code, granularity=granularity, start=first_bucket, end=end, points=points)
 
 # ================================
 # Обновление ссылки
 # ================================
 @router.put("/links/{short_code}")
-def update_link_api(
+async def update_link_api(
     short_code: str,
     link_data: LinkUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    link = get_link(short_code, db)
+    link = await get_link(short_code, db)
     if not link.user_id or link.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Нет доступа к этой ссылке")
     # Преобразуем HttpUrl в строку для сохранения в БД
     link.original_url = str(link_data.original_url)
-    db.commit()
-    delete_cache(f"link_stats_{short_code}")
+    await db.commit()
+    invalidate_link_cache(short_code)
     return {"message": "Ссылка обновлена", "short_code": short_code}
 
 @router.post("/links/update")
-def update_link_form(
+async def update_link_form(
     short_code: str = Form(...),
     original_url: str = Form(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    link = get_link(short_code, db)
+    link = await get_link(short_code, db)
     if not link.user_id or link.user_id != current_user.id:
         return HTMLResponse(
             content="<h3>Нет доступа к этой ссылке</h3><a href='/dashboard'>Назад</a>",
             status_code=403
         )
     link.original_url = original_url
-    db.commit()
-    delete_cache(f"link_stats_{short_code}")
+    await db.commit()
+    invalidate_link_cache(short_code)
     return RedirectResponse(url="/?message=Ссылка успешно обновлена", status_code=303)
 
 # ================================
 # Удаление ссылки
 # ================================
 @router.delete("/links/{short_code}")
-def delete_link_api(
+async def delete_link_api(
     short_code: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    link = get_link(short_code, db)
+    link = await get_link(short_code, db)
     if not link.user_id or link.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Нет доступа к этой ссылке")
-    db.delete(link)
-    db.commit()
-    delete_cache(f"link_stats_{short_code}")
+    await delete_link_analytics(db, [short_code])
+    await db.delete(link)
+    await db.commit()
+    click_aggregator.discard(short_code)
+    invalidate_link_cache(short_code)
     return {"message": "Ссылка удалена"}
 
 @router.post("/links/delete")
-def delete_link_form(
+async def delete_link_form(
     short_code: str = Form(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    link = get_link(short_code, db)
+    link = await get_link(short_code, db)
     if not link.user_id or link.user_id != current_user.id:
         return HTMLResponse(
             content="<h3>Нет доступа к этой ссылке</h3><a href='/dashboard'>Назад</a>",
             status_code=403
         )
-    db.delete(link)
-    db.commit()
-    delete_cache(f"link_stats_{short_code}")
+    await delete_link_analytics(db, [short_code])
+    await db.delete(link)
+    await db.commit()
+    click_aggregator.discard(short_code)
+    invalidate_link_cache(short_code)
     return RedirectResponse(url="/?message=Ссылка успешно удалена", status_code=303)
@@ -1,9 +1,104 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from handlers import auth, links, front
+from handlers import auth, links, front, admin, health, metrics as metrics_handlers
+from clicks import click_aggregator
+from analytics import click_events
+from cache import cache_store, cache_tier
+from password_pool import password_pool
+from reaper import link_reaper
+from migrations import upgrade
+from sqlstuff import engine
+from metrics import registry, MetricsMiddleware, stats_collector
+from profiler import ProfilingMiddleware, request_profiler
+from fast_redirect import FastRedirectMiddleware
+from compression import CompressionMiddleware
+from ratelimit import rate_limiter
+from bloom import short_code_filter
+from warmup import cache_warmer
+from config import AUTO_MIGRATE, METRICS_ENABLED, PROFILE_SAMPLE_RATE, COMPRESSION_MIN_SIZE, GZIP_LEVEL, BROTLI_QUALITY
 
-app = FastAPI(title="API-сервис сокращения ссылок")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if AUTO_MIGRATE:
+        upgrade(engine)
+    click_aggregator.ensure_started()
+    click_events.ensure_started()
+    cache_store.ensure_sweeper()
+    cache_tier.ensure_subscribed()
+    cache_warmer.ensure_started()
+    short_code_filter.ensure_started()
+    link_reaper.start()
+    yield
+    link_reaper.stop()
+    short_code_filter.stop()
+    # Перед остановкой записываем в БД все накопленные клики
+    click_aggregator.stop()
+    click_events.stop()
+    # Снимок кэша — до остановки фоновых потоков кэша
+    cache_warmer.stop()
+    cache_store.stop_sweeper()
+    cache_tier.close()
+    password_pool.shutdown()
+
+
+app = FastAPI(title="API-сервис сокращения ссылок", lifespan=lifespan)
 
 app.include_router(auth.router)
 app.include_router(links.router)
 app.include_router(front.router)
+app.include_router(admin.router)
+app.include_router(health.router)
+
+# Редиректы в обход маршрутизации FastAPI (FAST_REDIRECT). Добавляется первым,
+# чтобы профилирование и метрики оборачивали и его
+app.add_middleware(FastRedirectMiddleware)
+
+# Профилирование: доля PROFILE_SAMPLE_RATE запросов или по заголовку X-Profile с ADMIN_TOKEN
+app.add_middleware(
+    ProfilingMiddleware,
+    profiler=request_profiler,
+    sample_rate=PROFILE_SAMPLE_RATE,
+    authorize=admin.is_admin_token,
+)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics_handlers.router)
+    registry.add_collector(stats_collector(
+        "cache", cache_tier.stats,
+        counters=(
+            "hits", "misses", "evictions", "expirations",
+            "shared_hits", "shared_misses", "shared_errors", "shared_skipped", "shared_circuit_trips",
+        ),
+        gauges=("entries", "bytes", "shared_circuit_open"),
+        help_text="Кэш приложения",
+    ))
+    registry.add_collector(stats_collector(
+        "click_events", click_events.stats,
+        counters=("recorded", "written", "dropped", "discarded", "errors"),
+        gauges=("pending",),
+        help_text="Буфер событий кликов",
+    ))
+    registry.add_collector(stats_collector(
+        "bloom", short_code_filter.stats,
+        counters=("definite_misses", "builds", "errors"),
+        gauges=("items_added", "memory_bytes"),
+        help_text="Фильтр Блума по коротким кодам",
+    ))
+    registry.add_collector(stats_collector(
+        "rate_limit", rate_limiter.stats,
+        counters=("allowed", "rejected", "evictions", "errors"),
+        gauges=("keys",),
+        help_text="Ограничение частоты запросов",
+    ))
 
+# Сжатие — самый внешний слой: сжимает ответы всех обработчиков, включая быстрый редирект.
+# Метрики отправляют тело через его send, поэтому задержка в http_request_duration_seconds
+# включает время gzip/brotli
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESSION_MIN_SIZE,
+    gzip_level=GZIP_LEVEL,
+    brotli_quality=BROTLI_QUALITY,
+)
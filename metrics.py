@@ -0,0 +1,274 @@
+"""
+Метрики в текстовом формате Prometheus: задержки по маршрутам, запросы к БД,
+ожидание соединения из пула, кэш.
+
+Значения пишутся в шарды, принадлежащие потоку: на горячем пути нет блокировок,
+а /metrics суммирует шарды всех потоков. Каждый воркер uvicorn считает свои метрики.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from sqlalchemy import event
+
+# Границы интервалов гистограмм (в секундах, как принято в Prometheus)
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def add_collector(self, collector):
+        """collector() возвращает список (name, kind, help, [(labels, value), ...])."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        families = [metric.collect() for metric in self._metrics]
+        for collector in self._collectors:
+            families.extend(collector())
+        for name, kind, help_text, samples in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class ShardedMetric:
+    """Основа метрик: у каждого потока свой словарь labels -> значение."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), registry: MetricsRegistry = registry):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        registry.register(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            # Блокировка берётся один раз на поток, при создании его шарда
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _items(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            # list(dict.items()) выполняется без отпускания GIL, поэтому безопасен при записи из другого потока
+            yield from list(shard.items())
+
+    def _labels(self, values: tuple) -> dict:
+        return dict(zip(self.labelnames, values))
+
+
+class Counter(ShardedMetric):
+    kind = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self) -> dict:
+        totals = {}
+        for labels, value in self._items():
+            totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def collect(self):
+        samples = [(self.name, self._labels(labels), value) for labels, value in sorted(self.values().items())]
+        return self.name, self.kind, self.help, samples
+
+
+class Histogram(ShardedMetric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = REQUEST_BUCKETS,
+                 registry: MetricsRegistry = registry):
+        super().__init__(name, help_text, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels: tuple, value: float):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # Счётчики по интервалам (последний — +Inf) и сумма значений в конце
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def values(self) -> dict:
+        totals = {}
+        for labels, counts in self._items():
+            total = totals.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, count in enumerate(counts):
+                total[i] += count
+        return totals
+
+    def collect(self):
+        samples = []
+        for labels, counts in sorted(self.values().items()):
+            label_dict = self._labels(labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", {**label_dict, "le": format_value(float(bound))}, cumulative))
+            samples.append((f"{self.name}_sum", label_dict, counts[-1]))
+            samples.append((f"{self.name}_count", label_dict, cumulative))
+        return self.name, self.kind, self.help, samples
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP-запросы по маршруту и статусу", ("method", "route", "status"))
+HTTP_DURATION = Histogram("http_request_duration_seconds", "Время обработки запроса", ("method", "route"))
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Время запросов к БД за один HTTP-запрос", ("route",), QUERY_BUCKETS)
+REQUEST_DB_QUERIES = Histogram("http_request_db_queries", "Число запросов к БД за один HTTP-запрос", ("route",), COUNT_BUCKETS)
+DB_QUERIES = Counter("db_queries_total", "Запросы к БД по типу", ("operation",))
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "Время выполнения запроса к БД", ("operation",), QUERY_BUCKETS)
+DB_COMMITS = Counter("db_commits_total", "Завершённые транзакции")
+DB_ROLLBACKS = Counter("db_rollbacks_total", "Откаченные транзакции")
+POOL_CHECKOUT_WAIT = Histogram("db_pool_checkout_wait_seconds", "Ожидание соединения из пула", (), QUERY_BUCKETS)
+
+# Счётчики БД текущего HTTP-запроса: [число запросов, секунды]. Контекст копируется
+# в пул потоков, поэтому запросы из run_in_threadpool попадают в тот же список.
+current_request_db: ContextVar = ContextVar("current_request_db", default=None)
+
+OPERATIONS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+
+def query_operation(statement: str) -> str:
+    head = statement.lstrip()[:6].upper()
+    return head if head in OPERATIONS else "OTHER"
+
+
+def instrument_engine(sync_engine):
+    """Подключает к движку учёт запросов, commit и rollback."""
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_started
+        operation = query_operation(statement)
+        DB_QUERIES.inc((operation,))
+        DB_QUERY_DURATION.observe((operation,), elapsed)
+        request_db = current_request_db.get()
+        if request_db is not None:
+            request_db[0] += 1
+            request_db[1] += elapsed
+
+    @event.listens_for(sync_engine, "commit")
+    def commit(conn):
+        DB_COMMITS.inc()
+
+    @event.listens_for(sync_engine, "rollback")
+    def rollback(conn):
+        DB_ROLLBACKS.inc()
+
+
+def timed_pool(pool_class):
+    """Подкласс пула, который измеряет ожидание свободного соединения."""
+
+    class TimedPool(pool_class):
+        # _do_get — место, где пул ждёт соединение (до pool_timeout)
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                POOL_CHECKOUT_WAIT.observe((), time.perf_counter() - started)
+
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
+
+
+def route_label(scope) -> str:
+    # Шаблон маршрута, а не путь: иначе каждый short_code стал бы отдельной серией
+    route = scope.get("route")
+    return getattr(route, "path", None) or "<unmatched>"
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: задержка, статус и время БД для каждого HTTP-запроса."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+        request_db = [0, 0.0]
+        token = current_request_db.set(request_db)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_request_db.reset(token)
+            elapsed = time.perf_counter() - started
+            route = route_label(scope)
+            method = scope["method"]
+            HTTP_REQUESTS.inc((method, route, str(status)))
+            HTTP_DURATION.observe((method, route), elapsed)
+            REQUEST_DB_QUERIES.observe((route,), request_db[0])
+            REQUEST_DB_SECONDS.observe((route,), request_db[1])
+
+
+def stats_collector(prefix: str, stats, counters: tuple, gauges: tuple, help_text: str):
+    """Коллектор для объектов со stats() -> dict (кэш, буферы кликов)."""
+
+    def collect():
+        values = stats()
+        families = []
+        for key in counters:
+            families.append((f"{prefix}_{key}_total", "counter", f"{help_text}: {key}", [(f"{prefix}_{key}_total", {}, values[key])]))
+        for key in gauges:
+            families.append((f"{prefix}_{key}", "gauge", f"{help_text}: {key}", [(f"{prefix}_{key}", {}, values[key])]))
+        return families
+
+    return collect
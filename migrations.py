@@ -0,0 +1,96 @@
+"""
+Версионные миграции схемы БД.
+
+Применяются при старте приложения (если AUTO_MIGRATE включён) или вручную:
+    python migrations.py status
+    python migrations.py upgrade
+"""
+import sys
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+
+def create_tables(*names):
+    """Шаг миграции: создаёт таблицы моделей (если их ещё нет) с учётом диалекта БД."""
+    def step(conn):
+        from sqlstuff import Base
+        Base.metadata.create_all(conn, tables=[Base.metadata.tables[name] for name in names])
+    return step
+
+
+# (версия, описание, шаги). Шаг — SQL-команда или функция от соединения.
+# Шаги должны быть идемпотентными: на новой БД те же объекты уже может
+# создать Base.metadata.create_all.
+MIGRATIONS = [
+    (1, "Индексы links(user_id, created_at, short_code) и links(expires_at)", [
+        "CREATE INDEX IF NOT EXISTS ix_links_user_id_created_at_short_code ON links (user_id, created_at, short_code)",
+        "CREATE INDEX IF NOT EXISTS ix_links_expires_at ON links (expires_at)",
+    ]),
+    (2, "Таблицы click_events и click_rollups для аналитики кликов", [
+        create_tables("click_events", "click_rollups"),
+    ]),
+]
+
+CREATE_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    description VARCHAR NOT NULL,
+    applied_at TIMESTAMP NOT NULL
+)
+"""
+
+
+def applied_versions(bind) -> set[int]:
+    with bind.begin() as conn:
+        conn.execute(text(CREATE_VERSION_TABLE))
+        return set(conn.execute(text("SELECT version FROM schema_version")).scalars())
+
+
+def pending_migrations(bind) -> list:
+    done = applied_versions(bind)
+    return [m for m in MIGRATIONS if m[0] not in done]
+
+
+def upgrade(bind) -> list[int]:
+    """Применяет недостающие миграции по порядку. Возвращает номера применённых."""
+    applied = []
+    for version, description, statements in pending_migrations(bind):
+        try:
+            with bind.begin() as conn:
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(text(statement))
+                conn.execute(
+                    text("INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)"),
+                    {"v": version, "d": description, "t": datetime.utcnow()},
+                )
+        except IntegrityError:
+            # Миграцию одновременно применил другой процесс
+            continue
+        applied.append(version)
+    return applied
+
+
+def main(argv: list[str]) -> int:
+    from sqlstuff import engine
+
+    command = argv[1] if len(argv) > 1 else "status"
+    if command == "status":
+        done = applied_versions(engine)
+        for version, description, _ in MIGRATIONS:
+            mark = "x" if version in done else " "
+            print(f"[{mark}] {version}: {description}")
+        return 0
+    if command == "upgrade":
+        applied = upgrade(engine)
+        print(f"Применено миграций: {len(applied)}" + (f" ({', '.join(map(str, applied))})" if applied else ""))
+        return 0
+    print(f"Неизвестная команда: {command}. Доступны: status, upgrade", file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
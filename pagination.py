@@ -0,0 +1,64 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import select, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlstuff import Link
+
+# Колонки, которые нужны для списков ссылок (без гидрации ORM-объектов)
+LINK_LIST_COLUMNS = (
+    Link.short_code,
+    Link.original_url,
+    Link.clicks,
+    Link.created_at,
+    Link.expires_at,
+    Link.last_accessed_at,
+)
+
+
+def encode_cursor(created_at: datetime, short_code: str) -> str:
+    """Курсор — позиция последней выданной строки в порядке (created_at, short_code)."""
+    raw = json.dumps([created_at.isoformat(), short_code]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    """Разбирает курсор. Некорректный курсор — ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, short_code = json.loads(raw)
+        return datetime.fromisoformat(created_at), str(short_code)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Некорректный курсор") from e
+
+
+def user_links_query(user_id: int, cursor: Optional[str], limit: int):
+    """
+    Keyset-запрос страницы ссылок пользователя, от новых к старым.
+    Выбирается limit + 1 строка, чтобы понять, есть ли следующая страница.
+    """
+    stmt = select(*LINK_LIST_COLUMNS).where(Link.user_id == user_id)
+    if cursor:
+        created_at, short_code = decode_cursor(cursor)
+        stmt = stmt.where(or_(
+            Link.created_at < created_at,
+            and_(Link.created_at == created_at, Link.short_code < short_code),
+        ))
+    return stmt.order_by(Link.created_at.desc(), Link.short_code.desc()).limit(limit + 1)
+
+
+async def fetch_links_page(db: AsyncSession, user_id: int, cursor: Optional[str], limit: int) -> tuple[list, Optional[str]]:
+    """Возвращает строки страницы и курсор следующей страницы (или None)."""
+    rows = (await db.execute(user_links_query(user_id, cursor, limit))).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].short_code)
+    return rows, next_cursor
+
+
+def render_in_chunks(rows, render_row, chunk_rows: int):
+    """Генератор HTML: строки таблицы склеиваются порциями по chunk_rows."""
+    for start in range(0, len(rows), chunk_rows):
+        yield "".join(render_row(row) for row in rows[start:start + chunk_rows])
@@ -0,0 +1,58 @@
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from profiler import run_profiled
+from config import PASSWORD_POOL_WORKERS, PASSWORD_POOL_MAX_QUEUE
+
+
+def run_in_context(context: contextvars.Context, fn, args):
+    # Как run_in_threadpool: задача видит contextvars запроса, а поток виден профайлеру
+    return context.run(run_profiled, fn, *args)
+
+
+class PasswordPoolBusy(Exception):
+    """Пул занят: все потоки работают и очередь заполнена."""
+
+
+class PasswordPool:
+    """
+    Ограниченный пул потоков для bcrypt.
+    Одновременно принимается не больше workers + max_queue задач, остальные
+    сразу получают PasswordPoolBusy, а не ждут в очереди.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    async def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+        try:
+            future = self._get_executor().submit(run_in_context, contextvars.copy_context(), fn, args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+
+password_pool = PasswordPool(PASSWORD_POOL_WORKERS or os.cpu_count() or 1, PASSWORD_POOL_MAX_QUEUE)
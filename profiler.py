@@ -0,0 +1,261 @@
+"""
+Сэмплирующий профайлер отдельных запросов.
+
+Пока идёт хотя бы один профилируемый запрос, фоновый поток раз в PROFILE_INTERVAL
+снимает стеки через sys._current_frames(). Стек потока event loop относится к
+запросу, если сейчас выполняется его задача (или дочерняя — их отмечает фабрика
+задач). Рабочий поток (run_in_threadpool из этого модуля, пул bcrypt) на время
+задачи профилируемого запроса записывает себя в реестр потоков, по нему стек
+и относится к запросу. Сводка хранится в формате
+collapsed stacks ("route;frame;frame N"), который понимают flamegraph.pl и speedscope.
+"""
+import asyncio
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from contextvars import ContextVar
+from starlette.concurrency import run_in_threadpool as starlette_run_in_threadpool
+from metrics import route_label
+from config import PROFILE_INTERVAL, PROFILE_MAX_STACKS, PROFILE_MAX_DEPTH, PROFILE_KEEP_REQUESTS
+
+profiled_request: ContextVar = ContextVar("profiled_request", default=None)
+
+OTHER_STACK = "<other>"
+TOP_STACKS_PER_REQUEST = 20
+
+
+# Рабочие потоки, выполняющие сейчас задачу профилируемого запроса: id потока -> RequestProfile
+_worker_profiles: dict = {}
+
+
+def run_profiled(fn, *args, **kwargs):
+    """
+    Выполняет fn в текущем (рабочем) потоке. Если контекст принадлежит профилируемому
+    запросу, поток на это время записан в реестр, и сэмплер относит его стек к запросу.
+    """
+    profile = profiled_request.get()
+    if profile is None:
+        return fn(*args, **kwargs)
+    thread_id = threading.get_ident()
+    previous = _worker_profiles.get(thread_id)
+    _worker_profiles[thread_id] = profile
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        if previous is None:
+            del _worker_profiles[thread_id]
+        else:
+            _worker_profiles[thread_id] = previous
+
+
+async def run_in_threadpool(fn, *args, **kwargs):
+    """Как starlette.concurrency.run_in_threadpool, но рабочий поток виден профайлеру."""
+    return await starlette_run_in_threadpool(run_profiled, fn, *args, **kwargs)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.samples = Counter()
+
+    def summary(self, route: str, status: int, duration: float) -> dict:
+        return {
+            "route": route,
+            "status": status,
+            "duration_ms": round(duration * 1000, 3),
+            "samples": sum(self.samples.values()),
+            "top_stacks": [
+                {"stack": stack, "samples": count}
+                for stack, count in self.samples.most_common(TOP_STACKS_PER_REQUEST)
+            ],
+        }
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float, max_stacks: int, max_depth: int, keep_requests: int):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._active = set()
+        self._tasks = weakref.WeakKeyDictionary()  # asyncio.Task -> RequestProfile
+        self._loops = weakref.WeakKeyDictionary()  # event loop -> id его потока
+        self._aggregate = Counter()
+        self._recent = deque(maxlen=keep_requests)
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.requests_profiled = 0
+        self.samples_taken = 0
+
+    def begin(self) -> tuple[RequestProfile, contextvars.Token]:
+        """Начинает профилирование текущего запроса; вызывается из его задачи."""
+        profile = RequestProfile()
+        token = profiled_request.set(profile)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._install_task_factory(loop)
+            self._tasks[asyncio.current_task()] = profile
+            self._active.add(profile)
+        self._ensure_started()
+        self._wakeup.set()
+        return profile, token
+
+    def end(self, profile: RequestProfile, token: contextvars.Token, route: str, status: int):
+        profiled_request.reset(token)
+        duration = time.perf_counter() - profile.started
+        with self._lock:
+            self._active.discard(profile)
+            for stack, count in profile.samples.items():
+                key = f"{route};{stack}"
+                if key not in self._aggregate and len(self._aggregate) >= self.max_stacks:
+                    key = f"{route};{OTHER_STACK}"
+                self._aggregate[key] += count
+            self._recent.append(profile.summary(route, status, duration))
+            self.requests_profiled += 1
+
+    def collapsed(self, route: str | None = None) -> str:
+        """Сводка в формате collapsed stacks, по строке на стек."""
+        with self._lock:
+            items = sorted(self._aggregate.items())
+        prefix = f"{route};" if route else ""
+        return "".join(f"{stack} {count}\n" for stack, count in items if stack.startswith(prefix))
+
+    def recent(self) -> list[dict]:
+        with self._lock:
+            return list(self._recent)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests_profiled": self.requests_profiled,
+                "samples_taken": self.samples_taken,
+                "stacks": len(self._aggregate),
+                "active": len(self._active),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._aggregate.clear()
+            self._recent.clear()
+
+    def _install_task_factory(self, loop):
+        # Вызывается под блокировкой. Дочерние задачи запроса (например, потоковая
+        # отдача ответа) наследуют contextvars, по ним фабрика и относит их к запросу.
+        if loop in self._loops:
+            return
+        previous = loop.get_task_factory()
+
+        def task_factory(loop, coro, **kwargs):
+            if previous is not None:
+                task = previous(loop, coro, **kwargs)
+            else:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            profile = profiled_request.get()
+            if profile is not None:
+                self._tasks[task] = profile
+            return task
+
+        loop.set_task_factory(task_factory)
+        self._loops[loop] = threading.get_ident()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._active
+            if idle:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            self._sample_once()
+            time.sleep(self.interval)
+
+    def _sample_once(self):
+        frames = sys._current_frames()
+        with self._lock:
+            active = set(self._active)
+            loops = list(self._loops.items())
+        if not active:
+            return
+        taken = []
+        loop_threads = set()
+        for loop, thread_id in loops:
+            loop_threads.add(thread_id)
+            task = asyncio.current_task(loop)
+            profile = self._tasks.get(task) if task is not None else None
+            if profile in active and thread_id in frames:
+                taken.append((profile, self._collapse(frames[thread_id])))
+        workers = _worker_profiles.copy()
+        if workers:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, profile in workers.items():
+                if profile in active and thread_id in frames and thread_id not in loop_threads:
+                    taken.append((profile, f"[{thread_names.get(thread_id, thread_id)}];{self._collapse(frames[thread_id])}"))
+        with self._lock:
+            # Запрос мог закончиться, пока снимались стеки: его сводка уже записана в end()
+            for profile, stack in taken:
+                if profile in self._active:
+                    profile.samples[stack] += 1
+                    self.samples_taken += 1
+
+    def _collapse(self, frame) -> str:
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+
+class ProfilingMiddleware:
+    """
+    Профилирует долю запросов sample_rate, а также запросы с заголовком X-Profile,
+    если authorize(значение заголовка) подтверждает право администратора.
+    """
+
+    def __init__(self, app, profiler: SamplingProfiler, sample_rate: float, authorize):
+        self.app = app
+        self.profiler = profiler
+        self.sample_rate = sample_rate
+        self.authorize = authorize
+
+    def should_profile(self, scope) -> bool:
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return True
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                return self.authorize(value.decode("latin-1"))
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        profile, token = self.profiler.begin()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.profiler.end(profile, token, route_label(scope), status)
+
+
+request_profiler = SamplingProfiler(PROFILE_INTERVAL, PROFILE_MAX_STACKS, PROFILE_MAX_DEPTH, PROFILE_KEEP_REQUESTS)
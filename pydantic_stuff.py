@@ -16,6 +16,34 @@ class LinkStats(BaseModel):
     clicks: int
     last_accessed_at: datetime | None
 
+class LinkListItem(BaseModel):
+    short_code: str
+    original_url: str
+    clicks: int
+    created_at: datetime
+    expires_at: datetime | None
+    last_accessed_at: datetime | None
+
+class LinkPage(BaseModel):
+    items: list[LinkListItem]
+    next_cursor: str | None = Field(None, description="Курсор следующей страницы, None — страница последняя")
+
+class TimeseriesPoint(BaseModel):
+    bucket_start: datetime
+    clicks: int
+
+class LinkTimeseries(BaseModel):
+    short_code: str
+    granularity: str
+    start: datetime
+    end: datetime
+    points: list[TimeseriesPoint]
+
+
+class CurrentUser(BaseModel):
+    """Лёгкая, не привязанная к сессии запись об авторизованном пользователе."""
+    id: int
+    username: str
 
 class UserCreate(BaseModel):
     username: str
@@ -0,0 +1,231 @@
+"""
+Ограничение частоты запросов: token bucket на каждого клиента.
+
+У каждого ключа (IP или пользователь) — ведро на limit запросов, которое равномерно
+наполняется за period секунд. Состояние ключа — два числа, активные ключи
+хранятся в LRU: самые давно не обращавшиеся вытесняются, когда их больше max_keys.
+Решение принимается до разбора пользователя и без обращения к БД; отказ — 429
+с Retry-After. При RATE_LIMIT_BACKEND=redis вёдра общие для всех воркеров.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from fastapi import HTTPException
+from starlette.requests import HTTPConnection
+from cache import get_cache_async
+from profiler import run_in_threadpool
+from config import (
+    RATE_LIMIT_ENABLED, RATE_LIMIT_BACKEND, RATE_LIMIT_KEY, RATE_LIMIT_MAX_KEYS, REDIS_URL,
+    RATE_LIMIT_CREATE, RATE_LIMIT_LOGIN, RATE_LIMIT_REGISTER, RATE_LIMIT_REDIRECT, RATE_LIMIT_BULK,
+)
+
+RATE_LIMITED_DETAIL = "Слишком много запросов. Повторите позже."
+
+PERIODS = {"second": 1, "s": 1, "minute": 60, "m": 60, "hour": 3600, "h": 3600}
+
+
+class RateLimit(NamedTuple):
+    limit: int
+    period: float
+
+    @property
+    def rate(self) -> float:
+        return self.limit / self.period
+
+
+def parse_rate_limit(value: str) -> Optional[RateLimit]:
+    """'60/minute' -> RateLimit(60, 60). Пустая строка — без ограничения."""
+    if not value:
+        return None
+    count, _, period = value.partition("/")
+    if period not in PERIODS or int(count) <= 0:
+        raise ValueError(f"Неверный лимит {value!r}: ожидается N/second, N/minute или N/hour")
+    return RateLimit(int(count), PERIODS[period])
+
+
+class TokenBucketLimiter:
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def acquire(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        """Списывает cost токенов. Возвращает 0, если запрос разрешён, иначе — сколько секунд ждать."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(limit.limit), now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(limit.limit, bucket[0] + (now - bucket[1]) * limit.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return 0.0
+            self.rejected += 1
+            return (cost - bucket[0]) / limit.rate
+
+    async def acquire_async(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        # Ведро в памяти: микросекунды под блокировкой, поток не нужен
+        return self.acquire(key, limit, cost)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+                "evictions": self.evictions,
+                "keys": len(self._buckets),
+                "errors": 0,
+            }
+
+
+# Ведро целиком в Redis: пополнение и списание в одном скрипте, время — с сервера Redis
+TOKEN_BUCKET_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or limit
+local updated = tonumber(state[2]) or now
+tokens = math.min(limit, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(limit / rate * 1000))
+return tostring(wait)
+"""
+
+
+class RedisTokenBucketLimiter:
+    """
+    Общие для воркеров вёдра в Redis; ключи истекают сами, когда ведро снова полное.
+    Если Redis недоступен, решение принимает локальное ведро процесса.
+    """
+
+    def __init__(self, url: str, max_keys: int, prefix: str = "ratelimit:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("Для RATE_LIMIT_BACKEND=redis нужен пакет redis (pip install redis)") from e
+        self._redis_errors = (redis.RedisError,)
+        client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._fallback = TokenBucketLimiter(max_keys)
+        self.prefix = prefix
+        self.allowed = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def acquire(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        try:
+            wait = float(self._script(keys=[self.prefix + key], args=[limit.limit, limit.rate, cost]))
+        except self._redis_errors:
+            self.errors += 1
+            return self._fallback.acquire(key, limit, cost)
+        if wait > 0:
+            self.rejected += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    async def acquire_async(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        # Запрос к Redis (до socket_timeout при его недоступности) — в пуле потоков, а не в event loop
+        return await run_in_threadpool(self.acquire, key, limit, cost)
+
+    def stats(self) -> dict:
+        fallback = self._fallback.stats()
+        return {
+            "allowed": self.allowed + fallback["allowed"],
+            "rejected": self.rejected + fallback["rejected"],
+            "evictions": fallback["evictions"],
+            "keys": fallback["keys"],
+            "errors": self.errors,
+        }
+
+
+def create_limiter(backend: str = RATE_LIMIT_BACKEND):
+    if backend == "redis":
+        return RedisTokenBucketLimiter(REDIS_URL, RATE_LIMIT_MAX_KEYS)
+    if backend == "local":
+        return TokenBucketLimiter(RATE_LIMIT_MAX_KEYS)
+    raise ValueError(f"Неизвестный RATE_LIMIT_BACKEND: {backend!r}")
+
+
+rate_limiter = create_limiter()
+
+RATE_LIMITS = {
+    "create": parse_rate_limit(RATE_LIMIT_CREATE),
+    "login": parse_rate_limit(RATE_LIMIT_LOGIN),
+    "register": parse_rate_limit(RATE_LIMIT_REGISTER),
+    "redirect": parse_rate_limit(RATE_LIMIT_REDIRECT),
+    # Массовое создание: списывается по токену на каждую ссылку в запросе
+    "bulk": parse_rate_limit(RATE_LIMIT_BULK),
+}
+
+
+async def client_key(conn: HTTPConnection) -> str:
+    """
+    Ключ клиента. По умолчанию — IP. С RATE_LIMIT_KEY=user — id пользователя, если его
+    токен уже проверен и лежит в кэше (запрос к БД ради лимита не делаем). Непроверенный
+    токен ключом не служит: иначе новый выдуманный токен давал бы новое полное ведро.
+    """
+    if RATE_LIMIT_KEY in ("user", "token"):
+        authorization = conn.headers.get("authorization", "")
+        token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else conn.cookies.get("token")
+        if token:
+            user = await get_cache_async(f"user_token_{token}")
+            if user is not None:
+                return f"user:{user.id}"
+    return f"ip:{conn.client.host if conn.client else 'unknown'}"
+
+
+async def retry_after(policy: str, conn: HTTPConnection, cost: float = 1.0) -> float:
+    """0, если запрос укладывается в лимит policy, иначе — сколько секунд ждать."""
+    limit = RATE_LIMITS.get(policy)
+    if not RATE_LIMIT_ENABLED or limit is None:
+        return 0.0
+    if cost > limit.limit:
+        # Столько токенов ведро не накопит никогда: ждать бесполезно
+        raise HTTPException(status_code=413, detail=f"Не больше {limit.limit} операций за запрос.")
+    return await rate_limiter.acquire_async(f"{policy}:{await client_key(conn)}", limit, cost)
+
+
+def retry_after_header(wait: float) -> str:
+    return str(max(1, math.ceil(wait)))
+
+
+async def enforce_rate_limit(policy: str, conn: HTTPConnection, cost: float = 1.0):
+    """429 с Retry-After, если клиент превысил лимит policy."""
+    wait = await retry_after(policy, conn, cost)
+    if wait > 0:
+        raise HTTPException(
+            status_code=429,
+            detail=RATE_LIMITED_DETAIL,
+            headers={"Retry-After": retry_after_header(wait)},
+        )
+
+
+def rate_limit(policy: str):
+    """Зависимость FastAPI: лимит policy по одному токену на запрос."""
+
+    async def dependency(conn: HTTPConnection):
+        await enforce_rate_limit(policy, conn)
+
+    return dependency
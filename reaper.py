@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete
+from sqlstuff import engine, Link
+from clicks import click_aggregator
+from analytics import click_events, analytics_delete_statements
+from cache import invalidate_links_cache
+from config import REAPER_INTERVAL, REAPER_BATCH_SIZE, REAPER_BATCH_PAUSE, REAPER_GRACE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiredLinkReaper:
+    """
+    Фоновое удаление истёкших ссылок небольшими пачками по индексу expires_at.
+    Каждая пачка — отдельная короткая транзакция, между пачками поток делает паузу,
+    чтобы не держать блокировку записи SQLite и не задерживать редиректы.
+    """
+
+    def __init__(self, bind, interval: float, batch_size: int, batch_pause: float, grace_seconds: int):
+        self.bind = bind
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.grace = timedelta(seconds=grace_seconds)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.rows_reaped = 0
+        self.batches = 0
+        self.seconds_spent = 0.0
+        self.max_batch_seconds = 0.0
+        self.errors = 0
+        self.last_run_at = None
+        self.last_run_rows = 0
+
+    def reap_batch(self, now: datetime | None = None) -> list[str]:
+        """Удаляет одну пачку ссылок, истёкших раньше now - grace. Возвращает их коды."""
+        cutoff = (now or datetime.utcnow()) - self.grace
+        table = Link.__table__
+        started = time.perf_counter()
+        with self.bind.begin() as conn:
+            codes = conn.execute(
+                select(table.c.short_code)
+                .where(table.c.expires_at < cutoff)
+                .order_by(table.c.expires_at)
+                .limit(self.batch_size)
+            ).scalars().all()
+            if codes:
+                # Вместе со ссылками — их события и агрегаты кликов
+                click_events.discard(codes)
+                for statement in analytics_delete_statements(codes):
+                    conn.execute(statement)
+                conn.execute(delete(table).where(table.c.short_code.in_(codes)))
+        elapsed = time.perf_counter() - started
+        invalidate_links_cache(codes)
+        for short_code in codes:
+            click_aggregator.discard(short_code)
+        with self._lock:
+            self.batches += 1
+            self.rows_reaped += len(codes)
+            self.seconds_spent += elapsed
+            self.max_batch_seconds = max(self.max_batch_seconds, elapsed)
+        return codes
+
+    def run_once(self, now: datetime | None = None) -> int:
+        """Удаляет все истёкшие ссылки пачками. Возвращает число удалённых строк."""
+        total = 0
+        while not self._stop.is_set():
+            reaped = len(self.reap_batch(now))
+            total += reaped
+            if reaped < self.batch_size:
+                break
+            self._stop.wait(self.batch_pause)
+        with self._lock:
+            self.last_run_at = datetime.utcnow()
+            self.last_run_rows = total
+        return total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rows_reaped": self.rows_reaped,
+                "batches": self.batches,
+                "seconds_spent": round(self.seconds_spent, 6),
+                "max_batch_seconds": round(self.max_batch_seconds, 6),
+                "errors": self.errors,
+                "last_run_at": self.last_run_at,
+                "last_run_rows": self.last_run_rows,
+            }
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="expired-link-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                logger.exception("Ошибка при удалении истёкших ссылок")
+
+
+link_reaper = ExpiredLinkReaper(engine, REAPER_INTERVAL, REAPER_BATCH_SIZE, REAPER_BATCH_PAUSE, REAPER_GRACE_SECONDS)
@@ -0,0 +1,75 @@
+"""
+Шаблоны HTML-страниц.
+
+Template разбирает шаблон с полями {name} один раз при импорте: render() только
+склеивает готовые куски со значениями. StaticPage хранит уже отрисованную страницу
+в байтах вместе с ETag и отвечает 304 на совпадающий If-None-Match.
+"""
+import hashlib
+from string import Formatter
+from typing import Optional
+from fastapi import Request
+from fastapi.responses import Response
+
+HTML_MEDIA_TYPE = "text/html; charset=utf-8"
+
+
+class Template:
+    def __init__(self, source: str):
+        # Чередование: literal, field, literal, field, ..., literal
+        self.literals = []
+        self.fields = []
+        pending = ""
+        for literal, field, _, _ in Formatter().parse(source):
+            pending += literal
+            if field is not None:
+                self.literals.append(pending)
+                self.fields.append(field)
+                pending = ""
+        self.literals.append(pending)
+
+    def render(self, **values) -> str:
+        parts = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            parts.append(str(values[field]))
+            parts.append(literal)
+        return "".join(parts)
+
+    def render_parts(self, split_field: str, **values) -> tuple[str, str]:
+        """Отрисовывает шаблон до поля split_field и после него — для потоковой отдачи."""
+        marker = "\x00"
+        head, tail = self.render(**values, **{split_field: marker}).split(marker)
+        return head, tail
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Слабое сравнение: W/"x" совпадает с "x"
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
+
+
+def not_modified(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
+
+
+class StaticPage:
+    """Страница, которая не зависит от запроса: отрисовывается один раз."""
+
+    def __init__(self, html: str, cache_control: str, vary: Optional[str] = None):
+        self.body = html.encode("utf-8")
+        self.etag = make_etag(self.body)
+        self.headers = {"ETag": self.etag, "Cache-Control": cache_control}
+        if vary:
+            self.headers["Vary"] = vary
+
+    def response(self, request: Request) -> Response:
+        if etag_matches(request.headers.get("if-none-match"), self.etag):
+            return not_modified(self.headers)
+        return Response(content=self.body, media_type=HTML_MEDIA_TYPE, headers=self.headers)
@@ -1,13 +1,112 @@
-from sqlalchemy import Column, String, Integer, DateTime, create_engine, ForeignKey
+from contextlib import asynccontextmanager
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, create_engine, ForeignKey, Index, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from starlette.requests import HTTPConnection
+from collections import OrderedDict
 from datetime import datetime
+from typing import Optional
+import threading
+import time
+from config import (
+    DB_MODE, DB_PROFILE, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+    SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, SQLITE_BUSY_TIMEOUT_MS,
+    DATABASE_URL, ASYNC_DATABASE_URL, DATABASE_REPLICA_URL, ASYNC_DATABASE_REPLICA_URL,
+    REPLICA_READ_AFTER_WRITE_SECONDS, REPLICA_READ_AFTER_WRITE_MAX_CLIENTS,
+)
+from metrics import instrument_engine, timed_pool
+from profiler import run_in_threadpool
 
-DATABASE_URL = "sqlite:///./links_db.sqlite"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# Асинхронные драйверы для DB_MODE=async, если URL задан без драйвера
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    return ASYNC_DRIVERS.get(scheme.split("+")[0], scheme) + sep + rest
+
+
+def sqlite_pragmas(profile: str) -> list[str]:
+    """PRAGMA, которые выполняются на каждом новом соединении SQLite."""
+    if profile == "production":
+        return [
+            # WAL: читатели не ждут писателя, а писатель не ждёт читателей
+            "PRAGMA journal_mode=WAL",
+            # В WAL режим NORMAL не теряет целостность, но убирает fsync на каждый commit
+            "PRAGMA synchronous=NORMAL",
+            f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}",
+            f"PRAGMA cache_size={SQLITE_CACHE_SIZE}",
+            f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+            "PRAGMA temp_store=MEMORY",
+        ]
+    if profile == "default":
+        return []
+    raise ValueError(f"Неизвестный DB_PROFILE: {profile!r} (ожидается 'default' или 'production')")
+
+
+def create_app_engine(url: str, profile: str = DB_PROFILE, async_mode: bool = False):
+    """Создаёт движок SQLAlchemy с настройками выбранного профиля."""
+    pragmas = sqlite_pragmas(profile)
+    options = {}
+    is_sqlite = url.startswith("sqlite")
+    if is_sqlite and not async_mode:
+        options["connect_args"] = {"check_same_thread": False}
+    if ":memory:" not in url:
+        options.update(
+            poolclass=timed_pool(AsyncAdaptedQueuePool if async_mode else QueuePool),
+            pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+        )
+    if async_mode:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        new_engine = create_async_engine(url, **options)
+        sync_engine = new_engine.sync_engine
+    else:
+        new_engine = sync_engine = create_engine(url, **options)
+    instrument_engine(sync_engine)
+    if is_sqlite and pragmas:
+        @event.listens_for(sync_engine, "connect")
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+    return new_engine
+
+
+engine = create_app_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Реплика для чтения (необязательна). Без неё все чтения идут в основную БД.
+replica_engine = create_app_engine(DATABASE_REPLICA_URL) if DATABASE_REPLICA_URL else None
+ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine) if replica_engine else None
+
+# Асинхронные движки создаются только в режиме DB_MODE=async (нужен aiosqlite/asyncpg)
+if DB_MODE == "async":
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    async_engine = create_app_engine(ASYNC_DATABASE_URL or to_async_url(DATABASE_URL), async_mode=True)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    if DATABASE_REPLICA_URL:
+        async_replica_engine = create_app_engine(
+            ASYNC_DATABASE_REPLICA_URL or to_async_url(DATABASE_REPLICA_URL), async_mode=True
+        )
+        AsyncReplicaSessionLocal = async_sessionmaker(async_replica_engine, autoflush=False, expire_on_commit=False)
+    else:
+        async_replica_engine = None
+        AsyncReplicaSessionLocal = None
+elif DB_MODE == "sync":
+    async_engine = None
+    AsyncSessionLocal = None
+    async_replica_engine = None
+    AsyncReplicaSessionLocal = None
+else:
+    raise ValueError(f"Неизвестный DB_MODE: {DB_MODE!r} (ожидается 'sync' или 'async')")
+
 
 
 class User(Base):
@@ -29,12 +128,263 @@ class Link(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     user = relationship("User")
 
+    # Для существующих БД эти индексы добавляет миграция 1 (migrations.py)
+    __table_args__ = (
+        Index("ix_links_user_id_created_at_short_code", "user_id", "created_at", "short_code"),
+        Index("ix_links_expires_at", "expires_at"),
+    )
+
+
+class CodeSequence(Base):
+    """Счётчик для генерации коротких кодов: процессы резервируют из него блоки id."""
+    __tablename__ = "code_sequences"
+    name = Column(String, primary_key=True)
+    next_value = Column(BigInteger, nullable=False)
+
+
+class ClickEvent(Base):
+    """Сырые события кликов. Таблица только дополняется; для отчётов есть ClickRollup."""
+    __tablename__ = "click_events"
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    short_code = Column(String, nullable=False)
+    occurred_at = Column(DateTime, nullable=False)
+    referrer = Column(String, nullable=True)
+    ua_family = Column(String, nullable=True)
+    country = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ix_click_events_short_code_occurred_at", "short_code", "occurred_at"),
+    )
+
+
+class ClickRollup(Base):
+    """Число кликов по ссылке за минуту, час или день (granularity), начиная с bucket_start."""
+    __tablename__ = "click_rollups"
+    short_code = Column(String, primary_key=True)
+    granularity = Column(String, primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    clicks = Column(Integer, nullable=False, default=0)
+
 Base.metadata.create_all(bind=engine)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+class ThreadedSession:
+    """
+    Синхронная сессия с интерфейсом AsyncSession.
+    Каждое обращение к БД выполняется в пуле потоков, поэтому не блокирует event loop.
+    """
+
+    def __init__(self, sync_session: Session):
+        self.sync_session = sync_session
+
+    @property
+    def info(self) -> dict:
+        return self.sync_session.info
+
+    def _execute(self, statement, params=None, **kwargs):
+        result = self.sync_session.execute(statement, params, **kwargs)
+        # Строки выбираются целиком в рабочем потоке, как это делает AsyncSession
+        if not getattr(result, "returns_rows", True):
+            return result
+        return result.freeze()()
+
+    async def execute(self, statement, params=None, **kwargs):
+        return await run_in_threadpool(self._execute, statement, params, **kwargs)
+
+    async def scalar(self, statement, params=None, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, statement, params, **kwargs)
+
+    async def scalars(self, statement, params=None, **kwargs):
+        result = await self.execute(statement, params, **kwargs)
+        return result.scalars()
+
+    async def get(self, entity, ident, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, entity, ident, **kwargs)
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def flush(self):
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def refresh(self, instance):
+        await run_in_threadpool(self.sync_session.refresh, instance)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+
+class ReadRouter:
+    """
+    Выбирает, откуда читать: из реплики или из основной БД.
+    Клиент, который только что изменил данные, некоторое время читает из основной БД,
+    чтобы отставание реплики не прятало его собственные изменения. Остальные клиенты
+    при этом продолжают читать из реплики.
+    """
+
+    def __init__(self, primary, replica, read_after_write: float, max_clients: int = 100_000):
+        self.primary = primary
+        self.replica = replica
+        self.read_after_write = read_after_write
+        self.max_clients = max_clients
+        self._last_write = OrderedDict()  # клиент -> время последней записи, от старых к новым
+        self._lock = threading.Lock()
+
+    def mark_write(self, client: Optional[str]):
+        if client is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._last_write[client] = now
+            self._last_write.move_to_end(client)
+            # Отметки старше окна уже ни на что не влияют
+            while self._last_write and (
+                len(self._last_write) > self.max_clients
+                or now - next(iter(self._last_write.values())) >= self.read_after_write
+            ):
+                self._last_write.popitem(last=False)
+
+    def recently_written(self, client: Optional[str]) -> bool:
+        if client is None:
+            return False
+        with self._lock:
+            written_at = self._last_write.get(client)
+        return written_at is not None and time.monotonic() - written_at < self.read_after_write
+
+    def session_factory(self, read_only: bool, client: Optional[str] = None):
+        if read_only and self.replica is not None and not self.recently_written(client):
+            return self.replica
+        return self.primary
+
+
+if DB_MODE == "async":
+    read_router = ReadRouter(
+        AsyncSessionLocal, AsyncReplicaSessionLocal, REPLICA_READ_AFTER_WRITE_SECONDS, REPLICA_READ_AFTER_WRITE_MAX_CLIENTS
+    )
+else:
+    read_router = ReadRouter(
+        SessionLocal, ReplicaSessionLocal, REPLICA_READ_AFTER_WRITE_SECONDS, REPLICA_READ_AFTER_WRITE_MAX_CLIENTS
+    )
+
+
+def read_client_key(conn: HTTPConnection) -> str:
+    """
+    Клиент для read-your-writes: токен из заголовка или cookie, иначе IP.
+    Токен здесь не проверяется: чужой или выдуманный токен только отправит
+    чтения своего же запроса в основную БД.
+    """
+    authorization = conn.headers.get("authorization", "")
+    token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else conn.cookies.get("token")
+    if token:
+        return f"token:{token}"
+    return f"ip:{conn.client.host if conn.client else 'unknown'}"
+
+
+# Сессия, изменившая данные, после commit переключает чтения своего клиента на основную БД
+@event.listens_for(Session, "after_flush")
+def _remember_flush(session, flush_context):
+    session.info["has_writes"] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _remember_dml(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["has_writes"] = True
+
+@event.listens_for(Session, "after_commit")
+def _mark_write(session):
+    if session.info.pop("has_writes", False):
+        read_router.mark_write(session.info.get("client"))
+
+@event.listens_for(Session, "after_rollback")
+def _forget_writes(session):
+    session.info.pop("has_writes", None)
+
+
+@asynccontextmanager
+async def open_session(read_only: bool = False, client: Optional[str] = None):
+    """
+    Открывает сессию БД в режиме, выбранном через DB_MODE.
+    read_only=True разрешает читать из реплики (если она настроена и client
+    ничего не записывал в последние REPLICA_READ_AFTER_WRITE_SECONDS секунд).
+    """
+    factory = read_router.session_factory(read_only, client)
+    if DB_MODE == "async":
+        async with factory() as db:
+            db.info["replica"] = factory is not read_router.primary
+            db.info["client"] = client
+            yield db
+    else:
+        db = ThreadedSession(factory(expire_on_commit=False))
+        db.info["replica"] = factory is not read_router.primary
+        db.info["client"] = client
+        try:
+            yield db
+        finally:
+            await db.close()
+
+
+async def first_with_fallback(db, statement, fresh: bool = False):
+    """
+    Возвращает первую строку запроса. Если читали из реплики и ничего не нашли,
+    перепроверяем в основной БД: реплика могла ещё не получить свежую запись.
+    fresh=True читает сразу из основной БД: строку недавно меняли, и реплика
+    могла бы вернуть её старую версию.
+    """
+    if fresh and db.info.get("replica"):
+        async with open_session() as primary_db:
+            return (await primary_db.execute(statement)).first()
+    row = (await db.execute(statement)).first()
+    if row is None and db.info.get("replica"):
+        async with open_session() as primary_db:
+            row = (await primary_db.execute(statement)).first()
+    return row
+
+
+class CoreReader:
+    """
+    Замена сессии для горячих запросов на чтение: Core-запрос выполняется прямо
+    на соединении из пула, без ORM-сессии и её событий. Для resolve_link и
+    first_with_fallback выглядит как сессия (execute, info).
+    """
+
+    def __init__(self, read_only: bool = True, client: Optional[str] = None):
+        factory = read_router.session_factory(read_only, client)
+        self.info = {"replica": factory is not read_router.primary, "client": client}
+        # Движок, к которому привязана фабрика сессий (основная БД или реплика)
+        self.bind = factory.kw["bind"]
+
+    def _execute(self, statement, params=None):
+        with self.bind.connect() as conn:
+            return conn.execute(statement, params).freeze()()
+
+    async def execute(self, statement, params=None):
+        if DB_MODE == "async":
+            async with self.bind.connect() as conn:
+                return (await conn.execute(statement, params)).freeze()()
+        return await run_in_threadpool(self._execute, statement, params)
+
+
+async def get_db(conn: HTTPConnection):
+    async with open_session(client=read_client_key(conn)) as db:
+        yield db
+
+
+async def get_read_db(conn: HTTPConnection):
+    """Сессия только для чтения: реплика, если она есть и этот клиент недавно ничего не записывал."""
+    async with open_session(read_only=True, client=read_client_key(conn)) as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -1,9 +1,36 @@
 import time
+import json
+import asyncio
+import threading
 import pytest
+from collections import OrderedDict
 from fastapi.testclient import TestClient
 
 from main import app
-from cache import set_cache, get_cache, delete_cache, cache_store
+from cache import set_cache, get_cache, delete_cache, cache_store, cache_tier, recent_invalidations, LRUCache, TieredCache, InMemorySharedBackend
+from clicks import click_aggregator
+from analytics import click_events, ua_family
+from sqlstuff import SessionLocal, Link, Base, engine, ClickEvent, ClickRollup
+from sqlalchemy import event, create_engine, select, func
+from datetime import datetime
+from password_pool import PasswordPool, PasswordPoolBusy
+from uuid_stuff import SequenceCodeGenerator, id_to_code, CODE_SPACE
+from migrations import upgrade, pending_migrations
+from pagination import user_links_query, encode_cursor
+from reaper import ExpiredLinkReaper
+import handlers.admin
+import csv
+import gzip
+import io
+from export import Export
+from benchmarks.endpoints import compare
+from metrics import Histogram, MetricsRegistry
+from config import METRICS_ENABLED
+import sqlstuff
+import fast_redirect
+import ratelimit
+from ratelimit import TokenBucketLimiter, RateLimit
+from sqlalchemy.orm import sessionmaker
 
 # client = TestClient(app)
 
@@ -162,3 +189,1091 @@ def test_cache_functions():
     assert get_cache("key2") == "value2"
     delete_cache("key2")
     assert get_cache("key2") is None
+
+def test_clicks_are_buffered_and_flushed():
+    """
+    Проверяем, что клики копятся в памяти и записываются в БД пачкой.
+    """
+    unique_alias = f"clicks_{int(time.time()*1000)}"
+    response = client.post(
+        "/links/shorten",
+        json={"original_url": "https://clicks.com", "custom_alias": unique_alias, "expires_at": None}
+    )
+    assert response.status_code == 201
+
+    for _ in range(3):
+        assert client.get(f"/links/{unique_alias}", follow_redirects=False).status_code == 302
+
+    # Несброшенные клики уже видны в статистике
+    stats = client.get(f"/links/{unique_alias}/stats").json()
+    assert stats["clicks"] == 3
+    assert stats["last_accessed_at"] is not None
+
+    click_aggregator.flush()
+    assert click_aggregator.pending(unique_alias) == (0, None)
+    with SessionLocal() as db:
+        link = db.query(Link).filter(Link.short_code == unique_alias).first()
+        assert link.clicks == 3
+        assert link.last_accessed_at is not None
+
+def test_redirect_cache_hits_and_invalidation():
+    """
+    Проверяем кэш редиректов: негативное кэширование, нулевые запросы и инвалидацию.
+    """
+    headers = authenticate_user("redirect_user", "redirect_password")
+    unique_alias = f"redirect_{int(time.time()*1000)}"
+
+    # Неизвестный код кэшируется как отсутствующий
+    assert client.get(f"/links/{unique_alias}", follow_redirects=False).status_code == 404
+
+    # Создание ссылки сбрасывает негативную запись
+    response = client.post(
+        "/links/shorten",
+        json={"original_url": "https://redirect.com", "custom_alias": unique_alias, "expires_at": None},
+        headers=headers
+    )
+    assert response.status_code == 201
+    assert client.get(f"/links/{unique_alias}", follow_redirects=False).status_code == 302
+
+    # Повторный редирект обслуживается из кэша без запросов к БД
+    # (фоновый сброс кликов делает UPDATE, поэтому считаем только SELECT)
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        response_redirect = client.get(f"/links/{unique_alias}", follow_redirects=False)
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert response_redirect.status_code == 302
+    assert response_redirect.headers["location"].rstrip("/") == "https://redirect.com"
+    assert [st for st in statements if st.lstrip().upper().startswith("SELECT")] == []
+
+    # Обновление ссылки сбрасывает кэш редиректа
+    client.put(f"/links/{unique_alias}", json={"original_url": "https://redirect2.com"}, headers=headers)
+    response_redirect = client.get(f"/links/{unique_alias}", follow_redirects=False)
+    assert response_redirect.headers["location"].rstrip("/") == "https://redirect2.com"
+
+    # Удаление тоже
+    client.delete(f"/links/{unique_alias}", headers=headers)
+    assert client.get(f"/links/{unique_alias}", follow_redirects=False).status_code == 404
+
+def test_lru_cache_eviction_and_counters():
+    """
+    Проверяем вытеснение LRU, лимит по объёму, фоновую очистку и счётчики кэша.
+    """
+    cache = LRUCache(max_entries=2, max_bytes=10_000, sweep_interval=0)
+    cache.set("a", 1, ttl=60)
+    cache.set("b", 2, ttl=60)
+    assert cache.get("a") == 1  # "a" становится самой свежей записью
+    cache.set("c", 3, ttl=60)  # вытесняется "b"
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+
+    cache.set("big", "x" * 20_000, ttl=60)  # не помещается в лимит по объёму
+    assert "big" not in cache
+    assert "c" in cache
+    assert cache.stats()["bytes"] <= 10_000
+
+    cache.set("short", "v", ttl=0)
+    assert cache.sweep() == 1
+    assert "short" not in cache
+
+def test_password_pool_rejects_when_saturated():
+    """
+    Проверяем, что переполненный пул bcrypt сразу отказывает, а не ставит задачу в очередь.
+    """
+    pool = PasswordPool(workers=1, max_queue=0)
+    release = threading.Event()
+
+    async def scenario():
+        busy = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0.05)
+        with pytest.raises(PasswordPoolBusy):
+            await pool.run(lambda: None)
+        release.set()
+        assert await busy is True
+        # После освобождения слота пул снова принимает задачи
+        assert await pool.run(lambda x: x * 2, 21) == 42
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        release.set()
+        pool.shutdown()
+
+def test_current_user_is_cached():
+    """
+    Проверяем, что на тёплом кэше авторизованные страницы не запрашивают таблицу users.
+    """
+    headers = authenticate_user("cached_user", "cached_password")
+    assert client.get("/dashboard", headers=headers).status_code == 200
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        for path in ("/dashboard", "/create", "/stats_page"):
+            assert client.get(path, headers=headers).status_code == 200
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert [st for st in statements if "FROM users" in st] == []
+
+    # Неизвестный токен по-прежнему отклоняется
+    response = client.put("/links/whatever", json={"original_url": "https://x.com"}, headers={"Authorization": "Bearer no_such_user_token"})
+    assert response.status_code == 401
+
+def test_sequence_code_generator_never_collides(tmp_path):
+    """
+    Проверяем, что генераторы с общим счётчиком выдают непересекающиеся коды блоками.
+    """
+    test_engine = create_engine(f"sqlite:///{tmp_path / 'codes.sqlite'}")
+    Base.metadata.create_all(bind=test_engine)
+    worker_a = SequenceCodeGenerator(test_engine, block_size=50)
+    worker_b = SequenceCodeGenerator(test_engine, block_size=50)
+
+    codes = worker_a.next_codes(120) + worker_b.next_codes(30) + [worker_a.next_code() for _ in range(40)]
+    assert len(codes) == len(set(codes))
+    assert all(len(code) == 6 for code in codes)
+    # Пока блок не исчерпан, код выдаётся без обращения к БД
+    assert worker_b.try_next_code() is not None
+
+    # Кодирование id биективно и на границе 6-символьного пространства
+    assert len({id_to_code(n) for n in range(10_000)}) == 10_000
+    assert id_to_code(CODE_SPACE - 1) != id_to_code(CODE_SPACE)
+    assert len(id_to_code(CODE_SPACE)) == 7
+
+def test_custom_alias_conflict():
+    """
+    Проверяем, что занятый alias даёт 400 без предварительного SELECT.
+    """
+    unique_alias = f"alias_{int(time.time()*1000)}"
+    payload = {"original_url": "https://alias.com", "custom_alias": unique_alias, "expires_at": None}
+    assert client.post("/links/shorten", json=payload).status_code == 201
+    response = client.post("/links/shorten", json=payload)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Код занят."
+
+def test_bulk_create_links():
+    """
+    Проверяем массовое создание ссылок из JSON-массива и NDJSON с результатом по каждой ссылке.
+    """
+    taken_alias = f"bulktaken_{int(time.time()*1000)}"
+    new_alias = f"bulknew_{int(time.time()*1000)}"
+    client.post("/links/shorten", json={"original_url": "https://taken.com", "custom_alias": taken_alias})
+
+    items = [
+        {"original_url": "https://bulk1.com"},
+        {"original_url": "not a url"},
+        {"original_url": "https://bulk2.com", "custom_alias": new_alias},
+        {"original_url": "https://bulk3.com", "custom_alias": new_alias},
+        {"original_url": "https://bulk4.com", "custom_alias": taken_alias},
+    ] + [{"original_url": f"https://bulk-many.com/{i}"} for i in range(200)]
+    response = client.post("/links/shorten/bulk", json=items)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["created"] == 202
+    assert data["failed"] == 3
+    statuses = [r["status"] for r in data["results"][:5]]
+    assert statuses == ["created", "error", "created", "error", "error"]
+    assert data["results"][2]["short_code"] == new_alias
+    assert data["results"][4]["detail"] == "Код занят."
+
+    short_code = data["results"][0]["short_code"]
+    response_redirect = client.get(f"/links/{short_code}", follow_redirects=False)
+    assert response_redirect.headers["location"].rstrip("/") == "https://bulk1.com"
+
+    ndjson = "\n".join(json.dumps({"original_url": f"https://ndjson.com/{i}"}) for i in range(3)) + "\n"
+    response = client.post("/links/shorten/bulk", content=ndjson, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.json()["created"] == 3
+
+def test_keyset_pagination_api_and_dashboard():
+    """
+    Проверяем постраничную выдачу ссылок пользователя через API и потоковый личный кабинет.
+    """
+    headers = authenticate_user(f"pager_{int(time.time()*1000)}", "pager_password")
+    items = [{"original_url": f"https://pager.com/{i}"} for i in range(7)]
+    created = client.post("/links/shorten/bulk", json=items, headers=headers).json()
+    created_codes = {r["short_code"] for r in created["results"]}
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 3}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/users/me/links", params=params, headers=headers)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) <= 3
+        seen.extend(item["short_code"] for item in page["items"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert len(seen) == len(set(seen)) == 7
+    assert set(seen) == created_codes
+
+    assert client.get("/users/me/links", params={"cursor": "garbage"}, headers=headers).status_code == 400
+
+    dashboard = client.get("/dashboard", headers=headers)
+    assert dashboard.status_code == 200
+    assert dashboard.text.count("/edit_link?short_code=") == 7
+    assert dashboard.text.rstrip().endswith("</html>")
+
+def explain_query_plan(stmt) -> str:
+    compiled = stmt.compile(engine)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    with engine.connect() as conn:
+        plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params).all()
+    return " | ".join(row[-1] for row in plan)
+
+def test_migrations_add_indexes_used_by_hot_queries():
+    """
+    Проверяем, что миграции применяются и горячие запросы используют индексы.
+    """
+    upgrade(engine)
+    assert pending_migrations(engine) == []
+    assert upgrade(engine) == []  # повторный запуск ничего не делает
+
+    page_plan = explain_query_plan(user_links_query(1, encode_cursor(datetime.utcnow(), "zzzzzz"), 100))
+    assert "ix_links_user_id_created_at_short_code" in page_plan
+    assert "TEMP B-TREE" not in page_plan  # сортировка берётся из индекса
+
+    expired_plan = explain_query_plan(select(Link.short_code).where(Link.expires_at < datetime.utcnow()).limit(100))
+    assert "ix_links_expires_at" in expired_plan
+
+def test_reaper_deletes_expired_links_in_batches(monkeypatch):
+    """
+    Проверяем, что истёкшие ссылки удаляются пачками, кэш сбрасывается, а метрики доступны админу.
+    """
+    prefix = f"expired_{int(time.time()*1000)}"
+    for i in range(5):
+        response = client.post(
+            "/links/shorten",
+            json={"original_url": "https://expired.com", "custom_alias": f"{prefix}_{i}", "expires_at": "2000-01-01T00:00:00"}
+        )
+        assert response.status_code == 201
+    # Истёкшая ссылка отвечает 410 и попадает в кэш редиректов
+    assert client.get(f"/links/{prefix}_0", follow_redirects=False).status_code == 410
+
+    reaper = ExpiredLinkReaper(engine, interval=0, batch_size=2, batch_pause=0, grace_seconds=0)
+    assert reaper.run_once() >= 5
+    stats = reaper.stats()
+    assert stats["batches"] >= 3
+    assert stats["rows_reaped"] >= 5
+
+    with SessionLocal() as db:
+        assert db.query(Link).filter(Link.short_code.like(f"{prefix}_%")).count() == 0
+    assert client.get(f"/links/{prefix}_0", follow_redirects=False).status_code == 404
+
+    # Метрики фонового процесса видны только с админ-токеном
+    monkeypatch.setattr(handlers.admin, "ADMIN_TOKEN", "secret")
+    assert client.get("/admin/reaper").status_code == 403
+    response = client.get("/admin/reaper", headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    assert "rows_reaped" in response.json()
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_session_factory_modes_create_redirect_and_stats(monkeypatch, mode):
+    """
+    Проверяем обе фабрики сессий независимо от DB_MODE прогона: sync отдаёт ThreadedSession
+    поверх синхронной сессии, async — AsyncSession; создание, редирект и статистика работают в обеих.
+    """
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+    async_engine = None
+    if mode == "async":
+        async_engine = sqlstuff.create_app_engine(sqlstuff.to_async_url(sqlstuff.DATABASE_URL), async_mode=True)
+        primary = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    else:
+        primary = sqlstuff.SessionLocal
+    monkeypatch.setattr(sqlstuff, "DB_MODE", mode)
+    monkeypatch.setattr(sqlstuff.read_router, "primary", primary)
+    monkeypatch.setattr(sqlstuff.read_router, "replica", None)
+
+    async def session_type():
+        async with sqlstuff.open_session() as db:
+            return type(db), await db.scalar(select(func.count()).select_from(Link))
+
+    try:
+        db_type, links = asyncio.run(session_type())
+        assert db_type is (AsyncSession if mode == "async" else sqlstuff.ThreadedSession)
+        assert links >= 0
+
+        alias = f"mode_{mode}_{int(time.time()*1000)}"
+        response = client.post("/links/shorten", json={"original_url": f"https://{mode}.com", "custom_alias": alias})
+        assert response.status_code == 201
+        for fast in (True, False):
+            monkeypatch.setattr(fast_redirect, "FAST_REDIRECT", fast)
+            response = client.get(f"/links/{alias}", follow_redirects=False)
+            assert response.status_code == 302
+            assert response.headers["location"].startswith(f"https://{mode}.com")
+        click_aggregator.flush()
+        response = client.get(f"/links/{alias}/stats")
+        assert response.status_code == 200
+        assert response.json()["original_url"].startswith(f"https://{mode}.com")
+    finally:
+        if async_engine is not None:
+            async_engine.sync_engine.dispose()
+
+def test_production_profile_applies_sqlite_pragmas(tmp_path):
+    """
+    Проверяем, что DB_PROFILE=production выполняет PRAGMA на каждом новом соединении
+    (синхронном и асинхронном), а профиль default оставляет настройки SQLite по умолчанию.
+    """
+    from config import SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, SQLITE_BUSY_TIMEOUT_MS
+    expected = {
+        "journal_mode": "wal",
+        "synchronous": 1,  # NORMAL
+        "busy_timeout": SQLITE_BUSY_TIMEOUT_MS,
+        "cache_size": SQLITE_CACHE_SIZE,
+        "mmap_size": SQLITE_MMAP_SIZE,
+        "temp_store": 2,  # MEMORY
+    }
+
+    def read_pragmas(conn):
+        return {name: conn.exec_driver_sql(f"PRAGMA {name}").scalar() for name in expected}
+
+    url = f"sqlite:///{tmp_path / 'production.sqlite'}"
+    production = sqlstuff.create_app_engine(url, profile="production")
+    default = sqlstuff.create_app_engine(f"sqlite:///{tmp_path / 'default.sqlite'}", profile="default")
+    async_production = sqlstuff.create_app_engine(sqlstuff.to_async_url(url), profile="production", async_mode=True)
+
+    async def read_async_pragmas():
+        async with async_production.connect() as conn:
+            return await conn.run_sync(read_pragmas)
+
+    try:
+        with production.connect() as conn:
+            assert read_pragmas(conn) == expected
+        assert asyncio.run(read_async_pragmas()) == expected
+        with default.connect() as conn:
+            pragmas = read_pragmas(conn)
+        assert pragmas["journal_mode"] == "delete" and pragmas["synchronous"] == 2
+    finally:
+        production.dispose()
+        default.dispose()
+        async_production.sync_engine.dispose()
+
+def use_test_replica(monkeypatch, tmp_path):
+    """Подключает пустую реплику в tmp_path. Возвращает её синхронный движок и фабрику сессий."""
+    replica_url = f"sqlite:///{tmp_path / 'replica.sqlite'}"
+    replica_engine = create_engine(replica_url)
+    Base.metadata.create_all(bind=replica_engine)
+    if sqlstuff.DB_MODE == "async":
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        replica = async_sessionmaker(sqlstuff.create_app_engine(sqlstuff.to_async_url(replica_url), async_mode=True))
+    else:
+        replica = sessionmaker(bind=sqlstuff.create_app_engine(replica_url))
+    monkeypatch.setattr(sqlstuff.read_router, "replica", replica)
+    monkeypatch.setattr(sqlstuff.read_router, "_last_write", OrderedDict())
+    return replica_engine, replica
+
+def test_reads_use_replica_with_primary_fallback(monkeypatch, tmp_path):
+    """
+    Проверяем, что чтения идут в реплику, запись временно переключает на основную БД
+    только чтения того же клиента, а отсутствующая в отстающей реплике ссылка
+    перепроверяется в основной.
+    """
+    replica_engine, replica = use_test_replica(monkeypatch, tmp_path)
+    router = sqlstuff.read_router
+
+    suffix = int(time.time() * 1000)
+    response = client.post("/links/shorten", json={"original_url": "https://primary.com", "custom_alias": f"primary_{suffix}"})
+    assert response.status_code == 201
+    # TestClient ходит с адреса "testclient": записал анонимный клиент с этого IP
+    assert router.recently_written("ip:testclient")
+    assert router.session_factory(read_only=True, client="ip:testclient") is router.primary
+    # Чужая запись не уводит чтения других клиентов с реплики
+    assert router.session_factory(read_only=True, client="token:someone_else") is replica
+
+    # Окно после записи истекло: чтения снова идут в реплику
+    router._last_write.clear()
+    assert router.session_factory(read_only=True, client="ip:testclient") is replica
+    with replica_engine.begin() as conn:
+        conn.execute(Link.__table__.insert().values(
+            short_code=f"replica_{suffix}", original_url="https://replica.com", created_at=datetime.utcnow()
+        ))
+    response = client.get(f"/links/replica_{suffix}/stats")
+    assert response.status_code == 200
+    assert response.json()["original_url"].startswith("https://replica.com")
+
+    # Реплика ещё не получила ссылку — ответ берётся из основной БД, а не 404
+    response = client.get(f"/links/primary_{suffix}", follow_redirects=False)
+    assert response.status_code == 302
+    assert response.headers["location"].startswith("https://primary.com")
+
+def test_stale_replica_row_is_not_cached_after_update(monkeypatch, tmp_path):
+    """
+    Проверяем, что после изменения ссылки отстающая реплика со старым original_url
+    не попадает в кэш: сброшенный ключ заполняется из основной БД, в том числе
+    для других клиентов и после окна read-your-writes.
+    """
+    replica_engine, replica = use_test_replica(monkeypatch, tmp_path)
+    router = sqlstuff.read_router
+    headers = authenticate_user("stale_owner", "stale_password")
+    alias = f"stale_{int(time.time()*1000)}"
+    assert client.post(
+        "/links/shorten", json={"original_url": "https://old-target.com", "custom_alias": alias}, headers=headers
+    ).status_code == 201
+    with replica_engine.begin() as conn:
+        conn.execute(Link.__table__.insert().values(
+            short_code=alias, original_url="https://old-target.com", created_at=datetime.utcnow()
+        ))
+    router._last_write.clear()  # регистрация и создание — тоже записи; считаем только обновление
+    assert client.put(
+        f"/links/{alias}", json={"original_url": "https://new-target.com"}, headers=headers
+    ).status_code == 200
+
+    # Окно read-your-writes только у владельца; реплика всё ещё отдаёт старый адрес
+    assert router.session_factory(read_only=True, client="token:stale_owner") is router.primary
+    assert router.session_factory(read_only=True, client="ip:testclient") is replica
+    router._last_write.clear()
+    with replica_engine.connect() as conn:
+        stale = conn.execute(select(Link.original_url).where(Link.short_code == alias)).scalar_one()
+    assert stale == "https://old-target.com"
+
+    for fast in (True, False):
+        monkeypatch.setattr(fast_redirect, "FAST_REDIRECT", fast)
+        delete_cache(f"link_redirect_{alias}")
+        response = client.get(f"/links/{alias}", follow_redirects=False)
+        assert response.headers["location"].startswith("https://new-target.com")
+        assert get_cache(f"link_redirect_{alias}")[0].startswith("https://new-target.com")
+    assert client.get(f"/links/{alias}/stats").json()["original_url"].startswith("https://new-target.com")
+
+    # Сброс, пришедший от другого воркера, тоже отправляет заполнение ключа в основную БД
+    other_key = f"link_redirect_other_{alias}"
+    assert not recent_invalidations.recent(other_key)
+    cache_tier._on_invalidate(other_key)
+    assert recent_invalidations.recent(other_key)
+
+def test_tiered_cache_invalidates_other_workers():
+    """
+    Проверяем, что воркеры видят записи друг друга через общий L2, удаление в одном
+    воркере сразу убирает копию из L1 другого, обращения к L2 не блокируют event loop,
+    пакетное удаление идёт одним вызовом, а недоступный L2 отключается после нескольких ошибок.
+    """
+    shared = InMemorySharedBackend()
+    worker_a = TieredCache(LRUCache(100, 1024 * 1024, 0), shared, l1_ttl=60)
+    worker_b = TieredCache(LRUCache(100, 1024 * 1024, 0), shared, l1_ttl=60)
+
+    worker_a.set("link_redirect_abc", ("https://old.com", None), ttl=300)
+    worker_a.flush()  # запись в L2 уходит в фоновый поток
+    assert worker_b.get("link_redirect_abc") == ("https://old.com", None)  # из L2
+    assert "link_redirect_abc" in worker_b.local  # и теперь в L1 воркера B
+
+    worker_a.delete("link_redirect_abc")
+    worker_a.flush()
+    assert "link_redirect_abc" not in worker_b.local
+    assert worker_b.get("link_redirect_abc") is None
+    assert worker_b.stats()["invalidations_received"] == 1
+
+    # Медленный L2 не останавливает event loop: пока идёт чтение, другие задачи работают
+    class SlowBackend(InMemorySharedBackend):
+        def get(self, key):
+            time.sleep(0.2)
+            return super().get(key)
+
+        def invalidate(self, channel, keys):
+            self.invalidate_calls = getattr(self, "invalidate_calls", 0) + 1
+            super().invalidate(channel, keys)
+
+    slow = SlowBackend()
+    worker_slow = TieredCache(LRUCache(100, 1024 * 1024, 0), slow, l1_ttl=60, threads=1)
+
+    async def read_while_ticking():
+        ticks = 0
+        read = asyncio.ensure_future(worker_slow.get_async("missing"))
+        while not read.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return await read, ticks
+
+    value, ticks = asyncio.run(read_while_ticking())
+    assert value is None and ticks >= 5
+    worker_slow.delete_many([f"link_redirect_{i}" for i in range(1000)])
+    worker_slow.flush()
+    assert slow.invalidate_calls == 1  # 1000 ключей — один конвейер, а не 2000 обращений
+
+    # Недоступный L2 не ломает кэш: остаётся локальный уровень, а после ошибок подряд
+    # L2 на время отключается и запросы к нему не идут
+    class BrokenBackend(InMemorySharedBackend):
+        calls = 0
+
+        def get(self, key):
+            BrokenBackend.calls += 1
+            raise ConnectionError("redis down")
+    worker_c = TieredCache(LRUCache(100, 1024 * 1024, 0), BrokenBackend(), l1_ttl=60, failure_threshold=2, cooldown=60)
+    for _ in range(5):
+        assert worker_c.get("missing") is None
+    stats = worker_c.stats()
+    assert BrokenBackend.calls == 2
+    assert stats["shared_errors"] == 2 and stats["shared_skipped"] == 3
+    assert stats["shared_circuit_open"] == 1 and stats["shared_circuit_trips"] == 1
+    for worker in (worker_a, worker_b, worker_slow, worker_c):
+        worker.close()
+
+def test_click_events_rollups_and_timeseries():
+    """
+    Проверяем, что редирект кладёт событие в буфер, фоновая запись обновляет
+    агрегаты по минутам/часам/дням, а timeseries отдаёт их с нулями в пустых интервалах.
+    """
+    short_code = f"ts_{int(time.time()*1000)}"
+    assert client.post("/links/shorten", json={"original_url": "https://ts.com", "custom_alias": short_code}).status_code == 201
+    response = client.get(
+        f"/links/{short_code}",
+        headers={"Referer": "https://news.example.com/post/1", "User-Agent": "Mozilla/5.0 Chrome/120.0 Safari/537.36"},
+        follow_redirects=False
+    )
+    assert response.status_code == 302
+    base = datetime(2024, 5, 1, 10, 15)
+    click_events.record(short_code, None, "curl/8.0", None, when=base)
+    click_events.record(short_code, None, "Googlebot/2.1", None, when=base.replace(minute=45))
+    click_events.record(short_code, None, None, None, when=base.replace(hour=12))
+    click_events.flush_all()
+
+    with SessionLocal() as db:
+        events = db.query(ClickEvent).filter(ClickEvent.short_code == short_code).all()
+    assert len(events) == 4
+    assert {(e.referrer, e.ua_family) for e in events} >= {("news.example.com", "Chrome"), (None, "curl"), (None, "Bot")}
+
+    response = client.get(
+        f"/links/{short_code}/stats/timeseries",
+        params={"granularity": "hour", "start": "2024-05-01T10:30:00", "end": "2024-05-01T12:00:00"}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [(p["bucket_start"], p["clicks"]) for p in data["points"]] == [
+        ("2024-05-01T10:00:00", 2), ("2024-05-01T11:00:00", 0), ("2024-05-01T12:00:00", 1),
+    ]
+    response = client.get(
+        f"/links/{short_code}/stats/timeseries",
+        params={"granularity": "day", "start": "2024-05-01T00:00:00", "end": "2024-05-01T23:00:00"}
+    )
+    assert response.json()["points"] == [{"bucket_start": "2024-05-01T00:00:00", "clicks": 3}]
+    assert client.get(f"/links/{short_code}/stats/timeseries", params={"granularity": "minute", "start": "2020-01-01T00:00:00"}).status_code == 400
+    assert client.get("/links/no_such_code_ts/stats/timeseries").status_code == 404
+    assert ua_family("Mozilla/5.0 Chrome/120.0 Safari/537.36 Edg/120.0") == "Edge"
+
+def test_deleting_link_removes_click_analytics():
+    """
+    Проверяем, что удаление ссылки (API, форма и reaper) удаляет её click_events и click_rollups,
+    включая ещё не записанные события из буфера, и не трогает аналитику других ссылок.
+    """
+    headers = authenticate_user("analytics_delete_user", "analytics_delete_password")
+    suffix = int(time.time() * 1000)
+    api_code, form_code, kept_code, expired_code = (f"{name}_{suffix}" for name in ("an_api", "an_form", "an_kept", "an_expired"))
+    for code in (api_code, form_code, kept_code):
+        assert client.post("/links/shorten", json={"original_url": "https://an.com", "custom_alias": code}, headers=headers).status_code == 201
+    assert client.post(
+        "/links/shorten", json={"original_url": "https://an.com", "custom_alias": expired_code, "expires_at": "2000-01-01T00:00:00"}
+    ).status_code == 201
+    when = datetime(2024, 6, 1, 10, 0)
+    for code in (api_code, form_code, kept_code, expired_code):
+        click_events.record(code, None, None, None, when=when)
+    click_events.flush_all()
+    for code in (api_code, form_code, kept_code, expired_code):
+        click_events.record(code, None, None, None, when=when)  # ещё в буфере
+
+    def analytics_rows(code):
+        with SessionLocal() as db:
+            return (
+                db.query(ClickEvent).filter(ClickEvent.short_code == code).count(),
+                db.query(ClickRollup).filter(ClickRollup.short_code == code).count(),
+            )
+
+    assert client.delete(f"/links/{api_code}", headers=headers).status_code == 200
+    assert client.post("/links/delete", data={"short_code": form_code}, headers=headers, follow_redirects=False).status_code == 303
+    ExpiredLinkReaper(engine, interval=0, batch_size=100, batch_pause=0, grace_seconds=0).run_once()
+    click_events.flush_all()
+    for code in (api_code, form_code, expired_code):
+        assert analytics_rows(code) == (0, 0)
+    assert analytics_rows(kept_code) == (2, 3)
+
+    # Редирект, начавшийся до удаления, записывает клик после discard и до commit удаления
+    from handlers.links import get_link, delete_link_analytics
+    late_code = f"an_late_{suffix}"
+    assert client.post("/links/shorten", json={"original_url": "https://an.com", "custom_alias": late_code}).status_code == 201
+
+    async def delete_with_late_clicks():
+        async with sqlstuff.open_session() as db:
+            link = await get_link(late_code, db)
+            await delete_link_analytics(db, [late_code])
+            click_events.record(late_code, None, None, None, when=when)
+            # record проверил надгробие до того, как оно появилось, и дописал событие позже
+            click_events._buffer.append((late_code, when, None, None, None))
+            await db.delete(link)
+            await db.commit()
+
+    discarded = click_events.stats()["discarded"]
+    asyncio.run(delete_with_late_clicks())
+    click_events.flush_all()
+    assert analytics_rows(late_code) == (0, 0)
+    assert click_events.stats()["discarded"] == discarded + 2
+
+    # Alias занят новой ссылкой: её клики снова записываются
+    assert client.post("/links/shorten", json={"original_url": "https://an.com", "custom_alias": late_code}).status_code == 201
+    click_events.record(late_code, None, None, None, when=when)
+    click_events.flush_all()
+    assert analytics_rows(late_code) == (1, 3)
+
+def test_export_links_in_chunks_since_watermark(monkeypatch):
+    """
+    Проверяем, что выгрузка идёт порциями в сжатый CSV, учитывает отметку since
+    и доступна администратору потоком с отметкой для следующей выгрузки.
+    """
+    started = datetime.utcnow()
+    prefix = f"export_{int(time.time()*1000)}"
+    for i in range(5):
+        assert client.post("/links/shorten", json={"original_url": f"https://export.com/{i}", "custom_alias": f"{prefix}_{i}"}).status_code == 201
+
+    def read_csv(data: bytes) -> list[dict]:
+        return list(csv.DictReader(io.StringIO(gzip.decompress(data).decode())))
+
+    job = Export("links", "csv.gz", since=started, chunk_size=2, lag_seconds=0)
+    rows = read_csv(b"".join(job.chunks()))
+    assert {row["short_code"] for row in rows} >= {f"{prefix}_{i}" for i in range(5)}
+    assert job.rows_exported == len(rows)
+    # Следующая выгрузка с отметкой предыдущей не повторяет строки
+    next_job = Export("links", "csv.gz", since=job.until, lag_seconds=0)
+    assert not any(row["short_code"].startswith(prefix) for row in read_csv(b"".join(next_job.chunks())))
+
+    with pytest.raises(ValueError):
+        Export("links", "csv.gz", watermark_column="original_url")
+
+    monkeypatch.setattr(handlers.admin, "ADMIN_TOKEN", "secret")
+    response = client.get("/admin/export/links", params={"since": started.isoformat()}, headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    assert "X-Export-Watermark" in response.headers
+    assert gzip.decompress(response.content).decode().startswith("short_code,original_url")
+    assert client.get("/admin/export/users", headers={"X-Admin-Token": "secret"}).status_code == 400
+
+def test_benchmark_comparison_flags_regressions():
+    """
+    Проверяем, что сравнение с прошлым прогоном отмечает рост p95/p99 и падение req/s
+    сверх порога и не реагирует на шум в пределах порога.
+    """
+    baseline = {"results": [
+        {"target": "asgi", "scenario": "redirect", "rps": 1000.0, "p50_ms": 2.0, "p95_ms": 5.0, "p99_ms": 10.0},
+        {"target": "asgi", "scenario": "stats", "rps": 500.0, "p50_ms": 4.0, "p95_ms": 8.0, "p99_ms": 12.0},
+    ]}
+    results = [
+        {"target": "asgi", "scenario": "redirect", "rps": 980.0, "p50_ms": 2.1, "p95_ms": 5.2, "p99_ms": 10.5},
+        {"target": "asgi", "scenario": "stats", "rps": 400.0, "p50_ms": 4.0, "p95_ms": 10.0, "p99_ms": 12.0},
+        {"target": "uvicorn", "scenario": "stats", "rps": 300.0, "p50_ms": 5.0, "p95_ms": 9.0, "p99_ms": 15.0},
+    ]
+    comparison = {(c["target"], c["scenario"]): c for c in compare(results, baseline, threshold=0.10)}
+    assert comparison[("asgi", "redirect")]["regressions"] == []
+    assert comparison[("asgi", "stats")]["regressions"] == ["p95_ms", "rps"]
+    assert ("uvicorn", "stats") not in comparison  # в baseline такого сценария нет
+
+@pytest.mark.skipif(not METRICS_ENABLED, reason="METRICS_ENABLED=0")
+def test_metrics_endpoint_and_thread_sharded_histogram():
+    """
+    Проверяем, что /metrics отдаёт задержки по шаблону маршрута, запросы к БД и кэш,
+    а гистограмма суммирует значения, записанные из разных потоков.
+    """
+    short_code = f"metrics_{int(time.time()*1000)}"
+    assert client.post("/links/shorten", json={"original_url": "https://metrics.com", "custom_alias": short_code}).status_code == 201
+    client.get(f"/links/{short_code}", follow_redirects=False)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert 'http_requests_total{method="POST",route="/links/shorten",status="201"}' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/links/{short_code}",le="+Inf"}' in text
+    assert short_code not in text  # в метках шаблон маршрута, а не путь
+    assert 'db_queries_total{operation="INSERT"}' in text
+    assert "db_commits_total" in text
+    assert "cache_hits_total" in text
+
+    histogram = Histogram("test_seconds", "Тест", ("kind",), buckets=(0.1, 1.0), registry=MetricsRegistry())
+    threads = [threading.Thread(target=lambda: [histogram.observe(("a",), 0.5) for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    histogram.observe(("a",), 5.0)
+    assert histogram.values()[("a",)] == [0, 4000, 1, 2005.0]
+
+def test_profiler_captures_request_by_admin_header(monkeypatch):
+    """
+    Проверяем, что запрос с X-Profile и админ-токеном профилируется, стеки рабочих
+    потоков (bcrypt, run_in_threadpool) относятся к нему, а сводка доступна в формате collapsed stacks.
+    """
+    monkeypatch.setattr(handlers.admin, "ADMIN_TOKEN", "secret")
+    admin_headers = {"X-Admin-Token": "secret"}
+    client.delete("/admin/profile", headers=admin_headers)
+    username = f"profiled_{int(time.time()*1000)}"
+    response = client.post(
+        "/users/register", json={"username": username, "password": "pw"}, headers={"X-Profile": "secret"}
+    )
+    assert response.status_code == 201
+    # Без верного токена заголовок игнорируется
+    client.get("/links/no_such_profiled_code", headers={"X-Profile": "wrong"})
+
+    recent = client.get("/admin/profile/requests", headers=admin_headers).json()["requests"]
+    assert [r["route"] for r in recent] == ["/users/register"]
+    assert recent[0]["samples"] > 0
+
+    collapsed = client.get("/admin/profile", headers=admin_headers).text
+    lines = collapsed.splitlines()
+    assert lines and all(line.startswith("/users/register;") for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("[bcrypt" in line for line in lines)  # хэширование в пуле bcrypt попало в профиль запроса
+    assert client.get("/admin/profile").status_code == 403
+
+    # Рабочий поток относится к запросу, пока выполняет его задачу; закончившийся запрос сэмплов не получает
+    import profiler
+    sampler = profiler.SamplingProfiler(0.001, 100, 50, 10)
+    profile = profiler.RequestProfile()
+
+    async def sample_in_worker():
+        token = profiler.profiled_request.set(profile)
+        try:
+            await profiler.run_in_threadpool(sampler._sample_once)
+        finally:
+            profiler.profiled_request.reset(token)
+
+    sampler._active.add(profile)
+    asyncio.run(sample_in_worker())
+    assert sum(profile.samples.values()) == 1
+    assert any("_sample_once" in stack for stack in profile.samples)
+    assert profiler._worker_profiles == {}
+    sampler._active.discard(profile)
+    asyncio.run(sample_in_worker())
+    assert sum(profile.samples.values()) == 1 and sampler.samples_taken == 1
+
+def test_fast_redirect_matches_router_handler(monkeypatch):
+    """
+    Проверяем, что быстрый путь редиректа отвечает так же, как обработчик FastAPI:
+    302 с тем же Location, 404 и 410 с тем же телом, и так же учитывает клики.
+    """
+    suffix = int(time.time() * 1000)
+    url = "https://fast.com/path with space?q=1"
+    client.post("/links/shorten", json={"original_url": url, "custom_alias": f"fast_{suffix}"})
+    client.post("/links/shorten", json={
+        "original_url": "https://old.com", "custom_alias": f"fast_old_{suffix}", "expires_at": "2000-01-01T00:00:00"
+    })
+
+    def responses():
+        result = []
+        for code in (f"fast_{suffix}", f"fast_old_{suffix}", f"fast_missing_{suffix}"):
+            response = client.get(f"/links/{code}", follow_redirects=False)
+            result.append((response.status_code, response.headers.get("location"), response.content))
+        return result
+
+    # Второй проход без кэша редиректов: ссылка читается Core-запросом, а не из кэша
+    fast = responses()
+    for code in (f"fast_{suffix}", f"fast_old_{suffix}", f"fast_missing_{suffix}"):
+        delete_cache(f"link_redirect_{code}")
+    assert responses() == fast
+    monkeypatch.setattr(fast_redirect, "FAST_REDIRECT", False)
+    assert responses() == fast
+    assert [status for status, _, _ in fast] == [302, 410, 404]
+
+    # Три редиректа (два быстрых и один через роутер) учтены одинаково
+    assert click_aggregator.pending(f"fast_{suffix}")[0] == 3
+    click_aggregator.flush()
+    assert client.get(f"/links/fast_{suffix}/stats").json()["clicks"] == 3
+
+def test_static_pages_are_prerendered_with_etag():
+    """
+    Проверяем, что страницы входа, регистрации и главная для гостя отдаются готовыми
+    с ETag, отвечают 304 на If-None-Match и при этом не обращаются к БД.
+    """
+    for path in ("/login_page", "/register_page", "/"):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "text/html; charset=utf-8"
+        etag = response.headers["etag"]
+        assert "Cache-Control" in response.headers
+
+        queries = []
+        listener = lambda *args: queries.append(args)
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            not_modified = client.get(path, headers={"If-None-Match": f'"other", {etag}'})
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        assert not_modified.status_code == 304
+        assert not_modified.content == b""
+        assert not_modified.headers["etag"] == etag.removeprefix("W/")  # ETag без сжатия
+        assert queries == []
+    assert client.get("/", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+    # Для пользователя страницы по-прежнему собираются с его именем в навигации
+    headers = authenticate_user("template_user", "template_password")
+    response = client.get("/create", headers=headers)
+    assert "Привет, template_user" in response.text
+    assert "etag" not in response.headers
+
+def test_stats_etag_and_response_compression():
+    """
+    Проверяем, что статистика отдаётся с ETag и отвечает 304 из кэша, а большие
+    и потоковые ответы сжимаются по Accept-Encoding.
+    """
+    alias = f"etag_{int(time.time()*1000)}"
+    client.post("/links/shorten", json={"original_url": "https://etag.com", "custom_alias": alias})
+    response = client.get(f"/links/{alias}/stats")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.json()["clicks"] == 0
+    assert "content-encoding" not in response.headers  # маленький JSON не сжимается
+
+    assert client.get(f"/links/{alias}/stats", headers={"If-None-Match": etag}).status_code == 304
+    # После клика и сброса кэша статистика другая — и ETag тоже
+    client.get(f"/links/{alias}", follow_redirects=False)
+    delete_cache(f"link_stats_{alias}")
+    response = client.get(f"/links/{alias}/stats", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["clicks"] == 1
+    assert response.headers["etag"] != etag
+
+    # Страница входа больше порога: сжимается, ETag становится слабым и всё так же даёт 304
+    response = client.get("/login_page", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert response.headers["etag"].startswith("W/")
+    assert "Вход" in response.text
+    assert client.get("/login_page", headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+    assert "content-encoding" not in client.get("/login_page", headers={"Accept-Encoding": "identity"}).headers
+
+    # Потоковый личный кабинет сжимается по кускам
+    headers = authenticate_user("gzip_user", "gzip_password")
+    response = client.get("/dashboard", headers={**headers, "Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Личный кабинет" in response.text
+
+def test_token_bucket_rate_limits_without_db(monkeypatch):
+    """
+    Проверяем token bucket (пополнение, LRU-вытеснение ключей) и то, что превышение
+    лимита на создание ссылок и редирект даёт 429 с Retry-After без запросов к БД.
+    """
+    limiter = TokenBucketLimiter(max_keys=2)
+    limit = RateLimit(2, 1.0)
+    assert limiter.acquire("a", limit) == 0 and limiter.acquire("a", limit) == 0
+    assert 0 < limiter.acquire("a", limit) <= 0.5
+    time.sleep(0.6)
+    assert limiter.acquire("a", limit) == 0  # ведро пополнилось
+    limiter.acquire("b", limit)
+    limiter.acquire("c", limit)
+    assert limiter.stats()["keys"] == 2 and limiter.stats()["evictions"] == 1
+
+    # Ведро в Redis опрашивается из пула потоков: медленный Redis не останавливает event loop,
+    # а недоступный — заменяется локальным ведром
+    redis_limiter = ratelimit.RedisTokenBucketLimiter.__new__(ratelimit.RedisTokenBucketLimiter)
+    redis_limiter.__dict__.update(
+        prefix="ratelimit:", allowed=0, rejected=0, errors=0,
+        _redis_errors=(ConnectionError,), _fallback=TokenBucketLimiter(max_keys=10),
+    )
+
+    def slow_script(keys, args):
+        time.sleep(0.2)
+        if keys == ["ratelimit:down"]:
+            raise ConnectionError("redis down")
+        return "0"
+    redis_limiter._script = slow_script
+
+    async def acquire_while_ticking(key):
+        ticks = 0
+        acquire = asyncio.ensure_future(redis_limiter.acquire_async(key, limit))
+        while not acquire.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return await acquire, ticks
+
+    wait, ticks = asyncio.run(acquire_while_ticking("up"))
+    assert wait == 0 and ticks >= 5
+    assert asyncio.run(acquire_while_ticking("down"))[0] == 0
+    assert redis_limiter.stats()["errors"] == 1 and redis_limiter.stats()["allowed"] == 2
+
+    monkeypatch.setattr(ratelimit, "rate_limiter", TokenBucketLimiter(max_keys=100))
+    monkeypatch.setitem(ratelimit.RATE_LIMITS, "create", RateLimit(2, 60))
+    monkeypatch.setitem(ratelimit.RATE_LIMITS, "redirect", RateLimit(1, 60))
+    for _ in range(2):
+        assert client.post("/links/shorten", json={"original_url": "https://limited.com"}).status_code == 201
+    client.get("/links/no_such_limited_code", follow_redirects=False)
+
+    queries = []
+    listener = lambda *args: queries.append(args)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        response = client.post("/links/shorten", json={"original_url": "https://limited.com"})
+        assert response.status_code == 429
+        assert 1 <= int(response.headers["retry-after"]) <= 30
+        for fast in (True, False):
+            monkeypatch.setattr(fast_redirect, "FAST_REDIRECT", fast)
+            response = client.get("/links/no_such_limited_code", follow_redirects=False)
+            assert response.status_code == 429
+            assert response.json()["detail"] == ratelimit.RATE_LIMITED_DETAIL
+            assert "retry-after" in response.headers
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert queries == []
+
+def test_bulk_rate_limit_per_item_and_verified_user_key(monkeypatch):
+    """
+    Проверяем, что массовое создание списывает токен за каждую ссылку, а с RATE_LIMIT_KEY=user
+    ключом служит id пользователя с проверенным токеном; выдуманный токен считается по IP.
+    """
+    headers = authenticate_user("bulk_limit_user", "bulk_limit_password")
+    monkeypatch.setattr(ratelimit, "rate_limiter", TokenBucketLimiter(max_keys=100))
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_KEY", "user")
+    monkeypatch.setitem(ratelimit.RATE_LIMITS, "create", None)
+    monkeypatch.setitem(ratelimit.RATE_LIMITS, "bulk", RateLimit(5, 3600))
+    items = [{"original_url": f"https://bulk-limit.com/{i}"} for i in range(3)]
+
+    assert client.post("/links/shorten/bulk", json=items * 2).status_code == 413
+    assert client.post("/links/shorten/bulk", json=items).status_code == 200
+    response = client.post("/links/shorten/bulk", json=items)
+    assert response.status_code == 429 and "retry-after" in response.headers
+
+    # Проверенный токен — своё ведро пользователя; новый выдуманный токен ведра не даёт
+    client.get("/users/me/links", headers=headers)
+    assert client.post("/links/shorten/bulk", json=items, headers=headers).status_code == 200
+    bogus = {"Authorization": "Bearer not-a-real-token"}
+    assert client.post("/links/shorten/bulk", json=items, headers=bogus).status_code == 429
+    keys = sorted(ratelimit.rate_limiter._buckets)
+    assert keys[0] == "bulk:ip:testclient" and keys[1].startswith("bulk:user:") and len(keys) == 2
+
+def wait_for_bloom_build(bloom_filter, builds: int, timeout: float = 10.0):
+    """Ждёт, пока фоновый поток закончит построение номер builds + 1."""
+    deadline = time.monotonic() + timeout
+    while bloom_filter.builds <= builds:
+        assert time.monotonic() < deadline, "фильтр Блума не построился"
+        time.sleep(0.01)
+
+def test_bloom_filter_short_circuits_missing_codes(monkeypatch):
+    """
+    Проверяем, что после построения фильтра заведомо несуществующий код получает 404
+    без запроса к БД, новые ссылки (одиночные и пакетом) попадают в фильтр без участия
+    инвалидации кэша, а периодическая перестройка возвращает коды, о которых воркер не узнал.
+    """
+    import bloom
+    from bloom import BloomFilter, ShortCodeFilter, short_code_filter
+    test_bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        test_bloom.add(f"code{i}")
+    assert all(f"code{i}" in test_bloom for i in range(1000))
+    assert sum(f"other{i}" in test_bloom for i in range(10000)) < 300  # ~1% ложноположительных
+    assert 0.005 < test_bloom.false_positive_rate() < 0.02
+
+    # Без общего кэша воркеры не узнают о чужих кодах, поэтому по умолчанию фильтр выключен
+    import config
+    assert config.BLOOM_FILTER_ENABLED == (config.CACHE_BACKEND == "redis")
+    monkeypatch.setattr(bloom, "BLOOM_FILTER_ENABLED", True)
+
+    suffix = int(time.time() * 1000)
+    client.post("/links/shorten", json={"original_url": "https://bloom.com", "custom_alias": f"bloom_{suffix}"})
+    builds = short_code_filter.builds
+    short_code_filter.ensure_started()
+    try:
+        wait_for_bloom_build(short_code_filter, builds)
+        assert short_code_filter.ready
+
+        queries = []
+        listener = lambda *args: queries.append(args)
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            for fast in (True, False):
+                monkeypatch.setattr(fast_redirect, "FAST_REDIRECT", fast)
+                assert client.get(f"/links/bloom_missing_{suffix}", follow_redirects=False).status_code == 404
+            assert client.get(f"/links/bloom_missing_{suffix}/stats").status_code == 404
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        assert queries == []
+        assert get_cache(f"link_redirect_bloom_missing_{suffix}") is None  # промахи не засоряют кэш
+
+        # Существующая и только что созданные ссылки проходят фильтр, даже если
+        # оповещения об инвалидации кэша до фильтра не доходят
+        assert client.get(f"/links/bloom_{suffix}", follow_redirects=False).status_code == 302
+        monkeypatch.setattr(cache_tier, "_invalidation_listeners", [])
+        client.post("/links/shorten", json={"original_url": "https://bloom2.com", "custom_alias": f"bloom_new_{suffix}"})
+        assert client.get(f"/links/bloom_new_{suffix}", follow_redirects=False).status_code == 302
+        response = client.post("/links/shorten/bulk", json=[{"original_url": "https://bloom3.com"}] * 3)
+        for result in response.json()["results"]:
+            assert client.get(f"/links/{result['short_code']}", follow_redirects=False).status_code == 302
+
+        monkeypatch.setattr(handlers.admin, "ADMIN_TOKEN", "secret")
+        builds = short_code_filter.builds
+        assert client.post("/admin/bloom/rebuild", headers={"X-Admin-Token": "secret"}).status_code == 202
+        wait_for_bloom_build(short_code_filter, builds)
+        stats = client.get("/admin/bloom", headers={"X-Admin-Token": "secret"}).json()
+        assert stats["builds"] >= 2 and stats["memory_bytes"] > 0 and stats["definite_misses"] >= 3
+        assert client.get(f"/links/bloom_new_{suffix}", follow_redirects=False).status_code == 302
+    finally:
+        short_code_filter.reset()
+
+    # Код, о котором фильтр не узнал (потерянное сообщение), находится после перестройки по расписанию
+    periodic = ShortCodeFilter(engine, 1e-6, 1000, 2.0, 1000, rebuild_interval=0.05)
+    periodic.ensure_started()
+    try:
+        wait_for_bloom_build(periodic, 0)
+        lost = f"bloom_lost_{suffix}"
+        with engine.begin() as conn:
+            conn.execute(Link.__table__.insert().values(short_code=lost, original_url="https://lost.com"))
+        assert not periodic.might_contain(lost)
+        wait_for_bloom_build(periodic, periodic.builds)
+        assert periodic.might_contain(lost)
+    finally:
+        periodic.stop()
+
+def test_cache_snapshot_and_warmup_readiness(monkeypatch, tmp_path):
+    """
+    Проверяем, что горячие записи кэша редиректов переживают перезапуск через JSON-снимок
+    (без просроченных, «ссылки нет», токенов и статистики), прогрев берёт популярные ссылки из БД,
+    а /ready отвечает 503 до окончания прогрева.
+    """
+    import handlers.health
+    from warmup import CacheWarmer
+    from cache import LINK_NOT_FOUND
+    import gzip
+    snapshot = tmp_path / "snapshot.json.gz"
+    expires_at = datetime(2030, 1, 2, 3, 4, 5)
+    before = LRUCache(max_entries=100, max_bytes=1024 * 1024, sweep_interval=0)
+    before.set("link_redirect_cold", ("https://cold.com", expires_at), ttl=300)
+    before.set("link_redirect_hot", ("https://hot.com", None), ttl=300)
+    before.set("link_redirect_gone", LINK_NOT_FOUND, ttl=300)
+    before.set("link_redirect_stale", ("https://stale.com", None), ttl=0.01)
+    before.set("user_token_secret", {"id": 1}, ttl=300)
+    before.set("link_stats_hot", {"clicks": 1}, ttl=300)
+    time.sleep(0.02)
+    before.get("link_redirect_hot")
+    assert CacheWarmer(engine, before, str(snapshot), 10, 0, 10).save_snapshot() == 2  # hot и cold
+    with gzip.open(snapshot, "rt") as f:
+        saved = json.load(f)
+    assert [entry[0] for entry in saved["entries"]] == ["link_redirect_hot", "link_redirect_cold"]
+    assert "user_token_secret" not in json.dumps(saved)
+
+    after = LRUCache(max_entries=100, max_bytes=1024 * 1024, sweep_interval=0)
+    after.set("link_redirect_cold", ("https://fresh.com", None), ttl=300)  # свежая запись не затирается снимком
+    assert CacheWarmer(engine, after, str(snapshot), 10, 0, 10).load_snapshot() == 1
+    assert after.get("link_redirect_hot") == ("https://hot.com", None)
+    assert after.get("link_redirect_cold") == ("https://fresh.com", None)
+    assert after.get("link_redirect_gone") is None and after.get("link_redirect_stale") is None
+    restored = LRUCache(max_entries=100, max_bytes=1024 * 1024, sweep_interval=0)
+    assert CacheWarmer(engine, restored, str(snapshot), 10, 0, 10).load_snapshot() == 2
+    assert [key for key, _, _ in restored.hottest(10)] == ["link_redirect_hot", "link_redirect_cold"]
+    assert restored.get("link_redirect_cold") == ("https://cold.com", expires_at)
+
+    alias = f"warm_{int(time.time()*1000)}"
+    client.post("/links/shorten", json={"original_url": "https://warm.com", "custom_alias": alias})
+    client.get(f"/links/{alias}", follow_redirects=False)
+    click_aggregator.flush()
+    delete_cache(f"link_redirect_{alias}")
+
+    warmer = CacheWarmer(engine, after, str(snapshot), 10, 100_000, 100)
+    monkeypatch.setattr(handlers.health, "cache_warmer", warmer)
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["cache_warmup"]["state"] == "idle"
+    warmer.ensure_started()
+    warmer._thread.join(timeout=10)
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["cache_warmup"]["links_warmed"] >= 1
+    assert get_cache(f"link_redirect_{alias}")[0].startswith("https://warm.com")
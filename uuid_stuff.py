@@ -1,6 +1,144 @@
 import uuid
 import base64
+import os
+import threading
+from sqlalchemy import select, update, insert
+from sqlalchemy.exc import IntegrityError
+from sqlstuff import engine, CodeSequence
+from profiler import run_in_threadpool
+from config import SHORT_CODE_GENERATOR, SHORT_CODE_BLOCK_SIZE
+
+BASE62_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+CODE_LENGTH = 6
+CODE_SPACE = 62 ** CODE_LENGTH
+# Нечётный множитель, не кратный 31, взаимно прост с 62^6: умножение по модулю
+# CODE_SPACE переставляет id, и соседние id дают непохожие коды
+SCRAMBLE_MULTIPLIER = 2654435761
+
+
+def encode_base62(number: int, width: int = 0) -> str:
+    chars = []
+    while number:
+        number, rem = divmod(number, 62)
+        chars.append(BASE62_ALPHABET[rem])
+    return "".join(reversed(chars)).rjust(width, BASE62_ALPHABET[0])
+
+
+def decode_base62(code: str) -> int:
+    number = 0
+    for char in code:
+        number = number * 62 + BASE62_ALPHABET.index(char)
+    return number
+
+
+def id_to_code(number: int) -> str:
+    """
+    Биективно переводит id в короткий код.
+    id меньше 62^6 дают перемешанные коды ровно из 6 символов, остальные — обычный
+    base62 длиной от 7 символов, поэтому разные id никогда не дают одинаковый код.
+    """
+    if number < CODE_SPACE:
+        return encode_base62(number * SCRAMBLE_MULTIPLIER % CODE_SPACE, CODE_LENGTH)
+    return encode_base62(number)
+
+
+class RandomCodeGenerator:
+    """Прежний генератор: первые 6 символов base32 от UUID4. Возможны коллизии."""
+
+    def next_code(self) -> str:
+        uuid_bytes = uuid.uuid4().bytes
+        short_code = base64.b32encode(uuid_bytes).decode('utf-8').rstrip('=')
+        return short_code[:CODE_LENGTH]
+
+    def try_next_code(self):
+        return self.next_code()
+
+    def next_codes(self, count: int) -> list[str]:
+        return [self.next_code() for _ in range(count)]
+
+
+class SequenceCodeGenerator:
+    """
+    Генератор без коллизий: процесс резервирует в таблице code_sequences блок id
+    и выдаёт коды из него без обращений к БД. Несколько процессов (воркеров uvicorn)
+    получают непересекающиеся блоки и не координируются на каждом запросе.
+    """
+
+    def __init__(self, bind, name: str = "links", block_size: int = 1000, start: int = 1):
+        self.bind = bind
+        self.name = name
+        self.block_size = block_size
+        self.start = start
+        self._next = 0
+        self._end = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def try_next_code(self):
+        """Возвращает код из уже зарезервированного блока или None, если блок исчерпан."""
+        with self._lock:
+            if self._pid != os.getpid() or self._next >= self._end:
+                return None
+            number = self._next
+            self._next += 1
+        return id_to_code(number)
+
+    def next_code(self) -> str:
+        return self.next_codes(1)[0]
+
+    def next_codes(self, count: int) -> list[str]:
+        numbers = []
+        with self._lock:
+            if self._pid != os.getpid():
+                # После fork блок родителя использовать нельзя
+                self._next = self._end = 0
+                self._pid = os.getpid()
+            while len(numbers) < count:
+                if self._next >= self._end:
+                    self._next, self._end = self._reserve_block(max(self.block_size, count - len(numbers)))
+                take = min(count - len(numbers), self._end - self._next)
+                numbers.extend(range(self._next, self._next + take))
+                self._next += take
+        return [id_to_code(number) for number in numbers]
+
+    def _reserve_block(self, size: int) -> tuple[int, int]:
+        table = CodeSequence.__table__
+        while True:
+            try:
+                with self.bind.begin() as conn:
+                    updated = conn.execute(
+                        update(table)
+                        .where(table.c.name == self.name)
+                        .values(next_value=table.c.next_value + size)
+                    ).rowcount
+                    if updated:
+                        end = conn.execute(select(table.c.next_value).where(table.c.name == self.name)).scalar_one()
+                        return end - size, end
+                    conn.execute(insert(table).values(name=self.name, next_value=self.start + size))
+                    return self.start, self.start + size
+            except IntegrityError:
+                # Счётчик одновременно создал другой процесс — повторяем через UPDATE
+                continue
+
+
+def create_code_generator(kind: str):
+    if kind == "sequence":
+        return SequenceCodeGenerator(engine, block_size=SHORT_CODE_BLOCK_SIZE)
+    if kind == "random":
+        return RandomCodeGenerator()
+    raise ValueError(f"Неизвестный SHORT_CODE_GENERATOR: {kind!r} (ожидается 'sequence' или 'random')")
+
+
+code_generator = create_code_generator(SHORT_CODE_GENERATOR)
+
+
 def generate_short_code():
-    uuid_bytes = uuid.uuid4().bytes
-    short_code = base64.b32encode(uuid_bytes).decode('utf-8').rstrip('=')
-    return short_code[:6]
+    return code_generator.next_code()
+
+
+async def generate_short_code_async() -> str:
+    """Выдаёт код без блокировки event loop: к БД идём в пуле потоков, только если блок исчерпан."""
+    short_code = code_generator.try_next_code()
+    if short_code is None:
+        short_code = await run_in_threadpool(code_generator.next_code)
+    return short_code
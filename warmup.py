@@ -0,0 +1,168 @@
+"""
+Прогрев кэша после перезапуска.
+
+При остановке самые используемые записи кэша редиректов (до CACHE_SNAPSHOT_ENTRIES)
+вместе со сроком годности сохраняются в сжатый JSON-файл CACHE_SNAPSHOT_PATH. Токены
+пользователей и статистика в снимок не попадают, а файл не исполняет код при чтении
+(в отличие от pickle). При старте фоновый
+поток загружает из него ещё не истёкшие записи, а затем кладёт в кэш редиректов
+CACHE_WARMUP_LINKS ссылок с наибольшим числом кликов прямо из БД. Записи снимка живут
+не дольше, чем жили бы без перезапуска, поэтому устаревают не сильнее обычного кэша.
+Пока прогрев идёт, /ready отвечает 503 — балансировщик не шлёт трафик на холодный воркер.
+"""
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import select
+from cache import cache_store, set_cache, LINK_NOT_FOUND
+from sqlstuff import engine, Link
+from config import (
+    CACHE_SNAPSHOT_PATH, CACHE_SNAPSHOT_ENTRIES, CACHE_WARMUP_LINKS, CACHE_WARMUP_BATCH, REDIRECT_CACHE_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 2
+REDIRECT_KEY_PREFIX = "link_redirect_"
+
+
+def is_snapshot_entry(key: str, value) -> bool:
+    # Только найденные редиректы: «ссылки нет» за время простоя могла устареть
+    return key.startswith(REDIRECT_KEY_PREFIX) and value is not LINK_NOT_FOUND
+
+
+def encode_entry(key: str, value, expire_at: float) -> list:
+    original_url, expires_at = value
+    return [key, original_url, expires_at.isoformat() if expires_at else None, expire_at]
+
+
+def decode_entry(entry) -> tuple:
+    """[key, url, expires_at ISO, expire_at] -> (key, (url, expires_at), expire_at); ValueError, если запись испорчена."""
+    try:
+        key, original_url, expires_at, expire_at = entry
+    except (TypeError, ValueError):
+        raise ValueError(f"Неверная запись снимка: {entry!r}")
+    if not isinstance(key, str) or not key.startswith(REDIRECT_KEY_PREFIX) or not isinstance(original_url, str):
+        raise ValueError(f"Неверная запись снимка: {entry!r}")
+    expires_at = datetime.fromisoformat(expires_at) if expires_at is not None else None
+    return key, (original_url, expires_at), float(expire_at)
+
+
+class CacheWarmer:
+    def __init__(self, bind, cache, snapshot_path: str, snapshot_entries: int, warmup_links: int, batch_size: int):
+        self.bind = bind
+        self.cache = cache
+        self.snapshot_path = snapshot_path
+        self.snapshot_entries = snapshot_entries
+        self.warmup_links = warmup_links
+        self.batch_size = batch_size
+        self._thread = None
+        self._lock = threading.Lock()
+        self.state = "idle"
+        self.snapshot_loaded = 0
+        self.snapshot_saved = 0
+        self.links_warmed = 0
+        self.seconds = 0.0
+        self.errors = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def save_snapshot(self) -> int:
+        """Сохраняет самые используемые записи кэша. Возвращает их число."""
+        if not self.snapshot_path:
+            return 0
+        entries = self.cache.hottest(self.snapshot_entries, keep=is_snapshot_entry)
+        # Несколько воркеров пишут один файл: каждый во временный, затем атомарная подмена
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=1) as f:
+            json.dump({"version": SNAPSHOT_VERSION, "entries": [encode_entry(*entry) for entry in entries]}, f)
+        os.replace(tmp_path, self.snapshot_path)
+        self.snapshot_saved = len(entries)
+        return len(entries)
+
+    def load_snapshot(self) -> int:
+        """Загружает непросроченные записи снимка. Возвращает их число."""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return 0
+        with gzip.open(self.snapshot_path, "rt", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+            return 0
+        entries = []
+        for entry in snapshot.get("entries", []):
+            try:
+                entries.append(decode_entry(entry))
+            except ValueError:
+                continue
+        self.snapshot_loaded = self.cache.restore(entries)
+        return self.snapshot_loaded
+
+    def warm_from_db(self) -> int:
+        """Кладёт в кэш редиректов самые кликабельные ссылки. Возвращает их число."""
+        if self.warmup_links <= 0:
+            return 0
+        table = Link.__table__
+        query = (
+            select(table.c.short_code, table.c.original_url, table.c.expires_at)
+            .order_by(table.c.clicks.desc())
+            .limit(self.warmup_links)
+        )
+        with self.bind.connect() as conn:
+            result = conn.execution_options(yield_per=self.batch_size).execute(query)
+            for rows in result.partitions():
+                for short_code, original_url, expires_at in rows:
+                    set_cache(f"link_redirect_{short_code}", (original_url, expires_at), ttl=REDIRECT_CACHE_TTL)
+                self.links_warmed += len(rows)
+        return self.links_warmed
+
+    def warm_up(self):
+        started = time.perf_counter()
+        # Сначала снимок, затем БД: свежие данные из БД перекрывают записи снимка
+        for state, step in (("loading_snapshot", self.load_snapshot), ("warming", self.warm_from_db)):
+            self.state = state
+            try:
+                step()
+            except Exception:
+                # Прогрев — оптимизация: без него воркер всё равно работает, только медленнее
+                self.errors += 1
+                logger.exception("Ошибка прогрева кэша (%s)", state)
+        self.seconds = time.perf_counter() - started
+        self.state = "ready"
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.state = "starting"
+            self._thread = threading.Thread(target=self.warm_up, name="cache-warmup", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Сохраняет снимок кэша при остановке приложения."""
+        try:
+            self.save_snapshot()
+        except Exception:
+            self.errors += 1
+            logger.exception("Не удалось сохранить снимок кэша")
+
+    def progress(self) -> dict:
+        return {
+            "state": self.state,
+            "snapshot_loaded": self.snapshot_loaded,
+            "links_warmed": self.links_warmed,
+            "links_target": self.warmup_links,
+            "snapshot_saved": self.snapshot_saved,
+            "seconds": round(self.seconds, 3),
+            "errors": self.errors,
+        }
+
+
+cache_warmer = CacheWarmer(
+    engine, cache_store, CACHE_SNAPSHOT_PATH, CACHE_SNAPSHOT_ENTRIES, CACHE_WARMUP_LINKS, CACHE_WARMUP_BATCH
+)